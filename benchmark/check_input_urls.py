@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Check the handler's input URL cache (InputURLCache) against a local HTTP server, started in-process.
+
+    python3 benchmark/check_input_urls.py
+
+Each check prints "ok" or "FAIL" with the reason; the exit status is 1 if any check failed. Needs requests.
+"""
+import argparse
+import contextlib
+import hashlib
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message: str) -> None:
+    if not condition:
+        raise CheckFailed(message)
+
+
+class ImageServer(http.server.ThreadingHTTPServer):
+    """
+    Serves `images` (path -> bytes) with an ETag, answers conditional GETs with 304, and records the requests.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+        self.images = {}
+        self.unannounced = set() # paths served without a Content-Length
+        self.requests = [] # (path, If-None-Match)
+        self.lock = threading.Lock()
+
+    def url(self, path: str, host: str = "127.0.0.1") -> str:
+        return f"http://{host}:{self.server_address[1]}{path}"
+
+    def downloads(self, path: str) -> int:
+        with self.lock:
+            return sum(1 for requested, etag in self.requests if requested == path and etag != self.etag(path))
+
+    def etag(self, path: str) -> str:
+        return '"' + hashlib.sha256(self.images[path]).hexdigest() + '"'
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("If-None-Match")))
+            content = server.images.get(self.path)
+            etag = server.etag(self.path) if content is not None else None
+        if content is None:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if self.path in server.unannounced:
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Checks:
+    """
+    The checks, run in order of definition; each method whose name starts with `check_` is one.
+    """
+    def __init__(self, rp_handler, workdir: str, verbose: bool = False):
+        self.rp = rp_handler
+        self.workdir = workdir
+        self.verbose = verbose
+        self.server = ImageServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.caches = 0
+
+    def cache(self, max_bytes: int = 1 << 30, max_image_bytes: int = 1 << 20, public_only: bool = False):
+        """
+        A new cache; the local server is only reachable with `public_only` off.
+        """
+        self.caches += 1
+        session = self.rp.make_input_url_session(public_only)
+        return self.rp.InputURLCache(os.path.join(self.workdir, f"cache-{self.caches}"), max_bytes, max_image_bytes, session)
+
+    def serve(self, path: str, content: bytes, announced: bool = True) -> str:
+        self.server.images[path] = content
+        if not announced:
+            self.server.unannounced.add(path)
+        return self.server.url(path)
+
+    def expect_file(self, result: dict, content: bytes) -> None:
+        with open(result["path"], "rb") as f:
+            data = f.read()
+        expect(data == content, f"{result['path']} does not have the served content")
+        expect(result["sha256"] == hashlib.sha256(content).hexdigest(), "the sha256 is not the content's")
+
+    def check_loopback_refused(self):
+        self.serve("/private.png", b"secret")
+        for host in ("127.0.0.1", "localhost"):
+            try:
+                self.cache(public_only=True).fetch(self.server.url("/private.png", host))
+                raise CheckFailed(f"{host} was fetched from")
+            except self.rp.InputURLForbiddenError:
+                pass
+        expect(not self.server.downloads("/private.png"), "the server was sent a request")
+
+    def check_unsupported_scheme_refused(self):
+        for url in ("s3://bucket/users/bob/image.png", "file:///etc/passwd"):
+            try:
+                self.cache().fetch(url)
+                raise CheckFailed(f"{url} was fetched")
+            except ValueError:
+                pass
+
+    def check_revalidated_not_downloaded_again(self):
+        content = os.urandom(5000)
+        url = self.serve("/same.png", content)
+        cache = self.cache()
+        first = cache.fetch(url)
+        second = cache.fetch(url)
+        self.expect_file(second, content)
+        expect(first["path"] == second["path"], "the cached image was not reused")
+        expect(self.server.downloads("/same.png") == 1, f"downloaded {self.server.downloads('/same.png')} times")
+        expect(cache.pins.get(first["path"]) == 2, f"pinned {cache.pins.get(first['path'])} times, instead of once per fetch")
+        cache.release([first["path"], second["path"]])
+        expect(not cache.pins, "the releases did not unpin the image")
+
+    def check_changed_image_does_not_overwrite(self):
+        url = self.serve("/changing.png", b"version 1")
+        cache = self.cache()
+        first = cache.fetch(url)
+        self.server.images["/changing.png"] = b"version 2"
+        second = cache.fetch(url)
+        self.expect_file(second, b"version 2")
+        self.expect_file(first, b"version 1") # still in use by the first job
+
+    def check_announced_size_limit(self):
+        url = self.serve("/large.png", os.urandom(3000))
+        try:
+            self.cache(max_image_bytes=2000).fetch(url)
+            raise CheckFailed("the large image was fetched")
+        except self.rp.InputTooLargeError:
+            pass
+
+    def check_unannounced_size_limit(self):
+        url = self.serve("/large-unannounced.png", os.urandom(600 * 1024), announced=False)
+        cache = self.cache(max_image_bytes=300 * 1024)
+        try:
+            cache.fetch(url)
+            raise CheckFailed("the large image was fetched")
+        except self.rp.InputTooLargeError:
+            pass
+        expect(not os.listdir(cache.directory), f"left {os.listdir(cache.directory)} behind")
+
+    def check_pinned_not_evicted(self):
+        cache = self.cache(max_bytes=3000)
+        first = cache.fetch(self.serve("/a.png", os.urandom(2000)))
+        second = cache.fetch(self.serve("/b.png", os.urandom(2000)))
+        expect(os.path.exists(first["path"]), "a pinned image was evicted")
+        cache.release([first["path"], second["path"]])
+        cache.fetch(self.serve("/c.png", os.urandom(2000)))
+        expect(not os.path.exists(first["path"]), "the least recently used image was not evicted once released")
+
+    def check_concurrent_fetches_consistent(self):
+        url = self.serve("/racy.png", b"v0" * 1000)
+        cache = self.cache()
+        results, errors = [], []
+        def fetch(i):
+            try:
+                self.server.images["/racy.png"] = f"v{i % 3}".encode() * 1000
+                results.append(cache.fetch(url))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expect(not errors, f"errors: {errors}")
+        for result in results:
+            with open(result["path"], "rb") as f:
+                expect(hashlib.sha256(f.read()).hexdigest() == result["sha256"], "an image does not match its sha256")
+        meta = cache.cached(url)
+        expect(meta is not None, "the URL is not cached")
+        with open(cache.image_path(meta["sha256"]), "rb") as f:
+            expect(len(f.read()) == meta["size"], "the metadata does not match the image")
+
+    def run(self) -> int:
+        failures = 0
+        for name in [name for name in Checks.__dict__ if name.startswith("check_")]:
+            try:
+                # The handler is chatty
+                with contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+                    getattr(self, name)()
+                print(f"ok    {name}")
+            except Exception as e:
+                failures += 1
+                print(f"FAIL  {name} -- {e.__class__.__name__}: {e}")
+                if not isinstance(e, CheckFailed):
+                    traceback.print_exc()
+        self.server.shutdown()
+        return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verbose", action="store_true", help="show the handler's output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rp-handler-input-url-check-")
+    try:
+        os.environ.update({
+            "DOCKER_IMAGE_TYPE": "comfyui",
+            "COMFY_INPUT_URL_CACHE_DIR": os.path.join(workdir, "default-cache"),
+            "COMFY_MODEL_CACHE_DIR": "",
+        })
+        sys.path.insert(0, REPO_DIR)
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+            import rp_handler
+        failures = Checks(rp_handler, workdir, args.verbose).run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{failures} check(s) failed" if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Check the handler's S3 code paths, deduplication and multipart uploads, against a local S3 stand-in: moto's server, started in-process, or any S3-compatible server given with --endpoint-url (e.g. MinIO).
+
+    python3 benchmark/check_s3.py
+    python3 benchmark/check_s3.py --endpoint-url http://127.0.0.1:9000 --access-key minioadmin --secret-key minioadmin
+
+Each check prints "ok" or "FAIL" with the reason; the exit status is 1 if any check failed. Needs boto3 and requests, and moto[server] unless --endpoint-url is given.
+"""
+import argparse
+import contextlib
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import traceback
+import urllib.parse
+import uuid
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message: str) -> None:
+    if not condition:
+        raise CheckFailed(message)
+
+
+class Checks:
+    """
+    The checks, run in order of definition; each method whose name starts with `check_` is one.
+    """
+    def __init__(self, rp_handler, workdir: str, verbose: bool = False):
+        self.rp = rp_handler
+        self.workdir = workdir
+        self.verbose = verbose
+        self.client = rp_handler.get_s3_client()
+        self.bucket = rp_handler.AWS_S3_BUCKET
+
+    def new_job(self) -> str:
+        job_id = uuid.uuid4().hex
+        self.rp.JobTimestamp.start_job().set_job_id(job_id)
+        return job_id
+
+    def output_file(self, content: bytes) -> str:
+        path = os.path.join(self.workdir, f"{uuid.uuid4().hex}.png")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def keys(self) -> set:
+        paginator = self.client.get_paginator("list_objects_v2")
+        return {item["Key"] for page in paginator.paginate(Bucket=self.bucket) for item in page.get("Contents", [])}
+
+    def fetch(self, url: str) -> bytes:
+        response = self.rp.requests.get(url, timeout=30)
+        expect(response.status_code == 200, f"GET {url.split('?')[0]}: HTTP {response.status_code}")
+        return response.content
+
+    def upload(self, content: bytes, user: str) -> tuple:
+        """
+        Upload an output file through rp_upload_image().
+
+        Returns:
+            tuple: The URL returned, and the keys that the upload added to the bucket
+        """
+        before = self.keys()
+        url = self.rp.rp_upload_image(self.new_job(), self.output_file(content), {"user": user})
+        return url, self.keys() - before
+
+    @contextlib.contextmanager
+    def patched(self, method: str, replacement):
+        """
+        Replace one of the S3 client's methods, e.g. to make it fail; `replacement` is passed the original.
+        """
+        original = getattr(self.client, method)
+        setattr(self.client, method, lambda *args, **kwargs: replacement(original, *args, **kwargs))
+        try:
+            yield
+        finally:
+            delattr(self.client, method)
+
+    def multipart_file(self) -> tuple:
+        """
+        Returns:
+            tuple: The path of a file of 3 parts, its content, and a key to upload it to
+        """
+        content = os.urandom(2 * self.rp.s3_part_size(0) + 1000)
+        return self.output_file(content), content, f"multipart/{uuid.uuid4().hex}.mp4"
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def pending_uploads(self, key: str) -> list:
+        return [upload for upload in self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=key).get("Uploads", []) if upload["Key"] == key]
+
+    def check_presigned_url_uses_endpoint(self):
+        content = os.urandom(1000)
+        url, added = self.upload(content, "alice")
+        expect(len(added) == 1, f"{len(added)} objects were added")
+        endpoint = urllib.parse.urlsplit(self.rp.AWS_S3_ENDPOINT_URL).netloc
+        expect(endpoint in urllib.parse.urlsplit(url).netloc, f"{url.split('?')[0]} is not on {endpoint}")
+        expect(self.fetch(url) == content, "the object does not match the file")
+
+    def check_dedup_reuses_object(self):
+        content = os.urandom(2000)
+        first, _ = self.upload(content, "alice")
+        second, added = self.upload(content, "alice")
+        expect(not added, "the same content was uploaded twice")
+        expect(first.split("?")[0] == second.split("?")[0], "the second URL is not for the first object")
+        expect(self.fetch(second) == content, "the reused object does not match the file")
+
+    def check_dedup_is_scoped_to_user(self):
+        content = os.urandom(2000)
+        self.upload(content, "alice")
+        _, added = self.upload(content, "bob")
+        expect(len(added) == 1, "bob was handed alice's object")
+        expect(next(iter(added)).startswith("users/bob/"), f"{added} is not under users/bob/")
+
+    def check_dedup_skips_deleted_object(self):
+        content = os.urandom(2000)
+        _, added = self.upload(content, "alice")
+        self.client.delete_object(Bucket=self.bucket, Key=next(iter(added)))
+        second, added = self.upload(content, "alice")
+        expect(len(added) == 1, "a URL to the deleted object was returned")
+        expect(self.fetch(second) == content, "the new object does not match the file")
+
+    def check_dedup_from_memory(self):
+        data = os.urandom(2000)
+        first = self.rp.upload_bytes_to_s3(self.new_job(), "a.png", data, {"user": "alice"})
+        before = self.keys()
+        second = self.rp.upload_bytes_to_s3(self.new_job(), "b.png", data, {"user": "alice"})
+        expect(self.keys() == before, "the same bytes were uploaded twice")
+        expect(first.split("?")[0] == second.split("?")[0], "the second URL is not for the first object")
+
+    def check_index_shared_between_workers(self):
+        content = os.urandom(2000)
+        _, added = self.upload(content, "alice")
+        # Another worker, with the same index file on the network volume
+        other = self.rp.S3DedupIndex(self.rp.S3_DEDUPLICATE_INDEX)
+        key = other.lookup(f"alice/{hashlib.sha256(content).hexdigest()}")
+        expect(key in added, "the other worker's index does not have the upload")
+
+    def check_multipart_round_trip(self):
+        path, content, key = self.multipart_file()
+        job_id = self.new_job()
+        self.rp.multipart_upload_file(job_id, path, key, {})
+        expect(self.get(key) == content, "the object does not match the file")
+        expect(job_id not in self.rp.s3_multipart_uploads, "the finished upload is still remembered")
+        expect(not self.pending_uploads(key), "the upload was left open")
+
+    def check_multipart_resume_sends_missing_parts(self):
+        path, content, key = self.multipart_file()
+        job_id = self.new_job()
+        def fail_part_2(upload_part, **kwargs):
+            if kwargs["PartNumber"] == 2:
+                raise ConnectionError("part 2 lost")
+            return upload_part(**kwargs)
+        with self.patched("upload_part", fail_part_2):
+            try:
+                self.rp.multipart_upload_file(job_id, path, key, {})
+                raise CheckFailed("the failed upload did not raise")
+            except self.rp.S3UploadError:
+                pass
+        expect(set(self.rp.s3_multipart_uploads[job_id][key]["parts"]) == {1, 3}, "the uploaded parts were not remembered")
+        sent = []
+        def count_parts(upload_part, **kwargs):
+            sent.append(kwargs["PartNumber"])
+            return upload_part(**kwargs)
+        with self.patched("upload_part", count_parts):
+            self.rp.multipart_upload_file(job_id, path, key, {})
+        expect(sent == [2], f"the resumed upload sent parts {sent}")
+        expect(self.get(key) == content, "the object does not match the file")
+
+    def check_multipart_abort(self):
+        path, _, key = self.multipart_file()
+        job_id = self.new_job()
+        def fail(upload_part, **kwargs):
+            raise ConnectionError("lost")
+        with self.patched("upload_part", fail):
+            with contextlib.suppress(self.rp.S3UploadError):
+                self.rp.multipart_upload_file(job_id, path, key, {})
+        expect(self.pending_uploads(key), "the failed upload is not open for resuming")
+        self.rp.abort_multipart_uploads(job_id)
+        expect(not self.pending_uploads(key), "the upload was not aborted")
+        expect(job_id not in self.rp.s3_multipart_uploads, "the aborted upload is still remembered")
+
+    def check_multipart_job_cleaned_up_mid_upload(self):
+        path, content, key = self.multipart_file()
+        job_id = self.new_job()
+        def clean_up_job(upload_part, **kwargs):
+            # As if the job had ended while its parts were uploading
+            with self.rp.s3_multipart_lock:
+                self.rp.s3_multipart_uploads.pop(job_id, None)
+            return upload_part(**kwargs)
+        with self.patched("upload_part", clean_up_job):
+            self.rp.multipart_upload_file(job_id, path, key, {})
+        expect(self.get(key) == content, "the object does not match the file")
+        expect(job_id not in self.rp.s3_multipart_uploads, "the job's uploads were re-created")
+
+    def check_multipart_mismatch_deletes_object(self):
+        path, _, key = self.multipart_file()
+        def wrong_etag(complete_multipart_upload, **kwargs):
+            return {**complete_multipart_upload(**kwargs), "ETag": '"00000000000000000000000000000000-3"'}
+        with self.patched("complete_multipart_upload", wrong_etag):
+            try:
+                self.rp.multipart_upload_file(self.new_job(), path, key, {})
+                raise CheckFailed("the mismatch did not raise")
+            except self.rp.S3UploadError:
+                pass
+        expect(key not in self.keys(), "the bad object was kept")
+
+    def run(self) -> int:
+        failures = 0
+        for name in [name for name in Checks.__dict__ if name.startswith("check_")]:
+            try:
+                # The handler is chatty
+                with contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+                    getattr(self, name)()
+                print(f"ok    {name}")
+            except Exception as e:
+                failures += 1
+                print(f"FAIL  {name} -- {e.__class__.__name__}: {e}")
+                if not isinstance(e, CheckFailed):
+                    traceback.print_exc()
+        return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint-url", default="", help="an S3-compatible server to check against, instead of starting moto's")
+    parser.add_argument("--access-key", default="testing")
+    parser.add_argument("--secret-key", default="testing")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--bucket", default=f"rp-handler-check-{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--verbose", action="store_true", help="show the handler's output")
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url:
+        from moto.server import ThreadedMotoServer
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+        server.start()
+        endpoint_url = f"http://127.0.0.1:{port}"
+
+    workdir = tempfile.mkdtemp(prefix="rp-handler-s3-check-")
+    try:
+        os.environ.update({
+            "DOCKER_IMAGE_TYPE": "comfyui",
+            "AWS_REGION": args.region,
+            "AWS_ACCESS_KEY_ID": args.access_key,
+            "AWS_SECRET_ACCESS_KEY": args.secret_key,
+            "AWS_S3_BUCKET": args.bucket,
+            "AWS_S3_ENDPOINT_URL": endpoint_url,
+            "COMFY_S3_DEDUPLICATE": "true",
+            "COMFY_S3_DEDUPLICATE_INDEX": os.path.join(workdir, "s3-dedup-index.jsonl"),
+            "COMFY_S3_MULTIPART_RETRIES": "0",
+            "COMFY_MODEL_CACHE_DIR": "",
+        })
+        sys.path.insert(0, REPO_DIR)
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+            import rp_handler
+            rp_handler.get_s3_client().create_bucket(Bucket=args.bucket, **({"CreateBucketConfiguration": {"LocationConstraint": args.region}} if args.region != "us-east-1" else {}))
+        failures = Checks(rp_handler, workdir, args.verbose).run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if server is not None:
+            server.stop()
+    print(f"{failures} check(s) failed" if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Stand-ins for the ComfyUI, Deforum and A1111 HTTP APIs, implementing just the endpoints that rp_handler.py uses, so that the handler can be benchmarked without a GPU.
+
+Jobs "run" for a configurable time, one at a time like the real backends, and produce a configurable number of output files of about a configurable size (PNGs of random noise, so that they do not compress).
+
+    python3 benchmark/fake_backends.py --service comfyui --port 8188 --workdir /tmp/bench --latency-ms 500 --outputs 4 --output-bytes 1000000
+
+The port actually listened on is printed on the first line of stdout (useful with --port 0).
+
+The ComfyUI stand-in also serves the /ws event stream (execution_start, executing, progress, executed, execution_success), delivered to the client whose `client_id` queued the prompt, as ComfyUI does, so that COMFY_USE_WEBSOCKET and COMFY_LOG_DEMUX can be exercised too.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+import struct
+import urllib.parse
+import uuid
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def noise_png(size: int) -> bytes:
+    """
+    A valid RGB PNG of random noise, of about `size` bytes.
+    """
+    side = max(1, int((size / 3) ** 0.5))
+    rows = b"".join(b"\x00" + os.urandom(side * 3) for _ in range(side)) # filter type 0 for every row
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(rows, 0)) + chunk(b"IEND", b"")
+
+
+class Backend:
+    """
+    The state shared by all the requests: the job queue, and what each job has produced so far.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.output_dir = os.path.join(args.workdir, "output")
+        self.input_dir = os.path.join(args.workdir, "input")
+        self.log_file = os.path.join(args.workdir, "comfyui.log")
+        os.makedirs(self.output_dir, exist_ok=True)
+        os.makedirs(self.input_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.jobs = {} # job ID -> ComfyUI history entry, or Deforum job status
+        self.cancelled = set()
+        self.ws_clients = {} # client_id -> queue of the /ws messages to send it
+        self.prompt_clients = {} # prompt ID -> client_id
+        self.queue = queue.Queue()
+        self.running = None # the job ID being executed
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def log(self, message: str) -> None:
+        with open(self.log_file, "a") as f:
+            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}] {message}\n")
+
+    def send_event(self, job_id: str, event_type: str, **data) -> None:
+        """
+        Send a /ws event about a prompt to the client that queued it, if it is connected.
+        """
+        with self.lock:
+            client = self.ws_clients.get(self.prompt_clients.get(job_id))
+        if client is not None:
+            client.put({"type": event_type, "data": {"prompt_id": job_id, **data}})
+
+    def output_file(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(noise_png(self.args.output_bytes))
+
+    def run(self):
+        """
+        Execute the queued jobs one after another, like the real backends.
+        """
+        while True:
+            job_id, execute = self.queue.get()
+            if job_id in self.cancelled:
+                continue
+            start = time.time()
+            with self.lock:
+                self.running = job_id
+            execute(job_id)
+            with self.lock:
+                self.running = None
+            if self.args.service == "comfyui":
+                self.log(f"Prompt executed in {time.time() - start:.2f} seconds")
+
+    def execute_comfyui(self, job_id: str) -> None:
+        self.send_event(job_id, "execution_start", timestamp=int(time.time() * 1000))
+        self.send_event(job_id, "executing", node="3")
+        self.log("Requested to load FakeModel")
+        steps = 4
+        for step in range(1, steps + 1):
+            time.sleep(self.args.latency_ms / 1000 / steps)
+            self.send_event(job_id, "progress", node="3", value=step, max=steps)
+        images = []
+        for i in range(self.args.outputs):
+            filename = f"bench_{job_id[:8]}_{i:05d}_.png"
+            self.output_file(os.path.join(self.output_dir, filename))
+            images.append({"filename": filename, "subfolder": "", "type": "output"})
+        self.send_event(job_id, "executed", node="9", output={"images": images})
+        self.send_event(job_id, "execution_success", timestamp=int(time.time() * 1000))
+        self.send_event(job_id, "executing", node=None)
+        with self.lock:
+            self.jobs[job_id] = {
+                "outputs": {"9": {"images": images}},
+                "status": {"status_str": "error" if job_id in self.cancelled else "success", "completed": True},
+            }
+
+    def execute_deforum(self, job_id: str) -> None:
+        status = self.jobs[job_id]
+        status.update({"status": "RUNNING", "phase": "GENERATING", "phase_progress": 0.0})
+        stub = os.path.join(status["outdir"], status["timestring"])
+        for i in range(self.args.outputs):
+            if job_id in self.cancelled:
+                status.update({"status": "CANCELLED"})
+                return
+            time.sleep(self.args.latency_ms / 1000 / max(self.args.outputs, 1))
+            self.output_file(f"{stub}_{i:09d}.png")
+            status["phase_progress"] = (i + 1) / self.args.outputs
+        status.update({"status": "SUCCEEDED", "phase": "DONE", "phase_progress": 1.0})
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately; without this, Nagle's algorithm and delayed ACKs add ~40 ms to every response
+    disable_nagle_algorithm = True
+    backend = None # set in main()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            # requests streams generator bodies (e.g. the image uploads) chunked
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def serve_websocket(self):
+        """
+        The /ws event stream: the handshake of RFC 6455, then a text frame for every event, until the client goes away. What the client sends is never read, as ComfyUI's clients only listen.
+        """
+        client_id = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get("clientId", [uuid.uuid4().hex])[0]
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode("ascii")).digest()).decode("ascii")
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        messages = queue.Queue()
+        messages.put({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id}})
+        with self.backend.lock:
+            self.backend.ws_clients[client_id] = messages
+        try:
+            while True:
+                payload = json.dumps(messages.get()).encode("utf-8")
+                if len(payload) < 126:
+                    header = struct.pack(">BB", 0x81, len(payload))
+                elif len(payload) < 2**16:
+                    header = struct.pack(">BBH", 0x81, 126, len(payload))
+                else:
+                    header = struct.pack(">BBQ", 0x81, 127, len(payload))
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self.backend.lock:
+                if self.backend.ws_clients.get(client_id) is messages:
+                    del self.backend.ws_clients[client_id]
+
+    def do_GET(self):
+        backend = self.backend
+        path = self.path.split("?")[0]
+        if backend.args.service == "comfyui" and path == "/ws" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self.serve_websocket()
+        elif backend.args.service == "comfyui" and path.startswith("/history/"):
+            job_id = path[len("/history/"):]
+            with backend.lock:
+                entry = backend.jobs.get(job_id)
+            self.send_json({job_id: entry} if entry else {})
+        elif backend.args.service == "deforum" and path.startswith("/deforum_api/jobs/"):
+            job_id = path[len("/deforum_api/jobs/"):]
+            with backend.lock:
+                status = dict(backend.jobs.get(job_id) or {})
+            self.send_json(status if status else {"detail": "not found"}, 200 if status else 404)
+        elif backend.args.service == "comfyui" and path == "/queue":
+            with backend.lock:
+                running = backend.running
+            self.send_json({"queue_running": [[0, running, {}, {}, []]] if running else [], "queue_pending": []})
+        elif path == "/system_stats":
+            # The health checks
+            self.send_json({"system": {"comfyui_version": "fake", "python_version": "", "argv": []}, "devices": []})
+        elif path == "/deforum_api/jobs":
+            with backend.lock:
+                self.send_json({job_id: dict(status) for job_id, status in backend.jobs.items()})
+        elif path == "/":
+            # check_server()
+            self.send_json({})
+        else:
+            self.send_json({"detail": "not found"}, 404)
+
+    def do_POST(self):
+        backend = self.backend
+        args = backend.args
+        path = self.path.split("?")[0]
+        body = self.read_body()
+        if args.service == "comfyui" and path == "/prompt":
+            job_id = uuid.uuid4().hex
+            client_id = json.loads(body or b"{}").get("client_id")
+            if client_id:
+                with backend.lock:
+                    backend.prompt_clients[job_id] = client_id
+            backend.log("got prompt")
+            backend.queue.put((job_id, backend.execute_comfyui))
+            self.send_json({"prompt_id": job_id, "number": 0, "node_errors": {}})
+        elif args.service == "comfyui" and path == "/upload/image":
+            boundary = re.search(r"boundary=([^;]+)", self.headers["Content-Type"]).group(1).encode("ascii")
+            name = "upload"
+            for part in body.split(b"--" + boundary):
+                headers, _, content = part.partition(b"\r\n\r\n")
+                match = re.search(rb'name="image"; filename="([^"]*)"', headers)
+                if match:
+                    name = os.path.basename(match.group(1).decode("utf-8"))
+                    with open(os.path.join(backend.input_dir, name), "wb") as f:
+                        f.write(content[:-2]) # the part's trailing CRLF
+            self.send_json({"name": name, "subfolder": "", "type": "input"})
+        elif args.service == "comfyui" and path == "/queue":
+            for job_id in json.loads(body or b"{}").get("delete", []):
+                with backend.lock:
+                    # Only a pending prompt can be deleted
+                    if job_id != backend.running:
+                        backend.cancelled.add(job_id)
+            self.send_json({})
+        elif args.service == "comfyui" and path == "/interrupt":
+            # Like the ComfyUI that the handler is written against, whatever is running is interrupted, whatever the prompt ID
+            with backend.lock:
+                if backend.running:
+                    backend.cancelled.add(backend.running)
+            self.send_json({})
+        elif args.service == "deforum" and path == "/deforum_api/batches":
+            job_id = f"batch({uuid.uuid4().int % 10**9})-0"
+            timestring = datetime.now().strftime("%Y%m%d%H%M%S") + uuid.uuid4().hex[:6]
+            outdir = os.path.join(backend.output_dir, f"Deforum_{timestring}")
+            os.makedirs(outdir, exist_ok=True)
+            with backend.lock:
+                backend.jobs[job_id] = {"id": job_id, "status": "ACCEPTED", "phase": "QUEUED", "phase_progress": 0.0, "outdir": outdir, "timestring": timestring}
+            backend.queue.put((job_id, backend.execute_deforum))
+            self.send_json({"message": "Job(s) accepted", "batch_id": job_id.split("-")[0], "job_ids": [job_id]}, 202)
+        elif args.service == "a1111" and path == "/sdapi/v1/txt2img":
+            # Synchronous: the response only comes once the images have been "generated"
+            done = threading.Event()
+            result = {}
+            def execute(job_id):
+                time.sleep(args.latency_ms / 1000)
+                result["images"] = [base64.b64encode(noise_png(args.output_bytes)).decode("ascii") for _ in range(args.outputs)]
+                done.set()
+            backend.queue.put((uuid.uuid4().hex, execute))
+            done.wait()
+            self.send_json({"images": result["images"], "parameters": {}, "info": "{}"})
+        elif path == "/sdapi/v1/interrupt":
+            self.send_json({})
+        else:
+            self.send_json({"detail": "not found"}, 404)
+
+    def do_DELETE(self):
+        backend = self.backend
+        path = self.path.split("?")[0]
+        if backend.args.service == "deforum" and path.startswith("/deforum_api/jobs/"):
+            backend.cancelled.add(path[len("/deforum_api/jobs/"):])
+            self.send_json({"id": path[len("/deforum_api/jobs/"):], "message": "Job cancelled."})
+        else:
+            self.send_json({"detail": "not found"}, 404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", choices=["comfyui", "deforum", "a1111"], required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--workdir", required=True, help="output/ and input/ are created here, and the ComfyUI log is written to comfyui.log")
+    parser.add_argument("--latency-ms", type=int, default=500, help="how long each job takes")
+    parser.add_argument("--outputs", type=int, default=1, help="output files per job (Deforum: frames)")
+    parser.add_argument("--output-bytes", type=int, default=1_000_000, help="size of each output file")
+    args = parser.parse_args()
+
+    Handler.backend = Backend(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
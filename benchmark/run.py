@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Benchmark the handler's own overhead, end to end, against the stand-in backends in fake_backends.py.
+
+Runs `--jobs` jobs through rp_handler.handler(), `--concurrency` at a time, and reports:
+
+- the latency of each phase of a job (server check, fetching and uploading the input images, queueing, waiting for the backend, gathering the outputs), as mean / p50 / p95 / max,
+- the throughput, in jobs per second,
+- the peak RSS of the handler process (the fake backend runs in a separate process).
+
+Every run is appended to a JSONL results file, and compared with the previous run of the same scenario (the same service, job shape and handler settings); a phase that got slower by more than `--threshold` is reported as a regression.
+
+    python3 benchmark/run.py --service comfyui --jobs 50 --concurrency 4 --latency-ms 200 --outputs 4 --output-bytes 2000000
+    python3 benchmark/run.py --service deforum --env COMFY_OUTPUT_WATCHER=poll --env COMFY_POLLING_ADAPTIVE=true
+    python3 benchmark/run.py --service comfyui --env COMFY_USE_WEBSOCKET=true
+
+Handler settings are passed as environment variables with --env. RunPod progress updates are not sent (there is no RunPod API to send them to).
+"""
+import argparse
+import base64
+import contextlib
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# rp_handler function (or method) -> the phase that it is timed as
+PHASES = {
+    "check_server": "check_server",
+    "BackendHealthMonitor.wait_ready": "check_server",
+    "fetch_images": "fetch_images",
+    "upload_images": "upload_images",
+    "queue_workflow": "queue",
+    "process_output_images": "outputs",
+}
+# Phases where lower is better, compared against the previous run
+TRACKED = ["total", "check_server", "fetch_images", "upload_images", "queue", "wait", "outputs"]
+
+
+def start_backend(args, workdir: str):
+    """
+    Start the fake backend in its own process, and return it with the port that it listens on.
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARK_DIR, "fake_backends.py"), "--service", args.service, "--workdir", workdir,
+         "--latency-ms", str(args.latency_ms), "--outputs", str(args.outputs), "--output-bytes", str(args.output_bytes)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    port = int(process.stdout.readline())
+    return process, port
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "mean_ms": round(statistics.mean(values) * 1000, 2),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+def instrument(rp_handler, timings: threading.local) -> None:
+    """
+    Time the handler's phases by wrapping the module functions that implement them. Each job runs in one thread, so the timings are collected per thread.
+    """
+    for function_name, phase in PHASES.items():
+        *owner_names, function_name = function_name.split(".")
+        owner = getattr(rp_handler, owner_names[0]) if owner_names else rp_handler
+        original = getattr(owner, function_name)
+        def timed(*args, __original=original, __phase=phase, **kwargs):
+            start = time.perf_counter()
+            try:
+                return __original(*args, **kwargs)
+            finally:
+                timings.phases[__phase] = timings.phases.get(__phase, 0.0) + time.perf_counter() - start
+        setattr(owner, function_name, timed)
+
+
+def make_job(args, i: int) -> dict:
+    job_input = {"workflow": {}, "metadata": {"user": "benchmark"}}
+    if args.service == "comfyui":
+        # A different seed every time, so that the result cache (if enabled) does not short-circuit the job
+        job_input["workflow"] = {"3": {"class_type": "KSampler", "inputs": {"seed": i}}, "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}}}
+    elif args.service == "deforum":
+        job_input["workflow"] = {"seed": i, "max_frames": args.outputs}
+    elif args.service == "a1111":
+        job_input["workflow"] = {"prompt": "benchmark", "seed": i, "batch_size": args.outputs}
+    if args.input_images:
+        image = base64.b64encode(os.urandom(args.input_bytes)).decode("ascii")
+        job_input["images"] = [{"name": f"bench_input_{n}.png", "image": image} for n in range(args.input_images)]
+    return {"id": f"bench-{i}", "input": job_input}
+
+
+def run_job(rp_handler, job: dict, timings: threading.local) -> dict:
+    timings.phases = {}
+    start = time.perf_counter()
+    first_output = None
+    result = None
+    for output in rp_handler.handler(job):
+        if first_output is None:
+            first_output = time.perf_counter() - start
+        result = output
+    total = time.perf_counter() - start
+    phases = dict(timings.phases)
+    phases["wait"] = max(0.0, total - sum(phases.values()))
+    phases["total"] = total
+    phases["first_output"] = first_output or total
+    return {"phases": phases, "ok": isinstance(result, dict) and "error" not in result}
+
+
+def scenario_key(args) -> dict:
+    return {
+        "service": args.service,
+        "concurrency": args.concurrency,
+        "latency_ms": args.latency_ms,
+        "outputs": args.outputs,
+        "output_bytes": args.output_bytes,
+        "input_images": args.input_images,
+        "input_bytes": args.input_bytes,
+        "env": sorted(args.env),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_run(results_file: str, scenario: dict):
+    """
+    Returns:
+        dict: The most recent run of the same scenario in the results file, or None
+    """
+    previous = None
+    try:
+        with open(results_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("scenario") == scenario:
+                    previous = record
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def compare(record: dict, previous: dict, threshold: float, min_delta_ms: float) -> list:
+    """
+    Returns:
+        list: Descriptions of the regressions, i.e. the tracked metrics that got worse by more than `threshold` (and, for latencies, by more than `min_delta_ms`)
+    """
+    regressions = []
+    for phase in TRACKED:
+        now = record["phases"].get(phase, {}).get("p50_ms")
+        before = previous["phases"].get(phase, {}).get("p50_ms")
+        if now is not None and before is not None and now - before > max(before * threshold, min_delta_ms):
+            regressions.append(f"{phase} p50 {before} ms -> {now} ms (+{(now / before - 1) * 100 if before else float('inf'):.0f}%)")
+    if record["throughput_jobs_per_s"] < previous["throughput_jobs_per_s"] * (1 - threshold):
+        regressions.append(f"throughput {previous['throughput_jobs_per_s']} -> {record['throughput_jobs_per_s']} jobs/s")
+    if record["peak_rss_mib"] > previous["peak_rss_mib"] * (1 + threshold):
+        regressions.append(f"peak RSS {previous['peak_rss_mib']} -> {record['peak_rss_mib']} MiB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", choices=["comfyui", "deforum", "a1111"], default="comfyui")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="jobs run at the same time (cf. COMFY_JOB_CONCURRENCY)")
+    parser.add_argument("--latency-ms", type=int, default=200, help="how long the fake backend takes per job")
+    parser.add_argument("--outputs", type=int, default=1, help="output files per job")
+    parser.add_argument("--output-bytes", type=int, default=1_000_000)
+    parser.add_argument("--input-images", type=int, default=0, help="base64 input images per job")
+    parser.add_argument("--input-bytes", type=int, default=100_000)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="handler setting, may be repeated")
+    parser.add_argument("--results", default=os.path.join(BENCHMARK_DIR, "results.jsonl"), help="JSONL file that the runs are appended to")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="smaller slowdowns are noise, not regressions")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    parser.add_argument("--label", default="", help="free-form note stored with the run")
+    parser.add_argument("--verbose", action="store_true", help="show the handler's output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rp-handler-bench-")
+    backend, port = start_backend(args, workdir)
+    try:
+        os.environ.update({
+            "DOCKER_IMAGE_TYPE": args.service,
+            "COMFY_HOST": f"127.0.0.1:{port}",
+            "WEBUI_HOST": f"127.0.0.1:{port}",
+            "COMFY_OUTPUT_PATH": os.path.join(workdir, "output"),
+            "COMFY_INPUT_PATH": os.path.join(workdir, "input"),
+            "COMFY_MODEL_CACHE_DIR": "",
+        })
+        for setting in args.env:
+            name, _, value = setting.partition("=")
+            os.environ[name] = value
+
+        sys.path.insert(0, REPO_DIR)
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with quiet:
+            import rp_handler
+            rp_handler.COMFYUI_LOG_FILE = os.path.join(workdir, "comfyui.log")
+            rp_handler.runpod.serverless.progress_update = lambda job, progress: None
+            timings = threading.local()
+            instrument(rp_handler, timings)
+            # One job to warm up the connections, not measured
+            run_job(rp_handler, make_job(args, -1), timings)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                runs = list(executor.map(lambda i: run_job(rp_handler, make_job(args, i), timings), range(args.jobs)))
+            wall = time.perf_counter() - start
+    finally:
+        backend.terminate()
+        backend.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    phases = sorted({phase for run in runs for phase in run["phases"]}, key=lambda phase: (TRACKED + ["first_output"]).index(phase))
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "label": args.label,
+        "scenario": scenario_key(args),
+        "jobs": args.jobs,
+        "failed_jobs": sum(not run["ok"] for run in runs),
+        "wall_s": round(wall, 3),
+        "throughput_jobs_per_s": round(args.jobs / wall, 3),
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # KiB on Linux
+        "phases": {phase: summarize([run["phases"].get(phase, 0.0) for run in runs]) for phase in phases},
+    }
+
+    print(f"{args.service}: {args.jobs} jobs ({record['failed_jobs']} failed), concurrency {args.concurrency}, revision {record['revision']}")
+    print(f"{'phase':<16}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+    for phase, stats in record["phases"].items():
+        print(f"{phase:<16}{stats['mean_ms']:>12}{stats['p50_ms']:>12}{stats['p95_ms']:>12}{stats['max_ms']:>12}")
+    print(f"throughput {record['throughput_jobs_per_s']} jobs/s, peak RSS {record['peak_rss_mib']} MiB")
+
+    previous = previous_run(args.results, record["scenario"])
+    regressions = compare(record, previous, args.threshold, args.min_delta_ms) if previous else []
+    if previous:
+        print(f"compared with {previous['revision']} ({previous['time']}): " + ("; ".join(regressions) if regressions else "no regressions"))
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+The image encoding that rp_handler.py runs in process pools (see WorkerPool there), so that it does not compete with the handler for the GIL.
+
+Importing this module must have no side effects, and it must not import rp_handler: it is imported in every worker process.
+"""
+import base64
+import io
+import os
+import warnings
+try:
+    from PIL import Image, features # Pillow; only needed for COMFY_PREVIEWS and COMFY_OUTPUT_FORMAT
+except ImportError:
+    Image = features = None
+
+
+def pillow_supports(feature: str) -> bool:
+    """
+    Whether Pillow is installed, and supports e.g. the "avif" format.
+    """
+    if features is None:
+        return False
+    with warnings.catch_warnings():
+        # A Pillow older than the feature warns that it does not know of it
+        warnings.simplefilter("ignore")
+        return features.check(feature)
+
+
+def make_preview(img_path: str, max_size: int, image_format: str, quality: int) -> str:
+    """
+    Downscale an image to fit within `max_size` x `max_size`, and return it as a data: URL.
+
+    Args:
+        image_format (str): "webp" or "jpeg"
+
+    Returns:
+        str: The preview encoded as data: URL
+    """
+    with Image.open(img_path) as image:
+        image.draft("RGB", (max_size, max_size)) # JPEG only: decode at a fraction of the size straight away
+        image.thumbnail((max_size, max_size))
+        if image_format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format.upper(), quality=quality)
+    return f"data:image/{image_format};base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def transcode_image(img_path: str, output_path: str, image_format: str, quality: int) -> str:
+    """
+    Re-encode an image in another format.
+
+    Args:
+        image_format (str): "webp", "avif" or "jpeg"
+        quality (int): 1-100; 100 is lossless for WebP
+
+    Returns:
+        str: `output_path`
+    """
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with Image.open(img_path) as image:
+        if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        options = {"lossless": True} if image_format == "webp" and quality >= 100 else {"quality": quality}
+        image.save(tmp_path, format=image_format.upper(), **options)
+    os.replace(tmp_path, output_path)
+    return output_path
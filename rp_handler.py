@@ -3,20 +3,41 @@ import uuid
 import runpod
 from runpod.serverless.utils import rp_upload
 import json
-import urllib.request
-import urllib.parse
+import asyncio
 import time
 import os
 import requests
+import urllib3
 import base64
-from io import BytesIO
+import urllib.parse
 import glob
+import mmap
+import ctypes
+import ctypes.util
+import struct
+import select
+import hashlib
+import ipaddress
+import socket
 import traceback
+import shutil
 import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_for_futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
-from tempfile import NamedTemporaryFile
 import re
 import tqdm
+from collections import OrderedDict, deque
+try:
+    import websocket # websocket-client; only needed when COMFY_USE_WEBSOCKET is enabled
+except ImportError:
+    websocket = None
+from image_workers import Image, pillow_supports, make_preview, transcode_image
 
 
 class InternalServerError(Exception):
@@ -25,11 +46,37 @@ class InternalServerError(Exception):
 class JobCancelledException(Exception):
     pass
 
+CANCEL_DIR = "/workspace/tasks/cancel/ids"
+COMFYUI_LOG_FILE = "/workspace/ComfyUI/comfyui.log"
+
+def take_cancel_request(cancel_path: str):
+    """
+    If there is a cancellation signal file, delete it.
+
+    :param cancel_path: The path of the cancellation signal file.
+    :return: The timestamp of when cancellation was requested, or None if there is no signal file.
+    """
+    try:
+        # Get the timestamp of when cancellation was requested
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(cancel_path)))
+    except OSError:
+        return None
+
+    # Remove the cancellation file to clean up
+    try:
+        os.remove(cancel_path)
+    except:
+        print(f"Warning: Failed to remove cancellation file: {cancel_path}")
+        pass
+    return timestamp
+
 def raise_for_cancel(runpod_job_id: str):
     """
     Checks if a job has been cancelled, deletes the cancellation signal file,
     and raises JobCancelledException if the job is cancelled.
 
+    If the job is registered with the CancellationWatcher, this is only an in-memory lookup.
+
     :param job_id: The ID of the job being checked.
     :raises JobCancelledException: If the job was cancelled by the user.
     """
@@ -37,24 +84,17 @@ def raise_for_cancel(runpod_job_id: str):
         print(f"Warning: Runpod Job ID is missing.")
         return
 
-    CANCEL_DIR = "/workspace/tasks/cancel/ids"
-    try:
-        cancel_path = os.path.join(CANCEL_DIR, fs_safe(runpod_job_id, raise_=True))
-    except UnsafeInputError:
-        print(f"Warning: Runpod Job ID is filesystem-unsafe: {runpod_job_id}")
-        return
-
-    if os.path.exists(cancel_path):
-        # Get the timestamp of when cancellation was requested
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(cancel_path)))
-
-        # Remove the cancellation file to clean up
+    if cancellation_watcher is not None and cancellation_watcher.is_registered(runpod_job_id):
+        timestamp = cancellation_watcher.cancelled_at(runpod_job_id)
+    else:
         try:
-            os.remove(cancel_path)
-        except:
-            print(f"Warning: Failed to remove cancellation file: {cancel_path}")
-            pass
+            cancel_path = os.path.join(CANCEL_DIR, fs_safe(runpod_job_id, raise_=True))
+        except UnsafeInputError:
+            print(f"Warning: Runpod Job ID is filesystem-unsafe: {runpod_job_id}")
+            return
+        timestamp = take_cancel_request(cancel_path)
 
+    if timestamp:
         # Raise the exception with a simple message
         message = f"Cancelling job '{runpod_job_id}' as requested at {timestamp}."
         print(message)
@@ -119,11 +159,107 @@ class JobTimestamp:
             raise ValueError(f"Job {job_id} not found in database")
         return timestamp
 
+class LogTailer:
+    """
+    Follows a growing log file by byte offset, so that every poll only reads the bytes appended since the previous poll.
+
+    Rotation (the path now refers to a different inode) and truncation (the file shrank below our offset) are detected on every poll, in which case we start reading the new file from the beginning.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self.partial = b"" # trailing bytes of an unterminated line; progress bars live here
+
+    @staticmethod
+    def _split_lines(data: bytes):
+        """
+        Split `data` into complete lines (with the terminating newline) and the unterminated remainder.
+        """
+        *lines, rest = data.split(b"\n")
+        return [line + b"\n" for line in lines], rest
+
+    @staticmethod
+    def _decode(lines):
+        return [line.decode("utf-8", errors="replace") for line in lines]
+
+    def seek_to_last(self, is_anchor) -> list:
+        """
+        Find the last line for which `is_anchor(line)` is true, by reading the file backwards in chunks, and position the tailer at the end of the file.
+
+        Returns:
+            list: The lines from the anchor (inclusive) to the end of the file, or [] if there is no anchor.
+        """
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.inode = st.st_ino
+            self.offset = st.st_size
+            self.partial = b""
+
+            pos = st.st_size
+            pending = b"" # bytes read but not yet split, i.e. the (possibly incomplete) first line of what we have read so far
+            tail = [] # complete lines after the region being scanned
+            at_eof = True
+            while pos > 0:
+                step = min(self.CHUNK_SIZE, pos)
+                pos -= step
+                f.seek(pos)
+                pending = f.read(step) + pending
+                if pos > 0:
+                    cut = pending.find(b"\n")
+                    if cut == -1:
+                        continue
+                    region, pending = pending[cut + 1:], pending[:cut + 1]
+                else:
+                    region, pending = pending, b""
+                lines, rest = self._split_lines(region)
+                if at_eof:
+                    self.partial = rest
+                    at_eof = False
+                lines = self._decode(lines)
+                for i in range(len(lines) - 1, -1, -1):
+                    if is_anchor(lines[i]):
+                        return lines[i:] + tail
+                tail = lines + tail
+            return []
+
+    def read_new(self) -> list:
+        """
+        Read the lines appended since the last call.
+
+        Returns:
+            list: The new complete lines; an unterminated last line is kept back in `self.partial`.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return [] # Probably mid-rotation
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            if self.inode is not None:
+                print(f"{worker_name} - Log file {self.path} was rotated or truncated, reading it from the start")
+            self.inode = st.st_ino
+            self.offset = 0
+            self.partial = b""
+        if st.st_size == self.offset:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        lines, self.partial = self._split_lines(self.partial + data)
+        return self._decode(lines)
+
 class LastLog(str):
     """
     A string subclass that captures the last log messages from the ComfyUI or Deform server logs.
 
     To avoid races (printing other jobs' logs), instantiate this class *just before* a job is started, and only call it while the job is ongoing. We will probably need to call this class one last time just after the job finishes, and if there are back-to-back jobs, we may print the next job's logs. We would need to refactor the logging of the upstream services to avoid this, which we won't, or restart the service after every job, which we also don't want to do. So we'll just have to live with the possibility of printing the next job's logs, for now.
+
+    ComfyUI is the exception: where we have its event stream, the log is split by prompt (see ComfyLogDemux, and `demux()`), and we get exactly our prompt's lines.
+
+    The log files are tailed incrementally (see LogTailer): the first call looks backwards from the end of the file for the last anchor line, and subsequent calls only read what has been appended since.
     """
     def __new__(cls, service_type, *args, **kwargs):
         instance = super().__new__(cls, *args, **kwargs)
@@ -131,12 +267,27 @@ class LastLog(str):
         now = datetime.now()
         instance.ignore_before = now
         instance.sent_data = ""
+        instance.tailer = None
+        instance.lines = [] # lines from the last anchor onwards
+        instance.good_log = False # whether the last anchor seen is ours
+        instance.prompt_events = None # set by demux()
+        instance.demuxed_lines = 0 # how many of prompt_events.log_lines are in `text`
+        instance.text = ""
+        instance.sent_partial = ""
         return instance
+
+    def demux(self, prompt_events):
+        """
+        Take the log from the lines that ComfyLogDemux attributes to the prompt, rather than from the last "got prompt" onwards.
+        """
+        self.prompt_events = prompt_events
     
     def __str__(self):
         return self.get_log()
     
     def get_log(self, last_only=True):
+        if self.prompt_events is not None:
+            return self.demuxed_log(last_only)
         if self.service_type == "comfyui":
             s = self.comfyui_log()
         elif self.service_type == "deforum":
@@ -157,6 +308,55 @@ class LastLog(str):
         self.sent_data += to_send
         return to_send
 
+    def demuxed_log(self, last_only):
+        """
+        Like get_log(), but only the lines added to the prompt since the previous call are looked at.
+        """
+        comfy_log_demux.poll()
+        lines = self.prompt_events.log_lines
+        end = len(lines)
+        self.text += "".join(lines[self.demuxed_lines:end])
+        self.demuxed_lines = end
+        partial = comfy_log_demux.partial(self.prompt_events)
+        if not last_only:
+            return self.text + partial
+        # A progress bar that we have sent while it was still unterminated has either grown, or been completed
+        to_send = self.text[len(self.sent_data):] + partial
+        if to_send.startswith(self.sent_partial):
+            to_send = to_send[len(self.sent_partial):]
+        self.sent_data = self.text
+        self.sent_partial = partial
+        return to_send
+
+    def follow(self, log_file, anchor):
+        """
+        Return the log from the last anchor line onwards, reading only what has been appended to `log_file` since the previous call.
+
+        Args:
+            log_file (str): The path to the log file
+            anchor (callable): Returns None if the line is not an anchor, else whether the log following the anchor belongs to us
+        """
+        if self.tailer is None:
+            tailer = LogTailer(log_file)
+            try:
+                new_lines = tailer.seek_to_last(lambda line: anchor(line) is not None)
+            except FileNotFoundError:
+                # Not created yet -- try again next time
+                return ""
+            self.tailer = tailer
+        else:
+            new_lines = self.tailer.read_new()
+        for line in new_lines:
+            is_ours = anchor(line)
+            if is_ours is not None:
+                self.good_log = is_ours
+                self.lines = [line] if is_ours else []
+            elif self.good_log:
+                self.lines.append(line)
+        if not self.good_log:
+            return ""
+        return "".join(self.lines) + self.tailer.partial.decode("utf-8", errors="replace")
+
     def a1111_log(self):
         """
         WARNING:root:Sampler Scheduler autocorrection: "Euler" -> "Euler", "default" -> "Automatic"
@@ -165,20 +365,11 @@ class LastLog(str):
         Total progress: 100%|██████████| 50/50 [00:04<00:00, 11.21it/s]
         """
         LOG_FILE = "/var/log/supervisor/webui.log"
-        with open(LOG_FILE, "r") as f:
-            lines = f.readlines()
+        def anchor(line):
             # Find the last occurence of /INFO:sd_dynamic_prompts.dynamic_prompting:Prompt matrix will create/
-            lines.reverse()
-            printable_lines = []
-            good_log = False
-            for line in lines:
-                printable_lines.append(line)
-                if "INFO:sd_dynamic_prompts.dynamic_prompting:Prompt matrix will create" in line:
-                    good_log = True
-                    # Ignore the /Euler/ line, that's fine, those errors are not always there, and we don't have a good way to figure out which errors are ours
-                    break
-            printable_lines.reverse()
-            return "".join(printable_lines) if good_log else ""
+            # Ignore the /Euler/ line, that's fine, those errors are not always there, and we don't have a good way to figure out which errors are ours
+            return True if "INFO:sd_dynamic_prompts.dynamic_prompting:Prompt matrix will create" in line else None
+        return self.follow(LOG_FILE, anchor)
         
     def deforum_log(self):
         """
@@ -187,19 +378,10 @@ class LastLog(str):
         ^MVideo stitching ESC[0;32mdoneESC[0m in 1.07 seconds!
         """
         LOG_FILE = "/var/log/supervisor/webui.log"
-        with open(LOG_FILE, "r") as f:
-            lines = f.readlines()
+        def anchor(line):
             # Find the last occurence of /deforum_api:Starting batch/
-            lines.reverse()
-            printable_lines = []
-            good_log = False
-            for line in lines:
-                printable_lines.append(line)
-                if "deforum_api:Starting batch" in line:
-                    good_log = True
-                    break
-            printable_lines.reverse()
-            return "".join(printable_lines) if good_log else ""
+            return True if "deforum_api:Starting batch" in line else None
+        return self.follow(LOG_FILE, anchor)
 
     def comfyui_log(self):
         """
@@ -208,30 +390,19 @@ class LastLog(str):
         [2024-12-28 16:36:45.533] got prompt
         [2024-12-28 16:36:45.595] Prompt executed in 0.05 seconds
         """
-        LOG_FILE = "/workspace/ComfyUI/comfyui.log"
-        with open(LOG_FILE, "r") as f:
-            lines = f.readlines()
+        LOG_FILE = COMFYUI_LOG_FILE
+        def anchor(line):
             # Find the last occurence of /] got prompt$/
-            lines.reverse()
-            printable_lines = []
-            start_datetime = None
-            for line in lines:
-                printable_lines.append(line)
-                # I believe this will reliably match even in cases where multiple processes write into the same file
-                if line.strip().endswith("] got prompt"):
-                    timestamp = line.split("]")[0].split("[")[1].strip()
-                    try:
-                        start_datetime = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-                    except:
-                        start_datetime = None
-                    break
-            printable_lines.reverse()
-            if start_datetime is None:
-                return ""
-            elif start_datetime < self.ignore_before:
-                return ""
-            else:
-                return "".join(printable_lines)
+            # I believe this will reliably match even in cases where multiple processes write into the same file
+            if not line.strip().endswith("] got prompt"):
+                return None
+            timestamp = line.split("]")[0].split("[")[1].strip()
+            try:
+                start_datetime = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+            except:
+                return False
+            return start_datetime >= self.ignore_before
+        return self.follow(LOG_FILE, anchor)
 
 def get_bool_env(var_name, default=False):
     """
@@ -282,28 +453,332 @@ SERVER_API_AVAILABLE_MAX_RETRIES = int(os.environ.get("COMFY_API_AVAILABLE_MAX_R
 SERVER_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 1000))
 # Maximum number of poll attempts
 SERVER_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 86400)) # 24 hours -- handle timeouts using the worker timeout instead
+# Watch for job cancellations in a background thread (see CancellationWatcher), instead of checking for the cancellation file on every poll
+CANCEL_WATCHER = get_bool_env("COMFY_CANCEL_WATCHER", True)
+# Time between listings of the cancellation directory, while jobs are running, in milliseconds
+CANCEL_WATCH_INTERVAL_MS = int(os.environ.get("COMFY_CANCEL_WATCH_INTERVAL_MS", 1000))
+# Check the backend's health in the background (see BackendHealthMonitor), instead of at the start of every job
+HEALTH_MONITOR = get_bool_env("COMFY_HEALTH_MONITOR", True)
+HEALTH_INTERVAL_MS = int(os.environ.get("COMFY_HEALTH_INTERVAL_MS", 2000))
+# Failed checks in a row before the backend is taken to be down (and whatever it was running, lost), so that one dropped connection is not a restart
+HEALTH_FAILURES = max(1, int(os.environ.get("COMFY_HEALTH_FAILURES", 3)))
+# How long the backend has to stay up before it is trusted; A1111 (and so Deforum) tends to crash shortly after it starts answering
+HEALTH_SETTLE_MS = int(os.environ.get("COMFY_HEALTH_SETTLE_MS", 5000 if SERVICE_TYPE in ["a1111", "deforum"] else 0))
+# Cache the model files that the workflows use on local disk (see ModelCache); only supported for ComfyUI
+MODEL_CACHE_DIR = os.environ.get("COMFY_MODEL_CACHE_DIR", "")
+MODEL_CACHE_MAX_BYTES = int(os.environ.get("COMFY_MODEL_CACHE_MAX_BYTES", 50 * 2**30))
+MODEL_CACHE_SOURCE = os.environ.get("COMFY_MODEL_CACHE_SOURCE", "/workspace/ComfyUI/models")
+MODEL_CACHE_USAGE_FILE = os.environ.get("COMFY_MODEL_CACHE_USAGE", "/workspace/.model-cache-usage.jsonl")
+# Keep in sync with start.sh
+MODEL_CACHE_FOLDERS = ("checkpoints", "loras", "vae", "unet", "diffusion_models", "clip", "text_encoders", "clip_vision", "controlnet", "upscale_models", "embeddings")
+# Number of model files preloaded into the page cache at once during the warm-up (see init_server())
+WARMUP_PRELOAD_CONCURRENCY = max(1, int(os.environ.get("COMFY_WARMUP_PRELOAD_CONCURRENCY", 4)))
+# Start accepting jobs as soon as the critical model files have been preloaded, rather than once the warm-up has finished
+WARMUP_ACCEPT_EARLY = get_bool_env("COMFY_WARMUP_ACCEPT_EARLY", False)
+# Number of jobs this worker accepts at once (see concurrent_handler()); A1111 only ever runs one job at a time
+JOB_CONCURRENCY = max(1, int(os.environ.get("COMFY_JOB_CONCURRENCY", 1))) if SERVICE_TYPE != "a1111" else 1
+# Adapt the time between polls to the progress of the job, between COMFY_POLLING_MIN_INTERVAL_MS and COMFY_POLLING_MAX_INTERVAL_MS (see PollScheduler), instead of always waiting COMFY_POLLING_INTERVAL_MS
+POLLING_ADAPTIVE = get_bool_env("COMFY_POLLING_ADAPTIVE", False)
+POLLING_MIN_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_MIN_INTERVAL_MS", 100))
+POLLING_MAX_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_MAX_INTERVAL_MS", 5000))
+# Subscribe to ComfyUI's /ws event stream, instead of only polling /history (which remains the fallback)
+COMFY_USE_WEBSOCKET = get_bool_env("COMFY_USE_WEBSOCKET", False)
+# Split the ComfyUI log by prompt, using the /ws execution events (see ComfyLogDemux), instead of by "got prompt" timestamps
+COMFY_LOG_DEMUX = get_bool_env("COMFY_LOG_DEMUX", COMFY_USE_WEBSOCKET)
 # Host where the server is running
 SERVER_HOST = {
     "comfyui": os.environ.get("COMFY_HOST", "127.0.0.1:8188"),
     "deforum": os.environ.get("WEBUI_HOST", "127.0.0.1:17860"),
     "a1111": os.environ.get("WEBUI_HOST", "127.0.0.1:17860"),
 }[SERVICE_TYPE]
+# All HTTP calls to the backend share one pool of keep-alive connections
+# Maximum number of pooled connections per host
+HTTP_POOL_MAXSIZE = int(os.environ.get("COMFY_HTTP_POOL_MAXSIZE", 16))
+# Time to wait for a connection to be established, in milliseconds
+HTTP_CONNECT_TIMEOUT_MS = int(os.environ.get("COMFY_HTTP_CONNECT_TIMEOUT_MS", 5000))
+# Time to wait for a response, in milliseconds (synchronous A1111 generation is exempt)
+HTTP_READ_TIMEOUT_MS = int(os.environ.get("COMFY_HTTP_READ_TIMEOUT_MS", 60000))
+# Maximum number of input images decoded and uploaded to the backend concurrently
+UPLOAD_IMAGES_CONCURRENCY = int(os.environ.get("COMFY_UPLOAD_IMAGES_CONCURRENCY", 8))
+# Input images given by URL (see InputURLCache): the allowed URL schemes, the maximum size of an image, and the local cache
+INPUT_URL_SCHEMES = [scheme.strip() for scheme in os.environ.get("COMFY_INPUT_URL_SCHEMES", "https").split(",") if scheme.strip() in ("http", "https")]
+INPUT_URL_MAX_BYTES = int(os.environ.get("COMFY_INPUT_URL_MAX_BYTES", 100 * 2**20))
+INPUT_URL_CACHE_DIR = os.environ.get("COMFY_INPUT_URL_CACHE_DIR", "/tmp/input-url-cache")
+INPUT_URL_CACHE_MAX_BYTES = int(os.environ.get("COMFY_INPUT_URL_CACHE_MAX_BYTES", 2**30))
+# Do not upload the input images that are already in ComfyUI's input directory (see StagedInputs)
+INPUT_DEDUPLICATE = get_bool_env("COMFY_INPUT_DEDUPLICATE", False)
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/workspace/ComfyUI/input")
+# Maximum number of output files uploaded to S3 concurrently
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("COMFY_S3_UPLOAD_CONCURRENCY", 8))
+# Outputs at least this large (bytes) are uploaded to S3 in parts, in parallel (see multipart_upload_file())
+S3_MULTIPART_THRESHOLD = int(os.environ.get("COMFY_S3_MULTIPART_THRESHOLD", 16 * 2**20))
+S3_MULTIPART_PART_SIZE = int(os.environ.get("COMFY_S3_MULTIPART_PART_SIZE", 16 * 2**20))
+# Parts uploaded at once, across all the uploads
+S3_MULTIPART_CONCURRENCY = int(os.environ.get("COMFY_S3_MULTIPART_CONCURRENCY", 8))
+S3_MULTIPART_RETRIES = int(os.environ.get("COMFY_S3_MULTIPART_RETRIES", 3))
+# Outputs larger than this (bytes) are not inlined as data: URLs, but uploaded to S3 if configured, or else returned as a file:// reference; 0 means no limit
+DATA_URL_MAX_BYTES = int(os.environ.get("COMFY_DATA_URL_MAX_BYTES", 0))
+# How OutputStreamer finds new Deforum frames: "inotify" (falls back to "poll" where unavailable), "poll" (list the output directory), or "glob" (re-process all the files on every poll)
+OUTPUT_WATCHER = os.environ.get("COMFY_OUTPUT_WATCHER", "inotify").lower().strip()
+# Stream a small preview of each Deforum frame as soon as it lands, ahead of the full-resolution frame (see image_workers.make_preview()); a job can override this with `metadata.previews`
+PREVIEWS = get_bool_env("COMFY_PREVIEWS", False)
+PREVIEW_MAX_SIZE = int(os.environ.get("COMFY_PREVIEW_MAX_SIZE", 256))
+PREVIEW_FORMAT = os.environ.get("COMFY_PREVIEW_FORMAT", "webp").lower().strip()
+PREVIEW_FORMAT = "jpeg" if PREVIEW_FORMAT == "jpg" else PREVIEW_FORMAT
+# init_server() warns about a PREVIEW_FORMAT that is not among these
+PREVIEW_FORMATS = ("webp", "jpeg")
+PREVIEW_QUALITY = int(os.environ.get("COMFY_PREVIEW_QUALITY", 70))
+PREVIEW_PROCESSES = max(1, int(os.environ.get("COMFY_PREVIEW_PROCESSES", 2)))
+# How long a poll waits for the previews of the new frames, before it moves on to the full-resolution frames
+PREVIEW_WAIT_MS = int(os.environ.get("COMFY_PREVIEW_WAIT_MS", 500))
+# Transcode the PNG outputs to this format (see image_workers.transcode_image()): "webp", "avif" or "jpeg" ("jpg"); empty or "png" to return them as they are. A job can override this with `metadata.output_format`
+OUTPUT_FORMAT = os.environ.get("COMFY_OUTPUT_FORMAT", "").lower().strip()
+OUTPUT_FORMAT = "jpeg" if OUTPUT_FORMAT == "jpg" else OUTPUT_FORMAT
+# AVIF needs a Pillow with AVIF support (11.2+, built with libavif); init_server() warns about an OUTPUT_FORMAT that is not among these
+OUTPUT_FORMATS = ("png", "webp", "jpeg") + (("avif",) if pillow_supports("avif") else ())
+# 100 is lossless for WebP; a job can override this with `metadata.output_quality`
+OUTPUT_QUALITY = int(os.environ.get("COMFY_OUTPUT_QUALITY", 90))
+OUTPUT_TRANSCODE_PROCESSES = max(1, int(os.environ.get("COMFY_OUTPUT_TRANSCODE_PROCESSES", 2)))
+OUTPUT_TRANSCODE_DIR = os.environ.get("COMFY_OUTPUT_TRANSCODE_DIR", "/tmp/transcoded-outputs")
+# Number of the most recent Deforum status snapshots kept in memory per job; they are written to /tmp/{job_id}_status.json only if the job fails
+STATUS_JOURNAL_SIZE = int(os.environ.get("COMFY_STATUS_JOURNAL_SIZE", 100))
+# If set, every status snapshot is also appended to {COMFY_STATUS_JOURNAL_DIR}/{job_id}_status.jsonl
+STATUS_JOURNAL_DIR = os.environ.get("COMFY_STATUS_JOURNAL_DIR", "")
+# Before uploading an output to S3, look up its content hash, and reuse the existing object if the same bytes have been uploaded before
+S3_DEDUPLICATE = get_bool_env("COMFY_S3_DEDUPLICATE", False)
+# The content hash -> S3 key index; on the network volume, so that it is shared by all the workers
+S3_DEDUPLICATE_INDEX = os.environ.get("COMFY_S3_DEDUPLICATE_INDEX", "/workspace/.s3-dedup-index.jsonl")
+# Return the result of a previous identical job (see ResultCache), instead of running the workflow again
+RESULT_CACHE = get_bool_env("COMFY_RESULT_CACHE", False)
+RESULT_CACHE_TTL_S = int(os.environ.get("COMFY_RESULT_CACHE_TTL_S", 86400))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("COMFY_RESULT_CACHE_MAX_ENTRIES", 1000))
+# On the network volume, so that it is shared by all the workers
+RESULT_CACHE_INDEX = os.environ.get("COMFY_RESULT_CACHE_INDEX", "/workspace/.result-cache.jsonl")
+# Attach the job's phase timings and counters (see JobMetrics) to every result; a job can also ask for them with `metadata.metrics`
+JOB_METRICS = get_bool_env("COMFY_JOB_METRICS", False)
+# The totals across all jobs, in the OpenMetrics text format, for a local scraper (see MetricsRegistry)
+METRICS_FILE = os.environ.get("COMFY_METRICS_FILE", "")
+METRICS_PORT = int(os.environ.get("COMFY_METRICS_PORT", 0))
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = get_bool_env("REFRESH_WORKER", False)
 
 SAVE_TO_S3 = get_bool_env("SAVE_TO_S3", False)
+# The credentials are also used without SAVE_TO_S3, for outputs too large to be inlined as data: URLs
+AWS_REGION = os.getenv("AWS_REGION")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
+# Overridable, e.g. to point at a local S3-compatible server
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL") or f"https://s3.{AWS_REGION}.amazonaws.com"
+S3_CONFIGURED = None not in (AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_BUCKET)
 if SAVE_TO_S3:
     print("SAVE_TO_S3 is enabled, loading AWS credentials...")
-    AWS_REGION = os.getenv("AWS_REGION")
-    AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-    AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-    AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
     assert AWS_REGION is not None, "AWS_REGION must be set"
     assert AWS_ACCESS_KEY_ID is not None, "AWS_ACCESS_KEY_ID must be set"
     assert AWS_SECRET_ACCESS_KEY is not None, "AWS_SECRET_ACCESS_KEY must be set"
     assert AWS_S3_BUCKET is not None, "AWS_S3_BUCKET must be set"
 
+def make_http_session() -> requests.Session:
+    """
+    Create the HTTP session shared by all backend calls, so that connections are kept alive and reused instead of being opened for every call.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http_session = make_http_session()
+
+def http_timeout(read_timeout_ms=HTTP_READ_TIMEOUT_MS) -> tuple:
+    """
+    The (connect, read) timeout tuple for the shared HTTP session, in seconds. Pass `read_timeout_ms=None` to wait for the response indefinitely.
+    """
+    return (HTTP_CONNECT_TIMEOUT_MS / 1000, read_timeout_ms / 1000 if read_timeout_ms is not None else None)
+
+current_job_metrics = contextvars.ContextVar("current_job_metrics", default=None)
+
+class JobMetrics:
+    """
+    Where a job's time goes: the time spent in each phase of handler(), and counters for the HTTP calls made and the bytes moved.
+
+    The counters are updated by whatever runs while the job's metrics are active (see active()), including in other threads, as long as the work was handed over with in_job_context(). A disabled JobMetrics does nothing, so that the instrumentation costs next to nothing when it is not wanted.
+
+    The phases are sequential, except for `s3_upload`, which is the total time of the S3 uploads, and these run concurrently, with each other and with the other phases.
+    """
+    def __init__(self, enabled: bool, attach: bool = False):
+        self.enabled = enabled
+        self.attach = attach # whether the metrics are returned with the job's result
+        self.started = time.perf_counter()
+        self.phases = {} # phase -> seconds
+        self.counters = {} # counter -> count
+        self.lock = threading.Lock()
+        self.status = None # set by finish()
+
+    @contextlib.contextmanager
+    def active(self, phase: str = None):
+        """
+        Attribute the counters to this job while in the block, and add the block's duration to `phase`, if given.
+        """
+        if not self.enabled:
+            yield
+            return
+        token = current_job_metrics.set(self)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current_job_metrics.reset(token)
+            if phase:
+                self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counter: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def finish(self, result) -> None:
+        """
+        Record the outcome of the job, and add it to the worker's totals.
+        """
+        if self.status is not None:
+            return
+        self.status = "cached" if result and result.get("cached") else "cancelled" if result and result.get("status") == "cancelled" else "success" if result and "error" not in result else "error"
+        self.add_time("total", time.perf_counter() - self.started)
+        if self.enabled and metrics_registry is not None:
+            metrics_registry.observe(self)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "phases_s": {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+def count_metric(counter: str, n: int = 1) -> None:
+    """
+    Add to a counter of the current job, if its metrics are being collected.
+    """
+    metrics = current_job_metrics.get()
+    if metrics is not None:
+        metrics.count(counter, n)
+
+@contextlib.contextmanager
+def timed_metric(phase: str):
+    """
+    Add the block's duration to a phase of the current job, if its metrics are being collected.
+    """
+    metrics = current_job_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(phase, time.perf_counter() - start)
+
+def in_job_context(function):
+    """
+    Wrap `function` so that it counts towards the current job's metrics, in whichever thread it runs.
+    """
+    metrics = current_job_metrics.get()
+    if metrics is None:
+        return function
+    def run(*args, **kwargs):
+        token = current_job_metrics.set(metrics)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_job_metrics.reset(token)
+    return run
+
+def count_http_response(response, *args, **kwargs):
+    """
+    Response hook for the shared HTTP session: counts the call, and the bytes sent and received where their size is known up front (streamed bodies are counted where they are produced).
+    """
+    metrics = current_job_metrics.get()
+    if metrics is None:
+        return
+    metrics.count("http_requests")
+    if isinstance(response.request.body, (bytes, str)):
+        metrics.count("http_request_bytes", len(response.request.body))
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        metrics.count("http_response_bytes", int(content_length))
+
+http_session.hooks["response"].append(count_http_response)
+
+class MetricsRegistry:
+    """
+    The totals of all the jobs' metrics (see JobMetrics), exposed in the OpenMetrics text format for a local scraper: written to a file after every job (COMFY_METRICS_FILE), and/or served over HTTP (COMFY_METRICS_PORT).
+    """
+    PREFIX = "rp_handler"
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {} # status -> count
+        self.phase_seconds = {} # phase -> [sum, count]
+        self.counters = {} # counter -> total
+
+    def observe(self, metrics: JobMetrics) -> None:
+        report = metrics.report()
+        with self.lock:
+            self.jobs[metrics.status] = self.jobs.get(metrics.status, 0) + 1
+            for phase, seconds in report["phases_s"].items():
+                totals = self.phase_seconds.setdefault(phase, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += 1
+            for counter, n in report["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+        if self.path:
+            try:
+                self.write(self.path)
+            except OSError as e:
+                print(f"{worker_name} - Warning - Could not write the metrics to {self.path} -- {e.__class__.__name__}: {e}")
+
+    def render(self) -> str:
+        lines = [f"# TYPE {self.PREFIX}_jobs counter", f"# HELP {self.PREFIX}_jobs Jobs handled, by outcome."]
+        with self.lock:
+            lines += [f'{self.PREFIX}_jobs_total{{status="{status}"}} {n}' for status, n in sorted(self.jobs.items())]
+            lines += [f"# TYPE {self.PREFIX}_phase_seconds summary", f"# UNIT {self.PREFIX}_phase_seconds seconds", f"# HELP {self.PREFIX}_phase_seconds Time spent in each phase of the jobs."]
+            for phase, (total, count) in sorted(self.phase_seconds.items()):
+                lines += [f'{self.PREFIX}_phase_seconds_sum{{phase="{phase}"}} {total:.6f}', f'{self.PREFIX}_phase_seconds_count{{phase="{phase}"}} {count}']
+            for counter, n in sorted(self.counters.items()):
+                lines += [f"# TYPE {self.PREFIX}_{counter} counter", f"{self.PREFIX}_{counter}_total {n}"]
+        return "\n".join(lines + ["# EOF", ""])
+
+    def write(self, path: str) -> None:
+        # Atomically, so that the scraper never reads a half-written file
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int) -> None:
+        registry = self
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # every scrape would end up in the worker's log otherwise
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+# Served from init_server() (COMFY_METRICS_PORT)
+metrics_registry = MetricsRegistry(METRICS_FILE) if METRICS_FILE or METRICS_PORT else None
+
 def construct_output_path_stub(deforum_status_json):
     """
     Construct the output path stub for the Deform job based on the status JSON.
@@ -351,12 +826,15 @@ def validate_input(job_input):
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict) and "name" in image and (("image" in image) != ("url" in image)) for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and either 'image' or 'url' keys",
             )
+        for image in images:
+            if "url" in image and (not isinstance(image["url"], str) or urllib.parse.urlsplit(image["url"]).scheme not in INPUT_URL_SCHEMES):
+                return None, f"'images[].url' must be one of {', '.join(INPUT_URL_SCHEMES)}: URL: {image['url']}"
 
     metadata = job_input.get("metadata", {})
     if not isinstance(metadata, dict):
@@ -364,6 +842,10 @@ def validate_input(job_input):
     if "user" in metadata:
         if not isinstance(metadata["user"], str):
             return None, "'metadata.user' must be a string"
+    if "output_format" in metadata and {"jpg": "jpeg"}.get(metadata["output_format"], metadata["output_format"]) not in OUTPUT_FORMATS:
+        return None, f"'metadata.output_format' must be one of {', '.join(OUTPUT_FORMATS)} (or jpg)"
+    if "output_quality" in metadata and (isinstance(metadata["output_quality"], bool) or not isinstance(metadata["output_quality"], int) or not 1 <= metadata["output_quality"] <= 100):
+        return None, "'metadata.output_quality' must be an integer from 1 to 100"
 
     # Return validated data and no error
     return {"workflow": workflow, "images": images, "metadata": metadata}, None
@@ -389,7 +871,7 @@ def check_server(url, retries=SERVER_API_AVAILABLE_MAX_RETRIES, delay=SERVER_API
 
     for i in range(retries):
         try:
-            response = requests.get(url)
+            response = http_session.get(url, timeout=http_timeout())
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
@@ -413,6 +895,130 @@ def check_server(url, retries=SERVER_API_AVAILABLE_MAX_RETRIES, delay=SERVER_API
     )
     return False
 
+class BackendHealthMonitor:
+    """
+    Checks the backend in a background thread, and keeps its state, so that a job only has to look at a flag, and only waits when the backend is actually down -- where check_server() costs every job a round-trip, and for A1111 and Deforum, a 5 s sleep.
+
+    The backend is ready once it has answered for HEALTH_SETTLE_MS in a row, which takes the place of check_server()'s crash workaround, but is only needed after the backend has (re)started. It is checked every HEALTH_INTERVAL_MS while it is up, and every COMFY_API_AVAILABLE_INTERVAL_MS while it is not.
+
+    A restart is detected either from the backend going away, i.e. failing HEALTH_FAILURES checks in a row, which are then made every COMFY_API_AVAILABLE_INTERVAL_MS, or from a change in its fingerprint (see fingerprint()), for restarts quicker than the check interval. `restarts` counts them, so that a job can tell whether the backend has lost it.
+    """
+    def __init__(self, url: str, interval_ms: int = HEALTH_INTERVAL_MS, retry_interval_ms: int = SERVER_API_AVAILABLE_INTERVAL_MS, settle_ms: int = HEALTH_SETTLE_MS, max_failures: int = HEALTH_FAILURES):
+        self.url = url
+        self.max_failures = max_failures
+        self.failures = 0 # failed checks in a row
+        self.interval = interval_ms / 1000
+        self.retry_interval = retry_interval_ms / 1000
+        self.settle = settle_ms / 1000
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.up_since = None # when the backend last came up, None while it is down
+        self.last_seen = None # when the backend last answered
+        self.restarts = 0
+        self.last_fingerprint = None
+        self.thread = threading.Thread(target=self.run, name="backend-health", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def fingerprint(response):
+        """
+        Something about the backend that changes when it restarts: the ComfyUI version and command line (/system_stats), or the Deforum jobs (/deforum_api/jobs), which are only kept in memory.
+        """
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if isinstance(data.get("system"), dict):
+            return json.dumps({key: data["system"].get(key) for key in ("comfyui_version", "python_version", "argv")}, sort_keys=True)
+        return frozenset(data) # job ID -> status
+
+    def restarted(self, fingerprint) -> bool:
+        if self.last_fingerprint is None or fingerprint is None:
+            return False
+        if isinstance(fingerprint, frozenset):
+            # Deforum may forget old jobs, but not all of the jobs that it knew about
+            return bool(self.last_fingerprint) and not (self.last_fingerprint & fingerprint)
+        return fingerprint != self.last_fingerprint
+
+    def check(self) -> bool:
+        """
+        Returns:
+            bool: Whether the backend is ready
+        """
+        try:
+            response = http_session.get(self.url, timeout=http_timeout())
+        except requests.Timeout:
+            # Busy rather than gone, e.g. loading a model; leave the state as it is
+            return self.ready.is_set()
+        except requests.RequestException:
+            response = None
+        now = time.time()
+        with self.lock:
+            if response is None or response.status_code != 200:
+                self.failures += 1
+                if self.up_since is not None and self.failures < self.max_failures:
+                    # Not down yet; check again soon
+                    return self.ready.is_set()
+                if self.up_since is not None:
+                    print(f"{worker_name} - The backend at {self.url} is down" + (f" -- HTTP {response.status_code}" if response is not None else ""))
+                    # Whatever it was running is lost
+                    self.restarts += 1
+                self.up_since = None
+                self.ready.clear()
+                return False
+            self.failures = 0
+            fingerprint = self.fingerprint(response)
+            if self.up_since is not None and self.restarted(fingerprint):
+                print(f"{worker_name} - The backend at {self.url} has restarted")
+                self.restarts += 1
+                self.up_since = None
+                self.ready.clear()
+            if self.up_since is None:
+                self.up_since = now
+            self.last_seen = now
+            self.last_fingerprint = fingerprint
+            if not self.ready.is_set() and now - self.up_since >= self.settle:
+                print(f"{worker_name} - The backend at {self.url} is ready")
+                self.ready.set()
+            return self.ready.is_set()
+
+    def run(self):
+        while True:
+            try:
+                ready = self.check()
+            except Exception as e:
+                print(f"{worker_name} - Warning - Backend health check failed -- {e.__class__.__name__}: {e}")
+                ready = False
+            time.sleep(self.interval if ready and not self.failures else self.retry_interval)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Returns:
+            bool: Whether the backend is ready, waiting for at most `timeout` seconds for it to be
+        """
+        if self.ready.is_set():
+            return True
+        print(f"{worker_name} - Waiting for the backend at {self.url}")
+        if self.ready.wait(timeout):
+            return True
+        print(f"{worker_name} - The backend at {self.url} was not ready after {timeout:.1f} seconds")
+        return False
+
+backend_health = None
+backend_health_lock = threading.Lock()
+def get_backend_health():
+    """
+    Return the worker's backend health monitor, starting it on first use, or None if COMFY_HEALTH_MONITOR (or the server check) is disabled.
+    """
+    global backend_health
+    if not HEALTH_MONITOR or get_bool_env("DEBUG_NO_CHECK_SERVER", False):
+        return None
+    with backend_health_lock:
+        if backend_health is None:
+            backend_health = BackendHealthMonitor(f"http://{SERVER_HOST}" + ("/deforum_api/jobs" if SERVICE_TYPE in ["deforum", "a1111"] else "/system_stats"))
+        return backend_health
 
 def guess_mime_type(file_name: str = None):
     """
@@ -425,6 +1031,7 @@ def guess_mime_type(file_name: str = None):
             "jpg":  "image/jpeg",
             "jpeg": "image/jpeg",
             "webp": "image/webp",
+            "avif": "image/avif",
             "gif":  "image/gif",
             "mp4":  "video/mp4",
             "webm": "video/webm",
@@ -435,13 +1042,428 @@ def guess_mime_type(file_name: str = None):
         mime_type = "application/octet-stream"
     return mime_type
 
+def iter_base64_decoded(image_data: str, chunk_size: int = 256 * 1024):
+    """
+    Decode base64 data chunk by chunk, so that at most one chunk of the decoded data is held in memory at a time.
+
+    Args:
+        image_data (str): The base64-encoded data
+        chunk_size (int): The (approximate) size of the decoded chunks, in bytes
+
+    Yields:
+        bytes: The decoded data, in order
+    """
+    if re.search(r"\s", image_data):
+        # Line-wrapped base64 -- chunk boundaries need to be aligned to 4 *significant* characters
+        image_data = "".join(image_data.split())
+    step = max(chunk_size // 3 * 4, 4)
+    for i in range(0, len(image_data), step):
+        yield base64.b64decode(image_data[i:i + step])
+
+def image_sha256(image_data: str) -> str:
+    """
+    Returns:
+        str: The SHA-256 of the decoded image, which unlike that of the base64 string does not depend on how it was line-wrapped
+    """
+    sha256 = hashlib.sha256()
+    for chunk in iter_base64_decoded(image_data):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def iter_file_chunks(path: str, chunk_size: int = 256 * 1024):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+def multipart_image_body(boundary: str, name: str, mime_type: str, chunks):
+    """
+    Stream the multipart/form-data body expected by ComfyUI's /upload/image endpoint, decoding (or reading) the image as we go.
+
+    Args:
+        chunks (iterable): The image, as iter_base64_decoded() or iter_file_chunks()
+    """
+    # Same escaping as HTML5 form submission
+    quoted_name = name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{quoted_name}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode("utf-8")
+    yield from chunks
+    yield (
+        f"\r\n--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="overwrite"\r\n\r\n'
+        f"true\r\n"
+        f"--{boundary}--\r\n"
+    ).encode("utf-8")
+
+class InputTooLargeError(Exception):
+    pass
+
+class InputURLForbiddenError(Exception):
+    pass
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%")[0]) # without the IPv6 scope
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+class PublicAddressConnectionMixin:
+    """
+    A urllib3 connection that only connects to public addresses, so that a client cannot make us request the backend, the metrics server, or the cloud metadata service by URL.
+
+    The host name is resolved here, and the connection is made to the address that was checked, so that the DNS answer cannot change in between. TLS still verifies the certificate against the host name.
+    """
+    def _new_conn(self):
+        addresses = [info[4][0] for info in socket.getaddrinfo(self._dns_host, self.port, type=socket.SOCK_STREAM)]
+        forbidden = [address for address in addresses if not is_public_address(address)]
+        if not addresses or forbidden:
+            raise InputURLForbiddenError(f"{self.host} resolves to a non-public address: {', '.join(forbidden) or 'none'}")
+        self._dns_host = addresses[0]
+        return super()._new_conn()
+
+class PublicHTTPConnection(PublicAddressConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class PublicHTTPSConnection(PublicAddressConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class PublicHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+class PublicHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+class PublicAddressAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": PublicHTTPConnectionPool, "https": PublicHTTPSConnectionPool}
+
+def make_input_url_session(public_only: bool = True) -> requests.Session:
+    """
+    Create the HTTP session that downloads the input images given by URL. It is separate from the backend's (see make_http_session()): it goes to the internet rather than to localhost, and its calls are not backend calls. Redirects are followed through the same checks.
+    """
+    session = requests.Session()
+    session.trust_env = False # a proxy would be the address that we check
+    adapter = (PublicAddressAdapter if public_only else requests.adapters.HTTPAdapter)(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class InputURLCache:
+    """
+    Input images given by URL (COMFY_INPUT_URL_SCHEMES, https: by default), downloaded to a local cache. Only public addresses are fetched from (see PublicAddressConnectionMixin).
+
+    A cached image is revalidated on every use, with a conditional GET (ETag / Last-Modified), so that an unchanged image is not downloaded again. Images larger than COMFY_INPUT_URL_MAX_BYTES are refused, before the download if the size is announced, or else as soon as it has been exceeded. The cache is bounded by COMFY_INPUT_URL_CACHE_MAX_BYTES, the least recently used images are evicted first.
+
+    The images are stored by content hash, with a metadata file per URL that points at the image, so that a new version of an image never overwrites one that another job is using. Both are put in place atomically, under the lock. An image handed out by fetch() is pinned, and is not evicted until it is released (see release()), i.e. until it has been uploaded to the backend.
+    """
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, directory: str, max_bytes: int, max_image_bytes: int, session: requests.Session = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.session = session or make_input_url_session()
+        self.lock = threading.Lock() # for the files, and the pins
+        self.pins = {} # image path -> number of jobs using it
+        os.makedirs(directory, exist_ok=True)
+
+    def meta_path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def image_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256 + ".bin")
+
+    def pin(self, path: str) -> None:
+        """
+        Must be called with the lock held.
+        """
+        self.pins[path] = self.pins.get(path, 0) + 1
+
+    def release(self, paths: list) -> None:
+        """
+        Let the images handed out by fetch() be evicted again.
+        """
+        with self.lock:
+            for path in paths:
+                self.pins[path] -= 1
+                if not self.pins[path]:
+                    del self.pins[path]
+
+    def cached(self, url: str):
+        """
+        Returns:
+            dict: The metadata of the cached image (`etag`, `last_modified`, `size`, `sha256`), which is pinned until it is released, or None
+        """
+        meta_path = self.meta_path(url)
+        with self.lock:
+            try:
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+                if meta["url"] != url:
+                    return None
+                if os.path.getsize(self.image_path(meta["sha256"])) == meta["size"]:
+                    self.pin(self.image_path(meta["sha256"]))
+                    return meta
+            except FileNotFoundError:
+                # The image has been evicted
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(meta_path)
+            except (OSError, ValueError, KeyError):
+                pass
+        return None
+
+    def check_size(self, size, url: str) -> None:
+        if size is not None and int(size) > self.max_image_bytes:
+            raise InputTooLargeError(f"{url} is larger than COMFY_INPUT_URL_MAX_BYTES ({size} > {self.max_image_bytes} bytes)")
+
+    def hit(self, url: str, meta: dict) -> dict:
+        path = self.image_path(meta["sha256"])
+        os.utime(path) # recently used
+        count_metric("input_fetch_cache_hits")
+        return {"path": path, "sha256": meta["sha256"], "size": meta["size"]}
+
+    def store(self, url: str, chunks, validators: dict) -> dict:
+        """
+        Write the downloaded image to the cache, enforcing the size limit as we go. The image is pinned, like a hit.
+        """
+        stub = os.path.join(self.directory, uuid.uuid4().hex)
+        tmp_image, tmp_meta = f"{stub}.bin.tmp", f"{stub}.json.tmp"
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_image, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    self.check_size(size, url)
+                    sha256.update(chunk)
+                    f.write(chunk)
+            meta = {"url": url, **validators, "size": size, "sha256": sha256.hexdigest()}
+            with open(tmp_meta, "w") as f:
+                json.dump(meta, f)
+            path = self.image_path(meta["sha256"])
+            with self.lock:
+                # If the same content is already there, it stays, it may be in use
+                if os.path.exists(path):
+                    os.utime(path)
+                else:
+                    os.replace(tmp_image, path)
+                os.replace(tmp_meta, self.meta_path(url))
+                self.pin(path)
+        finally:
+            for tmp in (tmp_image, tmp_meta):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp)
+        self.evict()
+        count_metric("input_fetch_bytes", size)
+        return {"path": path, "sha256": meta["sha256"], "size": size}
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used images that are not pinned, until the cache fits in `max_bytes`. Their metadata files are removed when they are next looked up.
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".bin"):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in self.pins:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+
+    def fetch(self, url: str) -> dict:
+        """
+        Returns:
+            dict: The local `path` of the image, the `sha256` of its content, and its `size`. The image is pinned in the cache until it is released.
+        """
+        if urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme: {url}")
+        meta = self.cached(url) # pinned, so that it is not evicted while we revalidate it
+        headers = {}
+        if meta is not None and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta is not None and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        hit = False
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=http_timeout()) as response:
+                if response.status_code == 304 and meta is not None:
+                    hit = True
+                    return self.hit(url, meta)
+                response.raise_for_status()
+                self.check_size(response.headers.get("Content-Length"), url)
+                validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                return self.store(url, response.iter_content(self.CHUNK_SIZE), validators)
+        finally:
+            if meta is not None and not hit:
+                self.release([self.image_path(meta["sha256"])])
+
+input_url_cache = None
+input_url_cache_lock = threading.Lock()
+def get_input_url_cache() -> InputURLCache:
+    global input_url_cache
+    with input_url_cache_lock:
+        if input_url_cache is None:
+            input_url_cache = InputURLCache(INPUT_URL_CACHE_DIR, INPUT_URL_CACHE_MAX_BYTES, INPUT_URL_MAX_BYTES)
+        return input_url_cache
+
+def fetch_images(images):
+    """
+    Download the input images given by URL, concurrently (COMFY_UPLOAD_IMAGES_CONCURRENCY at a time), so that they can be uploaded like the inline ones.
+
+    Returns:
+        dict: The status, and the `images`, where each image given by URL also has the local `path`, `sha256` and `size` of the download. The downloads are pinned in the cache (see InputURLCache.release()), and listed under `pinned`.
+    """
+    urls = list(dict.fromkeys(image["url"] for image in images or [] if "url" in image))
+    if not urls:
+        return {"status": "success", "images": images, "pinned": []}
+    print(f"{worker_name} - fetching {len(urls)} image(s) by URL")
+    cache = get_input_url_cache()
+    def fetch(url):
+        try:
+            return url, cache.fetch(url), None
+        except Exception as e:
+            return url, None, f"Error fetching {url}: {e.__class__.__name__}: {e}"
+    with ThreadPoolExecutor(max_workers=max(1, min(UPLOAD_IMAGES_CONCURRENCY, len(urls))), thread_name_prefix="fetch-images") as executor:
+        results = list(executor.map(in_job_context(fetch), urls))
+    errors = [error for _, _, error in results if error]
+    pinned = [download["path"] for _, download, _ in results if download]
+    if errors:
+        cache.release(pinned)
+        return {
+            "status": "error",
+            "message": "Some images failed to download",
+            "details": errors,
+        }
+    fetched = {url: download for url, download, _ in results}
+    return {"status": "success", "images": [{**image, **fetched[image["url"]]} if "url" in image else image for image in images], "pinned": pinned}
+
+class StagedInputs:
+    """
+    What we have uploaded to ComfyUI's input directory, so that an image that is already there is not decoded and uploaded again.
+
+    For every image that we upload, we note a fingerprint of its base64 data (which is cheaper than decoding it; for an image fetched by URL, the hash of its content), and the size and modification time of the file that ComfyUI wrote. The upload is skipped only if the file is still exactly as we left it; if it has been overwritten since (e.g. by another worker, the input directory is on the network volume), or we have no record of it, we compare its content with the decoded image, and only upload it if they differ.
+    """
+    def __init__(self, input_dir: str):
+        self.input_dir = input_dir
+        self.entries = {} # name -> (fingerprint, size, mtime_ns)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def canonical_base64(image_data: str) -> str:
+        return "".join(image_data.split()) if re.search(r"\s", image_data) else image_data
+
+    @classmethod
+    def fingerprint(cls, image_data: str) -> str:
+        return hashlib.sha256(cls.canonical_base64(image_data).encode("ascii", errors="replace")).hexdigest()
+
+    @classmethod
+    def decoded_size(cls, image_data: str) -> int:
+        data = cls.canonical_base64(image_data)
+        return len(data) * 3 // 4 - len(data[-2:]) + len(data[-2:].rstrip("="))
+
+    @classmethod
+    def describe(cls, image: dict) -> tuple:
+        """
+        Returns:
+            tuple: The image's fingerprint, its size, and a function that computes the SHA-256 of its content
+        """
+        if "path" in image: # fetched by URL, see fetch_images()
+            return image["sha256"], image["size"], lambda: image["sha256"]
+        return cls.fingerprint(image["image"]), cls.decoded_size(image["image"]), lambda: image_sha256(image["image"])
+
+    def is_staged(self, name: str, fingerprint: str, size: int, content_sha256) -> bool:
+        path = os.path.join(self.input_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        with self.lock:
+            if self.entries.get(name) == (fingerprint, st.st_size, st.st_mtime_ns):
+                return True
+        # Not staged by us, or changed since: compare the content, which still saves the upload
+        if st.st_size != size:
+            return False
+        try:
+            if file_sha256(path) != content_sha256():
+                return False
+            if os.stat(path).st_mtime_ns != st.st_mtime_ns: # changed while we were reading it
+                return False
+        except (OSError, ValueError):
+            return False
+        with self.lock:
+            self.entries[name] = (fingerprint, st.st_size, st.st_mtime_ns)
+        return True
+
+    def record(self, name: str, fingerprint: str) -> None:
+        try:
+            st = os.stat(os.path.join(self.input_dir, name))
+        except OSError:
+            return # ComfyUI is not on our filesystem
+        with self.lock:
+            self.entries[name] = (fingerprint, st.st_size, st.st_mtime_ns)
+
+staged_inputs = StagedInputs(COMFY_INPUT_PATH) if INPUT_DEDUPLICATE and SERVICE_TYPE == "comfyui" else None
+
+def upload_image(image):
+    """
+    Upload one base64 encoded image to the ComfyUI server using the /upload/image endpoint.
+
+    Args:
+        image (dict): A dictionary containing the 'name' of the image and the 'image' as a base64 encoded string, or the local 'path' of an image fetched by URL.
+
+    Returns:
+        tuple: (success, message)
+    """
+    name = image["name"].split("/")[-1]
+    if "\\" in name:
+        print(f"{worker_name} - Warning: image name contains a backslash, maybe a Windows path?: {name}")
+    mime_type = guess_mime_type(name)
+    boundary = uuid.uuid4().hex
+
+    fingerprint, size, content_sha256 = StagedInputs.describe(image) if staged_inputs is not None else (None, None, None)
+    if staged_inputs is not None and staged_inputs.is_staged(name, fingerprint, size, content_sha256):
+        count_metric("input_uploads_skipped")
+        return True, f"{name} is already in the input directory, not uploading it again"
+
+    try:
+        # POST request to upload the image; the body is streamed (chunked), so the decoded image is never held in memory in full
+        response = http_session.post(
+            f"http://{SERVER_HOST}/upload/image",
+            data=multipart_image_body(boundary, name, mime_type, iter_file_chunks(image["path"]) if "path" in image else iter_base64_decoded(image["image"])),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            timeout=http_timeout(),
+        )
+    except Exception as e:
+        return False, f"Error uploading {name}: {e.__class__.__name__}: {e}"
+    if response.status_code != 200:
+        return False, f"Error uploading {name}: {response.text}"
+    if staged_inputs is not None:
+        staged_inputs.record(name, fingerprint)
+    if current_job_metrics.get() is not None:
+        count_metric("input_upload_bytes", size if size is not None else image["size"] if "size" in image else StagedInputs.decoded_size(image["image"]))
+    return True, f"Successfully uploaded {name}"
+
 def upload_images(images):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
 
+    The images are decoded and uploaded concurrently, by at most COMFY_UPLOAD_IMAGES_CONCURRENCY threads.
+
     Args:
         images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
 
     Returns:
         list: A list of responses from the server for each image upload.
@@ -454,26 +1476,9 @@ def upload_images(images):
 
     print(f"{worker_name} - image(s) upload")
 
-    for image in images:
-        name = image["name"].split("/")[-1]
-        if "\\" in name:
-            print(f"{worker_name} - Warning: image name contains a backslash, maybe a Windows path?: {name}")
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
-        mime_type = guess_mime_type(name)
-
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), mime_type),
-            "overwrite": (None, "true"),
-        }
-
-        # POST request to upload the image
-        response = requests.post(f"http://{SERVER_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+    with ThreadPoolExecutor(max_workers=max(1, min(UPLOAD_IMAGES_CONCURRENCY, len(images))), thread_name_prefix="upload-images") as executor:
+        for success, message in executor.map(in_job_context(upload_image), images):
+            (responses if success else upload_errors).append(message)
 
     if upload_errors:
         print(f"{worker_name} - image(s) upload with errors")
@@ -496,34 +1501,59 @@ def cancel_job(job_id: str) -> None:
     Cancel a job with the given job ID.
 
     Args:
-        job_id (str): The ID of the job to cancel.
+        job_id (str): The ID of the job to cancel. (For A1111, which runs one synchronous job at a time, whatever is running is interrupted, and the ID is only used for logging.)
     Raiises:
         NotImplementedError: If the cancel job functionality is not implemented for the current service type.
     """
     if SERVICE_TYPE == "deforum":
-        api_url = f"http://{SERVER_HOST}/deforum_api/jobs/{job_id}"
-        req = urllib.request.Request(api_url, method="DELETE")
+        requests_to_send = [{"method": "DELETE", "url": f"http://{SERVER_HOST}/deforum_api/jobs/{job_id}"}]
     elif SERVICE_TYPE == "comfyui":
         # The server-side code we're coding against is here: https://github.com/comfyanonymous/ComfyUI/blob/1cd6cd608086a8ff8789b747b8d4f8b9273e576e/server.py#L662
-        api_url = f"http://{SERVER_HOST}/queue"
-        data = json.dumps({"delete": [job_id]}).encode("utf-8")
-        req = urllib.request.Request(api_url, data=data, headers={"Content-Type": "application/json"}, method="POST")
+        # Deleting from the queue only helps while the prompt is pending; if it is already running, it has to be interrupted (see below)
+        requests_to_send = [{"method": "POST", "url": f"http://{SERVER_HOST}/queue", "data": json.dumps({"delete": [job_id]}).encode("utf-8"), "headers": {"Content-Type": "application/json"}}]
+    elif SERVICE_TYPE == "a1111":
+        requests_to_send = [{"method": "POST", "url": f"http://{SERVER_HOST}/sdapi/v1/interrupt"}]
     else:
         raise NotImplementedError(f"Cancel job not implemented for service type: {SERVICE_TYPE}")
 
+    def send(request_kwargs):
+        try:
+            res = http_session.request(timeout=http_timeout(), **request_kwargs)
+            res.raise_for_status()
+            ret_data = res.json() if res.content else None
+            print(f"{worker_name} - Successfully cancelled {SERVICE_TYPE} job {job_id} ({request_kwargs['url']}): {ret_data}")
+        except requests.RequestException as e:
+            print(f"{worker_name} - Warning - Failed to cancel {SERVICE_TYPE} job {job_id} ({request_kwargs['url']}) -- {e.__class__.__name__}: {e}")
+
+    for request_kwargs in requests_to_send:
+        send(request_kwargs)
+    # That ComfyUI ignores the prompt ID on /interrupt, and interrupts whatever is running, which may be another job's prompt (with COMFY_JOB_CONCURRENCY, often one of ours), so only once ours is running (newer versions check the prompt ID themselves)
+    if SERVICE_TYPE == "comfyui" and comfy_prompt_running(job_id):
+        send({"method": "POST", "url": f"http://{SERVER_HOST}/interrupt", "data": json.dumps({"prompt_id": job_id}).encode("utf-8"), "headers": {"Content-Type": "application/json"}})
+
+def comfy_prompt_running(prompt_id: str) -> bool:
+    """
+    Whether ComfyUI is running the prompt right now: by its queue, or if that cannot be had, by the /ws events (see ComfyEventStream).
+    """
     try:
-        res = urllib.request.urlopen(req)
-        ret_data = json.loads(res.read())
-        print(f"{worker_name} - Successfully cancelled {SERVICE_TYPE} job {job_id}: {ret_data}")
-    except urllib.error.HTTPError as e:
-        print(f"{worker_name} - Warning - Failed to cancel {SERVICE_TYPE} job {job_id} -- {e.__class__.__name__}: {e}")
+        res = http_session.get(f"http://{SERVER_HOST}/queue", timeout=http_timeout())
+        res.raise_for_status()
+        # Each item is [number, prompt_id, prompt, extra_data, outputs_to_execute]
+        return any(len(item) > 1 and item[1] == prompt_id for item in res.json().get("queue_running", []))
+    except (requests.RequestException, ValueError, AttributeError, TypeError) as e:
+        print(f"{worker_name} - Warning - Could not get the ComfyUI queue -- {e.__class__.__name__}: {e}")
+    if comfy_event_stream is not None:
+        events = comfy_event_stream.get(prompt_id)
+        return events.started_at is not None and not events.finished.is_set()
+    return False
 
-def queue_workflow(workflow):
+def queue_workflow(workflow, client_id=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): ComfyUI delivers the prompt's /ws events to this client (comfyui only)
 
     Returns:
         dict: The JSON response from ComfyUI after processing the workflow
@@ -534,7 +1564,7 @@ def queue_workflow(workflow):
 
     if SERVICE_TYPE == "comfyui":
         # The top level element "prompt" is required by ComfyUI
-        data = json.dumps({"prompt": workflow}).encode("utf-8")
+        data = json.dumps({"prompt": workflow, **({"client_id": client_id} if client_id else {})}).encode("utf-8")
         api_url = f"http://{SERVER_HOST}/prompt"
     elif SERVICE_TYPE == "deforum":
         data = json.dumps(workflow).encode("utf-8")
@@ -544,13 +1574,19 @@ def queue_workflow(workflow):
         api_url = f"http://{SERVER_HOST}/sdapi/v1/txt2img"
     else:
         raise ValueError("Invalid SERVICE_TYPE")
-    req = urllib.request.Request(api_url, data=data)
-    req.add_header("Content-Type", "application/json")
-    try:
-        res = urllib.request.urlopen(req)
-        return lastlog, json.loads(res.read())
-    except urllib.error.HTTPError as e:
-        return None, {"error": str(e), "error_response": e.read().decode('utf-8'), "response": res.read() if 'res' in locals() else None, "workflow": workflow, "api_url": api_url}
+    res = http_session.post(
+        api_url,
+        data=data,
+        headers={"Content-Type": "application/json"},
+        # The sdapi API is synchronous, i.e. the response only arrives once the images have been generated
+        timeout=http_timeout(None if SERVICE_TYPE == "a1111" else HTTP_READ_TIMEOUT_MS),
+    )
+    if not res.ok:
+        return None, {"error": f"HTTP Error {res.status_code}: {res.reason}", "error_response": res.text, "response": None, "workflow": workflow, "api_url": api_url}
+    response = res.json()
+    if SERVICE_TYPE == "comfyui" and client_id and comfy_log_demux is not None:
+        lastlog.demux(comfy_event_stream.get(response["prompt_id"]))
+    return lastlog, response
 
 def get_a1111_job_status(job_id):
     """
@@ -562,8 +1598,9 @@ def get_deforum_job_status(job_id):
     """
     Get the status of a Deform job using its ID
     """
-    with urllib.request.urlopen(f"http://{SERVER_HOST}/deforum_api/jobs/{job_id}") as response:
-        return json.loads(response.read())
+    response = http_session.get(f"http://{SERVER_HOST}/deforum_api/jobs/{job_id}", timeout=http_timeout())
+    response.raise_for_status()
+    return response.json()
 
 def get_comfyui_history(job_id):
     """
@@ -575,25 +1612,280 @@ def get_comfyui_history(job_id):
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
-    with urllib.request.urlopen(f"http://{SERVER_HOST}/history/{job_id}") as response:
-        return json.loads(response.read())
+    response = http_session.get(f"http://{SERVER_HOST}/history/{job_id}", timeout=http_timeout())
+    response.raise_for_status()
+    return response.json()
+
+class ComfyPromptEvents:
+    """
+    What the ComfyUI /ws event stream has told us about one prompt so far.
+    """
+    def __init__(self):
+        self.finished = threading.Event() # set on success, error, or interruption
+        self.error = None # the `execution_error` / `execution_interrupted` payload, if any
+        self.node = None # the node currently executing
+        self.value = None # `progress` events: step `value` out of `max` of the current node
+        self.max = None
+        self.outputs = {} # node_id -> output, from `executed` events (cached nodes do not send these, so /history stays authoritative)
+        self.started_at = None # when the prompt started / finished executing (epoch seconds, by ComfyUI's clock where it tells us)
+        self.finished_at = None
+        self.log_lines = [] # the ComfyUI log lines written while the prompt was executing, see ComfyLogDemux
+        self.log_closed = False # whether the "Prompt executed in" line has been seen
+
+    def progress(self) -> dict:
+        return {"node": self.node, "value": self.value, "max": self.max} if self.max else {}
+
+class ComfyEventStream:
+    """
+    A background subscription to ComfyUI's /ws event stream.
+
+    Prompts queued with our `client_id` have their `executing`, `executed`, `progress` and `execution_error` events delivered to us as they happen, so that the handler can react to completion immediately instead of on the next /history poll. Events are recorded for every prompt we see (bounded), because a short prompt can finish before the handler has even received its prompt ID.
+
+    The connection is re-established if it drops. Each connection gets a new `epoch`: a job that has queued its prompt during one connection cannot trust the event stream after a reconnect (it may have missed events), and falls back to polling /history.
+    """
+    MAX_PROMPTS = 256
+
+    def __init__(self, host: str):
+        self.host = host
+        self.client_id = uuid.uuid4().hex
+        self.connected = threading.Event()
+        self.epoch = 0
+        self.prompts = OrderedDict() # prompt_id -> ComfyPromptEvents
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="comfy-ws", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        url = f"ws://{self.host}/ws?clientId={self.client_id}"
+        while True:
+            try:
+                ws = websocket.create_connection(url, timeout=SERVER_API_AVAILABLE_INTERVAL_MS / 1000)
+                ws.settimeout(None)
+                with self.lock:
+                    self.epoch += 1
+                self.connected.set()
+                print(f"{worker_name} - Subscribed to ComfyUI events at {url}")
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, str): # binary messages are previews, which we do not use
+                        self.on_message(json.loads(message))
+            except Exception as e:
+                if self.connected.is_set():
+                    print(f"{worker_name} - Warning - Lost ComfyUI event stream, falling back to polling /history -- {e.__class__.__name__}: {e}")
+                self.connected.clear()
+                time.sleep(SERVER_API_AVAILABLE_INTERVAL_MS / 1000)
+
+    def on_message(self, message: dict):
+        event_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return # e.g. `status` messages, which are about the queue as a whole
+        prompt = self.get(prompt_id)
+        timestamp = data["timestamp"] / 1000 if data.get("timestamp") else time.time()
+        if event_type == "execution_start":
+            prompt.started_at = timestamp
+        elif event_type == "executing":
+            prompt.node = data.get("node")
+            if prompt.node is None: # ComfyUI's way of saying that the prompt is done
+                prompt.finished_at = prompt.finished_at or timestamp
+                prompt.finished.set()
+        elif event_type == "progress":
+            prompt.node, prompt.value, prompt.max = data.get("node"), data.get("value"), data.get("max")
+        elif event_type == "executed":
+            prompt.outputs[data.get("node")] = data.get("output")
+        elif event_type in ("execution_error", "execution_interrupted"):
+            prompt.error = data
+            prompt.finished_at = prompt.finished_at or timestamp
+            prompt.finished.set()
+        elif event_type == "execution_success":
+            prompt.finished_at = prompt.finished_at or timestamp
+            prompt.finished.set()
+
+    def get(self, prompt_id: str) -> ComfyPromptEvents:
+        with self.lock:
+            if prompt_id not in self.prompts:
+                self.prompts[prompt_id] = ComfyPromptEvents()
+                while len(self.prompts) > self.MAX_PROMPTS:
+                    self.prompts.popitem(last=False)
+            return self.prompts[prompt_id]
+
+    def forget(self, prompt_id: str) -> None:
+        with self.lock:
+            self.prompts.pop(prompt_id, None)
+
+    def current_epoch(self):
+        """
+        Returns:
+            int: The epoch of the current connection, or None if we are not connected
+        """
+        with self.lock:
+            return self.epoch if self.connected.is_set() else None
+
+class ComfyLogDemux:
+    """
+    Splits the shared ComfyUI log into the lines of each prompt.
+
+    ComfyUI executes one prompt at a time, and the event stream tells us when each of our prompts started and finished executing. A timestamped log line belongs to the prompt that was executing at that time; an untimestamped line (traceback, progress bar) belongs wherever the line before it went. The "Prompt executed in" line, which ComfyUI writes just after announcing completion, goes to the prompt that has just finished. Everything else -- other clients' prompts, "got prompt" lines, which are written when a prompt is queued rather than when it runs -- is dropped.
 
+    The log and the event stream race each other: we may read a prompt's first lines before its `execution_start` event has reached us. A line that belongs to no prompt that we know of is therefore kept back, and handed out on a later poll once its prompt is known; it is only dropped after UNATTRIBUTED_TTL_S.
+
+    The log file is read once for all the jobs, incrementally (see LogTailer), and the lines are stored with the prompt's ComfyPromptEvents, so that each job's log only grows by its own new lines.
+    """
+    TIMESTAMP_RE = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+)\]")
+    UNATTRIBUTED_TTL_S = 30
+
+    def __init__(self, log_file: str, events: ComfyEventStream):
+        self.events = events
+        self.tailer = LogTailer(log_file)
+        try:
+            # Only lines written from now on, our prompts have not started yet
+            st = os.stat(log_file)
+            self.tailer.inode, self.tailer.offset = st.st_ino, st.st_size
+        except FileNotFoundError:
+            pass
+        self.lock = threading.Lock()
+        self.line_time = None # the time of the last timestamped line
+        self.owner = None # the prompt that the last line went to
+        self.unattributed = deque() # (time, lines): a timestamped line and the untimestamped lines after it, whose prompt we do not know yet
+        self.unattributed_lines = None # the lines of the last entry, if the last line went there
+
+    @classmethod
+    def line_timestamp(cls, line: str):
+        match = cls.TIMESTAMP_RE.match(line)
+        if not match:
+            return None
+        try:
+            return datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S.%f").timestamp()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def attribute(line_time: float, lines: list, started: list):
+        """
+        Hand a timestamped line, and the untimestamped lines after it, to the prompt that was executing at the time.
+
+        Returns:
+            ComfyPromptEvents: The prompt that the lines went to, or None
+        """
+        # The most recently started prompt (a handful at most, ComfyUI is serial)
+        prompt = next((p for p in reversed(started) if p.started_at <= line_time), None)
+        if prompt is None or prompt.log_closed:
+            return None
+        if prompt.finished_at is not None and line_time > prompt.finished_at and "Prompt executed in" not in lines[0]:
+            return None
+        if "Prompt executed in" in lines[0]:
+            prompt.log_closed = True
+        prompt.log_lines.extend(lines)
+        return prompt
+
+    def poll(self) -> None:
+        """
+        Read the lines appended to the log since the last poll, and hand them to the prompts that they belong to.
+        """
+        with self.lock:
+            new_lines = self.tailer.read_new()
+            if not new_lines and not self.unattributed:
+                return
+            with self.events.lock:
+                started = sorted((p for p in self.events.prompts.values() if p.started_at is not None), key=lambda p: p.started_at)
+            # The lines read before their prompt's `execution_start` came in; they precede the new lines
+            unattributed, self.unattributed = self.unattributed, deque()
+            for line_time, lines in unattributed:
+                prompt = self.attribute(line_time, lines, started)
+                if prompt is None:
+                    if time.time() - line_time < self.UNATTRIBUTED_TTL_S:
+                        self.unattributed.append((line_time, lines))
+                    elif lines is self.unattributed_lines:
+                        self.unattributed_lines = None
+                elif lines is self.unattributed_lines:
+                    self.owner, self.unattributed_lines = prompt, None
+            for line in new_lines:
+                line_time = self.line_timestamp(line)
+                if line_time is None:
+                    if self.owner is not None:
+                        self.owner.log_lines.append(line)
+                    elif self.unattributed_lines is not None:
+                        self.unattributed_lines.append(line)
+                    continue
+                self.line_time, self.owner, self.unattributed_lines = line_time, None, None
+                if line.rstrip().endswith("] got prompt"):
+                    continue
+                lines = [line]
+                self.owner = self.attribute(line_time, lines, started)
+                if self.owner is None:
+                    self.unattributed.append((line_time, lines))
+                    self.unattributed_lines = lines
+
+    def partial(self, prompt: ComfyPromptEvents) -> str:
+        """
+        Returns:
+            str: The unterminated last line of the log (typically a progress bar), if it belongs to `prompt`
+        """
+        with self.lock:
+            if self.owner is not prompt:
+                return ""
+            return self.tailer.partial.decode("utf-8", errors="replace")
 
-def image_to_data_url(img_path):
+comfy_event_stream = None
+comfy_log_demux = None
+comfy_event_stream_lock = threading.Lock()
+def get_comfy_event_stream():
+    """
+    Return the worker's ComfyUI event stream, starting it (and the log demultiplexer) on first use, or None if neither COMFY_USE_WEBSOCKET nor COMFY_LOG_DEMUX is enabled (or websocket-client is unavailable).
+    """
+    global comfy_event_stream, comfy_log_demux
+    if SERVICE_TYPE != "comfyui" or not (COMFY_USE_WEBSOCKET or COMFY_LOG_DEMUX):
+        return None
+    with comfy_event_stream_lock: # concurrent jobs all wait for the first connection
+        if comfy_event_stream is None:
+            if websocket is None:
+                print(f"{worker_name} - Warning - websocket-client is not installed; polling /history, and not demultiplexing the ComfyUI log")
+                return None
+            comfy_event_stream = ComfyEventStream(SERVER_HOST)
+            if COMFY_LOG_DEMUX:
+                comfy_log_demux = ComfyLogDemux(COMFYUI_LOG_FILE, comfy_event_stream)
+            # Give the first job a chance to use the stream
+            comfy_event_stream.connected.wait(SERVER_API_AVAILABLE_INTERVAL_MS / 1000)
+    return comfy_event_stream
+
+
+def image_to_data_url(img_path, chunk_size=3 * 256 * 1024):
     """
     Returns data: URL representation of an image
 
+    The file is memory-mapped and base64-encoded chunk by chunk, and the chunks are joined into the URL in one final allocation. We never hold the whole file, its whole encoding, and the URL in memory at the same time, which matters for video outputs.
+
     Args:
         img_path (str): The path to the image
+        chunk_size (int): Bytes encoded at a time; must be a multiple of 3, so that there is no padding between chunks
 
     Returns:
         str: The image encoded as data: URL
     """
+    assert chunk_size % 3 == 0, "chunk_size must be a multiple of 3"
+    mime_type = guess_mime_type(img_path)
+    parts = [f"data:{mime_type};base64,"]
     with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        mime_type = guess_mime_type(img_path)
-        url = f"data:{mime_type};base64,{encoded_string}"
-        return url
+        size = os.fstat(image_file.fileno()).st_size
+        if size: # empty files cannot be mapped
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                for offset in range(0, size, chunk_size):
+                    parts.append(base64.b64encode(mapped_file[offset:offset + chunk_size]).decode("ascii"))
+    return "".join(parts)
+
+def output_destination(local_image_path: str, save_to_s3: bool) -> str:
+    """
+    Decide how an output file is returned to the client.
+
+    Returns:
+        str: "s3" (pre-signed https: URL), "data" (inline data: URL), or "file" (file:// reference to the file on the network volume)
+    """
+    if save_to_s3:
+        return "s3"
+    if DATA_URL_MAX_BYTES and os.path.getsize(local_image_path) > DATA_URL_MAX_BYTES:
+        return "s3" if S3_CONFIGURED else "file"
+    return "data"
 
 def is_video(file_path: str) -> bool:
     """
@@ -608,6 +1900,154 @@ def is_video(file_path: str) -> bool:
     VIDEO_EXTENSIONS = [".mp4", ".webm"]
     return any(file_path.lower().endswith(ext) for ext in VIDEO_EXTENSIONS)
 
+class WorkerPool:
+    """
+    A process pool, started on first use, for the image encoding in image_workers.py.
+
+    The processes are spawned rather than forked: by the time the pool is first used, the handler is running threads (the health monitor, the metrics server, the preload, the executors), and a forked child could inherit a lock that one of them was holding. A spawned process imports this module again, as `__mp_main__`, so its top level must have no side effects (see init_server()).
+
+    A ProcessPoolExecutor whose process has died (e.g. killed for running out of memory) refuses any further work, so the pool is started again when that happens.
+    """
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    def submit(self, fn, *args):
+        executor = self.get_executor()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool as e:
+            print(f"{worker_name} - Warning - The {self.name} pool is broken, starting it again -- {e.__class__.__name__}: {e}")
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            return self.get_executor().submit(fn, *args)
+
+preview_pool = None
+preview_pool_lock = threading.Lock()
+def get_preview_pool():
+    """
+    Return the process pool that makes the previews (see image_workers.make_preview()), or None if Pillow is not installed. init_server() starts it early on, rather than in the middle of a job.
+    """
+    global preview_pool
+    if Image is None:
+        return None
+    with preview_pool_lock:
+        if preview_pool is None:
+            preview_pool = WorkerPool("preview", PREVIEW_PROCESSES)
+        return preview_pool
+
+transcode_pool = None
+transcode_pool_lock = threading.Lock()
+def get_transcode_pool():
+    """
+    Return the process pool that transcodes the outputs (see image_workers.transcode_image()), or None if Pillow is not installed.
+    """
+    global transcode_pool
+    if Image is None:
+        return None
+    with transcode_pool_lock:
+        if transcode_pool is None:
+            transcode_pool = WorkerPool("transcode", OUTPUT_TRANSCODE_PROCESSES)
+        return transcode_pool
+
+def output_transcode(metadata: dict):
+    """
+    Returns:
+        tuple: The (format, quality) that the job's PNG outputs are to be transcoded to, or None
+    """
+    image_format = (metadata or {}).get("output_format", OUTPUT_FORMAT) or "png"
+    image_format = "jpeg" if image_format == "jpg" else image_format
+    if image_format == "png" or image_format not in OUTPUT_FORMATS:
+        return None
+    return image_format, (metadata or {}).get("output_quality", OUTPUT_QUALITY)
+
+def output_name(path: str, transcode) -> str:
+    """
+    The name that an output file is returned under: its own, or with the extension of the format it is transcoded to.
+    """
+    name = os.path.basename(path)
+    if transcode and name.lower().endswith(".png"):
+        return f"{name[:-len('.png')]}.{transcode[0]}"
+    return name
+
+# Per job, so that a file is only transcoded once, however many times it is processed, and the transcoded files can be removed when the job is done
+output_transcodes = {} # job_id -> local path -> Future of the transcoded file's path
+output_transcode_lock = threading.Lock()
+
+def start_transcodes(paths: list, job_id: str, transcode: tuple) -> dict:
+    """
+    Start transcoding the PNGs among `paths` that are not being transcoded yet, in the transcode pool.
+
+    Returns:
+        dict: The Future of each path's transcoded file, or None if it is not transcoded
+    """
+    with output_transcode_lock:
+        job_transcodes = output_transcodes.setdefault(job_id, {})
+        for path in paths:
+            if path not in job_transcodes and path.lower().endswith(".png") and os.path.exists(path):
+                # In a directory of its own per source directory, as the names only need to be unique within one
+                output_path = os.path.join(OUTPUT_TRANSCODE_DIR, fs_safe(job_id), hashlib.sha1(os.path.dirname(path).encode("utf-8")).hexdigest()[:8], output_name(path, transcode))
+                job_transcodes[path] = get_transcode_pool().submit(transcode_image, path, output_path, *transcode)
+        return {path: job_transcodes.get(path) for path in paths}
+
+def transcode_outputs(paths: list, job_id: str, transcode: tuple, wait: bool = True) -> tuple:
+    """
+    Transcode the PNGs among `paths`, all at once, in the transcode pool. A PNG that fails to transcode is returned as it is.
+
+    Returns:
+        tuple: The paths to return, with the transcoded files in place of the PNGs, and the number of files that are still being transcoded, which are left out unless `wait`
+    """
+    futures = start_transcodes(paths, job_id, transcode)
+    transcoded_paths = []
+    pending = 0
+    for path, future in futures.items():
+        if future is None:
+            transcoded_paths.append(path)
+        elif not wait and not future.done():
+            pending += 1
+        else:
+            try:
+                transcoded_paths.append(future.result())
+                count_metric("transcoded_files")
+            except BrokenProcessPool as e:
+                # Its process died; transcode it again next time, in a new pool
+                print(f"{worker_name} - Warning - Could not transcode {path} to {transcode[0]}, returning it as it is -- {e.__class__.__name__}: {e}")
+                with output_transcode_lock:
+                    if output_transcodes.get(job_id, {}).get(path) is future:
+                        del output_transcodes[job_id][path]
+                transcoded_paths.append(path)
+            except Exception as e:
+                print(f"{worker_name} - Warning - Could not transcode {path} to {transcode[0]}, returning it as it is -- {e.__class__.__name__}: {e}")
+                transcoded_paths.append(path)
+    return transcoded_paths, pending
+
+def transcoded_source(job_id: str, transcoded_path: str):
+    """
+    Returns:
+        str: The path of the file that `transcoded_path` was transcoded from, or None
+    """
+    with output_transcode_lock:
+        futures = list(output_transcodes.get(job_id, {}).items())
+    for path, future in futures:
+        if future.done() and future.exception() is None and future.result() == transcoded_path:
+            return path
+    return None
+
+def remove_transcoded_outputs(job_id: str) -> None:
+    with output_transcode_lock:
+        output_transcodes.pop(job_id, None)
+    shutil.rmtree(os.path.join(OUTPUT_TRANSCODE_DIR, fs_safe(job_id)), ignore_errors=True)
+
 class UnsafeInputError(Exception):
     pass
 
@@ -637,6 +2077,272 @@ def fs_safe(s: str, raise_: bool = False) -> str:
             print(f"Warning: string {s} was sanitized to {ss}")
     return ss
 
+class TqdmUpdatesDisabled:
+    """
+    A context manager that turns `tqdm.tqdm.update` into a no-op.
+
+    Uploads run concurrently, so the patch is reference-counted: the original method is saved by the first upload to start, and restored by the last one to finish. (Saving and restoring it around each upload would race, and could leave tqdm disabled for good.)
+    """
+    lock = threading.Lock()
+    depth = 0
+    original_update = None
+
+    def __enter__(self):
+        with TqdmUpdatesDisabled.lock:
+            if TqdmUpdatesDisabled.depth == 0:
+                TqdmUpdatesDisabled.original_update = tqdm.tqdm.update  # Save original tqdm update method
+                tqdm.tqdm.update = lambda *_, **__: None  # Disable tqdm updates
+            TqdmUpdatesDisabled.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with TqdmUpdatesDisabled.lock:
+            TqdmUpdatesDisabled.depth -= 1
+            if TqdmUpdatesDisabled.depth == 0:
+                tqdm.tqdm.update = TqdmUpdatesDisabled.original_update  # Restore tqdm after execution
+        return False
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    The SHA-256 hex digest of a file, read chunk by chunk.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class S3DedupIndex:
+    """
+    A persisted index of content hash -> S3 object key, used to avoid uploading the same bytes twice (e.g. when RunPod retries a job after a worker crash, or a deterministic workflow is re-run).
+
+    The index is an append-only JSONL file, by default on the network volume, so that it is shared by all the workers; we follow it with LogTailer, so that the entries appended by other workers are picked up cheaply. An entry is only trusted after a HEAD request confirms that the object still exists in the bucket.
+
+    Entries are scoped to the user, so that we never hand out a URL to another user's object.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {} # "{user}/{sha256}" -> key
+        self.lock = threading.Lock()
+        self.tailer = LogTailer(path)
+
+    def refresh(self) -> None:
+        for line in self.tailer.read_new():
+            try:
+                entry = json.loads(line)
+                self.entries[entry["id"]] = entry["key"]
+            except (ValueError, KeyError, TypeError):
+                print(f"{worker_name} - Warning - Ignoring a malformed line in {self.path}: {line!r}")
+
+    def lookup(self, content_id: str):
+        """
+        Returns:
+            str: The key of an object with this content, or None
+        """
+        with self.lock:
+            self.refresh()
+            return self.entries.get(content_id)
+
+    def add(self, content_id: str, key: str) -> None:
+        with self.lock:
+            self.entries[content_id] = key
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"id": content_id, "key": key}, separators=(",", ":")) + "\n")
+            except OSError as e:
+                print(f"{worker_name} - Warning - Cannot persist the S3 deduplication index to {self.path} -- {e.__class__.__name__}: {e}")
+
+s3_dedup_index = S3DedupIndex(S3_DEDUPLICATE_INDEX) if S3_DEDUPLICATE else None
+
+class ResultCache:
+    """
+    The results of previous jobs, keyed by a hash of everything that determines the output: the canonical JSON of the workflow, the content of the input images, the user (whose S3 prefix the outputs are in), and where the outputs go.
+
+    Like S3DedupIndex, the cache is an append-only JSONL file, by default on the network volume, so that a job retried on another worker hits it too. Entries expire after COMFY_RESULT_CACHE_TTL_S, and at most COMFY_RESULT_CACHE_MAX_ENTRIES are kept in memory, least recently used first out.
+
+    Outputs returned as https: or file:// URLs are stored as is. Outputs inlined as data: URLs are stored as the path of the output file, with its size and SHA-256, and encoded again on a hit, provided that the file still has that content: the output directory may be local to another worker, and ComfyUI reuses the file names of outputs that have been deleted.
+    """
+    SEED_KEYS = ("seed", "noise_seed", "subseed")
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        # A pre-signed URL is only valid for 7 days from the time it was first handed out
+        self.ttl = min(ttl, 604800 - 3600)
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (time, result)
+        self.lock = threading.Lock()
+        self.tailer = LogTailer(path)
+
+    @classmethod
+    def is_deterministic(cls, workflow) -> bool:
+        """
+        Whether the workflow produces the same output every time, i.e. it has no random seeds (-1, the A1111 / Deforum convention) or seed behaviours.
+        """
+        if isinstance(workflow, dict):
+            for key, value in workflow.items():
+                if key in cls.SEED_KEYS and not (isinstance(value, int) and value >= 0) and not isinstance(value, list): # a list is a link to another node's output
+                    return False
+                if key == "seed_behavior" and value in ("random", "iter", "ladder", "alternate", "schedule"):
+                    return False
+                if not cls.is_deterministic(value):
+                    return False
+        elif isinstance(workflow, list):
+            return all(cls.is_deterministic(value) for value in workflow)
+        return True
+
+    @classmethod
+    def cacheable(cls, workflow, metadata) -> bool:
+        if metadata.get("cache") is False: # the client's opt-out
+            return False
+        if SERVICE_TYPE == "deforum": # the frames are streamed as they are generated, there is no one result to replay
+            return False
+        if SERVICE_TYPE == "a1111" and "seed" not in workflow: # the default is a random seed
+            return False
+        return cls.is_deterministic(workflow)
+
+    @staticmethod
+    def key(workflow, images, metadata) -> str:
+        canonical = json.dumps({
+            "service": SERVICE_TYPE,
+            "workflow": workflow,
+            "images": sorted((image["name"], image["sha256"] if "sha256" in image else image_sha256(image["image"])) for image in images or []),
+            "user": s3_user(metadata),
+            "save_to_s3": get_bool_env("SAVE_TO_S3", False),
+            "output_transcode": output_transcode(metadata),
+        }, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def refresh(self) -> None:
+        for line in self.tailer.read_new():
+            try:
+                entry = json.loads(line)
+                self.put(entry["key"], entry["time"], entry["result"])
+            except (ValueError, KeyError, TypeError):
+                print(f"{worker_name} - Warning - Ignoring a malformed line in {self.path}: {line!r}")
+
+    def put(self, key, created, result) -> None:
+        if time.time() - created > self.ttl:
+            return
+        self.entries[key] = (created, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, key: str):
+        """
+        Returns:
+            dict: The result of a previous job with the same key, ready to be returned, or None
+        """
+        with self.lock:
+            self.refresh()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            created, result = entry
+            if time.time() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        images = []
+        for image in result["images"]:
+            if "path" in image:
+                try:
+                    if os.path.getsize(image["path"]) != image.get("size") or file_sha256(image["path"]) != image.get("sha256"):
+                        return None
+                except OSError:
+                    return None
+                images.append({"name": image["name"], "url": image_to_data_url(image["path"])})
+            else:
+                images.append(image)
+        return {**result, "images": images}
+
+    def add(self, key: str, result: dict) -> None:
+        """
+        Cache a successful result, unless some of its outputs cannot be returned again.
+        """
+        paths = {os.path.basename(path): path for path in comfyui_output_files(result["outputs"])} if "outputs" in result else {}
+        images = []
+        for image in result["images"]:
+            if image["url"].startswith("data:"):
+                if image["name"] not in paths:
+                    return
+                path = paths[image["name"]]
+                try:
+                    images.append({"name": image["name"], "path": path, "size": os.path.getsize(path), "sha256": file_sha256(path)})
+                except OSError:
+                    return
+            else:
+                images.append(image)
+        result = {k: v for k, v in result.items() if k not in ("refresh_worker", "poll_cadence")}
+        result["images"] = images
+        created = time.time()
+        with self.lock:
+            self.put(key, created, result)
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"key": key, "time": created, "result": result}, separators=(",", ":")) + "\n")
+            except OSError as e:
+                print(f"{worker_name} - Warning - Cannot persist the result cache to {self.path} -- {e.__class__.__name__}: {e}")
+
+result_cache = ResultCache(RESULT_CACHE_INDEX, RESULT_CACHE_TTL_S, RESULT_CACHE_MAX_ENTRIES) if RESULT_CACHE else None
+
+def s3_credentials() -> dict:
+    # Cf. https://github.com/runpod/runpod-python/blob/main/docs/serverless/utils/rp_upload.md#bucket-credentials
+    return {
+        "endpointUrl": AWS_S3_ENDPOINT_URL,
+        "accessId": AWS_ACCESS_KEY_ID,
+        "accessSecret": AWS_SECRET_ACCESS_KEY,
+    }
+
+s3_client_lock = threading.Lock()
+def get_s3_client():
+    """
+    A boto3 S3 client for our bucket, created on first use (boto3 clients are thread-safe).
+    """
+    global s3_client
+    with s3_client_lock:
+        if "s3_client" not in globals():
+            # This method is simply wrong, so we monkeypatch it in the simplest way possible
+            rp_upload.extract_region_from_url = lambda url: AWS_REGION
+            s3_client, _ = rp_upload.get_boto_client(s3_credentials())
+        if s3_client is None:
+            raise InternalServerError("Cannot create an S3 client -- is boto3 installed?")
+        return s3_client
+
+def s3_presigned_url(key: str) -> str:
+    # Same expiry as rp_upload.upload_file_to_bucket()
+    return get_s3_client().generate_presigned_url("get_object", Params={"Bucket": AWS_S3_BUCKET, "Key": key}, ExpiresIn=604800)
+
+def s3_object_exists(key: str) -> bool:
+    try:
+        get_s3_client().head_object(Bucket=AWS_S3_BUCKET, Key=key)
+        return True
+    except Exception as e:
+        print(f"{worker_name} - S3 object {key} is gone -- {e.__class__.__name__}: {e}")
+        return False
+
+def s3_user(metadata: dict) -> str:
+    try:
+        return metadata["user"]
+    except:
+        return "no_user"
+
+def s3_object_prefix(job_id: str, file_name: str, metadata: dict) -> str:
+    """
+    The path-like prefix of the S3 object key of an output file; see rp_upload_image() for the folder structure.
+    """
+    TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S" # 2024-12-24-17-45-33
+    timestamp = JobTimestamp.get_timestamp(job_id).strftime(TIMESTAMP_FORMAT)
+
+    # Ideally the sanitization is a no-op. The helper function prints a warning if the sanitization is not a no-op.
+    return f"""users/{fs_safe(s3_user(metadata))}/output/{
+                                {
+                                    "comfyui": f"comfyui/generating-{'video' if is_video(file_name) else 'image'}",
+                                    "deforum": "1111-deforum/generating-image-sequence",
+                                    "a1111": "automatic1111/generating-image",
+                                }[SERVICE_TYPE]
+                            }/{fs_safe(timestamp)}"""
+
 def rp_upload_image(job_id: str, local_image_path: str, metadata: dict = {}, store_metadata: bool = False) -> str:
     """
     Save in S3.
@@ -662,6 +2368,8 @@ def rp_upload_image(job_id: str, local_image_path: str, metadata: dict = {}, sto
     
     Each job is saved in its own folder which is the timestamp of the job.
 
+    With COMFY_S3_DEDUPLICATE, if the same user has had the same bytes uploaded before (see S3DedupIndex), the existing object is reused instead, wherever it is.
+
     We use the RunPod SDK's S3 upload function, because we are masochists, love bad library code, becuase the fine developers at RunPod use some nice optimalisations, and most importantly because their version is tested so that the quirks of boto3 and the quirks of RunPod play together nicely -- which we cannot otherwise guarantee. Having said that, their code looks like someone took a shell script fragment, and without any thinking implemented it in Python, which is probably exactly what happened.
     """
     def my_upload_file_to_bucket(*args, **kwargs):
@@ -676,58 +2384,190 @@ def rp_upload_image(job_id: str, local_image_path: str, metadata: dict = {}, sto
         - This ensures that the function runs without issues, while preserving tqdm's normal behavior
         for any other part of the application.
 
-        The original tqdm behavior is restored immediately after the function call.
+        The original tqdm behavior is restored as soon as the last concurrent upload has finished.
         """
         file_name = args[0] if len(args) > 0 else kwargs.get("file_name", "[no file provided]")
         print(f"{worker_name} - Uploading {file_name} to S3 - Warning: uploading with TQDM disabled, to work around a bug in the RunPod SDK")
-        original_update = tqdm.tqdm.update  # Save original tqdm update method
-        tqdm.tqdm.update = lambda *_, **__: None  # Disable tqdm updates
-
-        try:
+        with TqdmUpdatesDisabled():
             return rp_upload.upload_file_to_bucket(*args, **kwargs)  # Call the original function
-        finally:
-            tqdm.tqdm.update = original_update  # Restore tqdm after execution
-
-    try:
-        user = metadata["user"]
-    except:
-        user = "no_user"
-    TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S" # 2024-12-24-17-45-33
-    timestamp = JobTimestamp.get_timestamp(job_id).strftime(TIMESTAMP_FORMAT)
 
-    # Ideally the sanitization is a no-op. The helper function prints a warning if the sanitization is not a no-op.
-    path_within_bucket = f"""users/{fs_safe(user)}/output/{
-                                {
-                                    "comfyui": f"comfyui/generating-{'video' if is_video(local_image_path) else 'image'}",
-                                    "deforum": "1111-deforum/generating-image-sequence",
-                                    "a1111": "automatic1111/generating-image",
-                                }[SERVICE_TYPE]
-                            }/{fs_safe(timestamp)}"""
+    path_within_bucket = s3_object_prefix(job_id, local_image_path, metadata)
 
-    # Cf. https://github.com/runpod/runpod-python/blob/main/docs/serverless/utils/rp_upload.md#bucket-credentials
-    aws_credentials = {
-        "endpointUrl": f"https://s3.{AWS_REGION}.amazonaws.com",
-        "accessId": AWS_ACCESS_KEY_ID,
-        "accessSecret": AWS_SECRET_ACCESS_KEY,
-    }
+    if s3_dedup_index:
+        content_id = f"{fs_safe(s3_user(metadata))}/{file_sha256(local_image_path)}"
+        key = s3_dedup_index.lookup(content_id)
+        if key and s3_object_exists(key):
+            print(f"{worker_name} - {local_image_path} has been uploaded to S3 before, as {key}, reusing it")
+            count_metric("s3_dedup_hits")
+            return s3_presigned_url(key)
 
     # This method is simply wrong, so we monkeypatch it in the simplest way possible
     rp_upload.extract_region_from_url = lambda url: AWS_REGION
 
+    extra_args = {
+        "ContentType": guess_mime_type(local_image_path),
+        **({"Metadata": metadata} if store_metadata else {})
+    }
     # We are getting reports that the images are only partially uploaded.
-    url = my_upload_file_to_bucket(
-        file_name=os.path.basename(local_image_path),
-        file_location=local_image_path,
-        bucket_creds=aws_credentials,
-        bucket_name=AWS_S3_BUCKET,
-        prefix=path_within_bucket,
-        extra_args={
-            "ContentType": guess_mime_type(local_image_path),
-            **({"Metadata": metadata} if store_metadata else {})
-        },
-    )
+    with timed_metric("s3_upload"):
+        if os.path.getsize(local_image_path) >= S3_MULTIPART_THRESHOLD:
+            # Videos, mostly; see multipart_upload_file() for why not upload_file_to_bucket()
+            key = f"{path_within_bucket}/{os.path.basename(local_image_path)}"
+            multipart_upload_file(job_id, local_image_path, key, extra_args)
+            url = s3_presigned_url(key)
+        else:
+            url = my_upload_file_to_bucket(
+                file_name=os.path.basename(local_image_path),
+                file_location=local_image_path,
+                bucket_creds=s3_credentials(),
+                bucket_name=AWS_S3_BUCKET,
+                prefix=path_within_bucket,
+                extra_args=extra_args,
+            )
+    count_metric("s3_uploads")
+    if current_job_metrics.get() is not None:
+        count_metric("s3_upload_bytes", os.path.getsize(local_image_path))
+    if s3_dedup_index:
+        s3_dedup_index.add(content_id, f"{path_within_bucket}/{os.path.basename(local_image_path)}")
     return url
 
+class S3UploadError(Exception):
+    pass
+
+# Per job, so that a failed upload can be resumed later in the job, and abandoned when the job is done
+s3_multipart_uploads = {} # job_id -> key -> {"upload_id", "size", "part_size", "parts": {part number -> {"ETag", "md5"}}}
+s3_multipart_lock = threading.Lock()
+# Separate from s3_upload_executor, whose threads wait for the parts
+s3_part_executor = ThreadPoolExecutor(max_workers=max(1, S3_MULTIPART_CONCURRENCY), thread_name_prefix="s3-part")
+
+def s3_part_size(size: int) -> int:
+    # S3 allows at most 10000 parts, and all but the last must be at least 5 MiB
+    return max(S3_MULTIPART_PART_SIZE, 5 * 2**20, -(-size // 10000))
+
+def multipart_upload_file(job_id: str, local_path: str, key: str, extra_args: dict) -> None:
+    """
+    Upload a file to S3 in parts of COMFY_S3_MULTIPART_PART_SIZE, COMFY_S3_MULTIPART_CONCURRENCY at a time.
+
+    rp_upload.upload_file_to_bucket() uploads in 25 KiB parts, which makes a large video thousands of requests, and a video over 250 MB more than the 10000 parts that S3 allows.
+
+    Each part is sent with its MD5, so that S3 rejects a part that arrives corrupted, and is retried up to COMFY_S3_MULTIPART_RETRIES times. The assembled object is checked against the size of the file, and against the ETag expected from the parts, so that an incomplete upload is never returned.
+
+    The parts that made it are remembered for the rest of the job: uploading the same file again in the same job only sends the missing parts. Uploads still unfinished at the end of the job are aborted (see abort_multipart_uploads()). An object that does not match the file is deleted.
+
+    Raises:
+        S3UploadError: If some parts failed to upload, or the object does not match the file
+    """
+    client = get_s3_client()
+    size = os.path.getsize(local_path)
+    part_size = s3_part_size(size)
+    part_count = max(1, -(-size // part_size))
+    with s3_multipart_lock:
+        upload = s3_multipart_uploads.get(job_id, {}).get(key)
+    if upload is not None and upload["size"] == size and upload["part_size"] == part_size:
+        print(f"{worker_name} - Resuming the upload of {key}, {len(upload['parts'])} of {part_count} parts are already uploaded")
+    else:
+        upload = {"upload_id": client.create_multipart_upload(Bucket=AWS_S3_BUCKET, Key=key, **extra_args)["UploadId"], "size": size, "part_size": part_size, "parts": {}}
+        with s3_multipart_lock:
+            s3_multipart_uploads.setdefault(job_id, {})[key] = upload
+
+    def upload_part(part_number):
+        with open(local_path, "rb") as f:
+            data = os.pread(f.fileno(), part_size, (part_number - 1) * part_size)
+        md5 = hashlib.md5(data).digest()
+        for attempt in range(S3_MULTIPART_RETRIES + 1):
+            try:
+                response = client.upload_part(
+                    Bucket=AWS_S3_BUCKET, Key=key, UploadId=upload["upload_id"], PartNumber=part_number, Body=data,
+                    ContentMD5=base64.b64encode(md5).decode("ascii"),
+                )
+                break
+            except Exception as e:
+                if attempt == S3_MULTIPART_RETRIES:
+                    raise
+                print(f"{worker_name} - Retrying part {part_number} of {key} -- {e.__class__.__name__}: {e}")
+                count_metric("s3_part_retries")
+                time.sleep(0.5 * 2 ** attempt)
+        upload["parts"][part_number] = {"ETag": response["ETag"], "md5": md5}
+        count_metric("s3_parts")
+
+    missing = [part_number for part_number in range(1, part_count + 1) if part_number not in upload["parts"]]
+    futures = [s3_part_executor.submit(in_job_context(upload_part), part_number) for part_number in missing]
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(f"{e.__class__.__name__}: {e}")
+    if errors:
+        raise S3UploadError(f"{len(errors)} of {part_count} parts of {key} failed to upload, the upload can be resumed -- {errors[0]}")
+
+    parts = [{"PartNumber": part_number, "ETag": upload["parts"][part_number]["ETag"]} for part_number in range(1, part_count + 1)]
+    response = client.complete_multipart_upload(Bucket=AWS_S3_BUCKET, Key=key, UploadId=upload["upload_id"], MultipartUpload={"Parts": parts})
+    with s3_multipart_lock:
+        # The job may have been cleaned up (see abort_multipart_uploads()) while the parts were uploading
+        uploads = s3_multipart_uploads.get(job_id, {})
+        uploads.pop(key, None)
+        if not uploads:
+            s3_multipart_uploads.pop(job_id, None)
+    # The ETag of a multipart object is the MD5 of the parts' MD5s, unless the bucket is encrypted with KMS, where it is something else entirely
+    expected_etag = f"{hashlib.md5(b''.join(upload['parts'][part_number]['md5'] for part_number in range(1, part_count + 1))).hexdigest()}-{part_count}"
+    etag = response.get("ETag", "").strip('"')
+    error = None
+    if "-" in etag and etag != expected_etag:
+        error = f"{key} does not match {local_path}: ETag {etag}, expected {expected_etag}"
+    else:
+        uploaded_size = client.head_object(Bucket=AWS_S3_BUCKET, Key=key)["ContentLength"]
+        if uploaded_size != size:
+            error = f"{key} is incomplete: {uploaded_size} of {size} bytes"
+    if error:
+        # Nobody is to be handed the bad object, e.g. by the deduplication index
+        try:
+            client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        except Exception as e:
+            print(f"{worker_name} - Warning - Could not delete the bad object {key} -- {e.__class__.__name__}: {e}")
+        raise S3UploadError(error)
+
+def abort_multipart_uploads(job_id: str) -> None:
+    """
+    Abort the job's unfinished multipart uploads, so that their parts are not kept (and billed for) by S3.
+    """
+    with s3_multipart_lock:
+        uploads = s3_multipart_uploads.pop(job_id, {})
+    for key, upload in uploads.items():
+        try:
+            get_s3_client().abort_multipart_upload(Bucket=AWS_S3_BUCKET, Key=key, UploadId=upload["upload_id"])
+        except Exception as e:
+            print(f"{worker_name} - Warning - Could not abort the upload of {key} -- {e.__class__.__name__}: {e}")
+
+def upload_bytes_to_s3(job_id: str, file_name: str, data: bytes, metadata: dict) -> str:
+    """
+    Upload in-memory data to an S3 bucket, under the same key as rp_upload_image() would for a file of that name -- but without going through the disk.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        file_name (str): The name of the object, within the job's folder
+        data (bytes): The content of the object
+
+    Returns:
+        str: The URL to the uploaded object in the S3 bucket
+    """
+    key = f"{s3_object_prefix(job_id, file_name, metadata)}/{file_name}"
+    if s3_dedup_index:
+        content_id = f"{fs_safe(s3_user(metadata))}/{hashlib.sha256(data).hexdigest()}"
+        existing_key = s3_dedup_index.lookup(content_id)
+        if existing_key and s3_object_exists(existing_key):
+            print(f"{worker_name} - {file_name} has been uploaded to S3 before, as {existing_key}, reusing it")
+            count_metric("s3_dedup_hits")
+            return s3_presigned_url(existing_key)
+    print(f"{worker_name} - Uploading {file_name} to S3")
+    with timed_metric("s3_upload"):
+        get_s3_client().put_object(Bucket=AWS_S3_BUCKET, Key=key, Body=data, ContentType=guess_mime_type(file_name))
+    count_metric("s3_uploads")
+    count_metric("s3_upload_bytes", len(data))
+    if s3_dedup_index:
+        s3_dedup_index.add(content_id, key)
+    return s3_presigned_url(key)
+
 def upload_png_to_s3(job_id: str, png_data: str, metadata: dict) -> str:
     """
     Upload a PNG image to an S3 bucket
@@ -739,16 +2579,33 @@ def upload_png_to_s3(job_id: str, png_data: str, metadata: dict) -> str:
     Returns:
         str: The URL to the uploaded image in the S3 bucket
     """
-    bytes = base64.b64decode(png_data)
-    with NamedTemporaryFile(mode="wb", suffix=".png") as temp_file:
-        temp_file.write(bytes)
-        temp_file.flush()
-        # Upload the PNG file to the S3 bucket
-        return rp_upload_image(job_id, temp_file.name, metadata)
-
-if get_bool_env("SAVE_TO_S3", False):
-    s3_url_cache = {}
-def process_output_images(outputs, job_id, metadata):
+    # The job ID is random, so it makes for a random file name, too
+    return upload_bytes_to_s3(job_id, f"{job_id}.png", base64.b64decode(png_data), metadata)
+
+# Both are per job, so that concurrent jobs are isolated, and a job's entries can be dropped once it is done
+s3_url_cache = {} # job_id -> local_image_path -> url
+s3_upload_futures = {} # job_id -> local_image_path -> Future, for uploads that have not been moved to s3_url_cache yet (in flight, or failed)
+s3_upload_lock = threading.Lock()
+s3_upload_executor = ThreadPoolExecutor(max_workers=max(1, S3_UPLOAD_CONCURRENCY), thread_name_prefix="s3-upload")
+def comfyui_output_files(outputs: dict) -> list:
+    """
+    Returns:
+        list: The paths of the images and videos in ComfyUI's /history `outputs`
+    """
+    # The path where ComfyUI stores the generated images
+    OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH") or os.environ.get("WEBUI_OUTPUT_PATH") or "/comfyui/output"
+
+    output_images = []
+    for node_id, node_output in outputs.items():
+        if "images" in node_output:
+            for image in node_output["images"]:
+                output_images.append(os.path.join(OUTPUT_PATH, image["subfolder"], image["filename"]))
+        if "gifs" in node_output:
+            for video in node_output["gifs"]:
+                output_images.append(os.path.join(OUTPUT_PATH, video["subfolder"], video["filename"]))
+    return output_images
+
+def process_output_images(outputs, job_id, metadata, wait=True):
     """
     This function takes the "outputs" from image generation and the job ID,
     then determines the correct way to return the image, either as a direct URL
@@ -760,7 +2617,9 @@ def process_output_images(outputs, job_id, metadata):
                         typically includes node IDs and their respective output data.
                         (for comfyui)
         outputs (str): File path stub of the generated images & videos. (for deforum)
+        outputs (list): Paths of the generated images. (for deforum)
         job_id (str): The unique identifier for the job.
+        wait (bool): Whether to wait for the S3 uploads to finish. If False, the images whose upload is still in progress are left out, and will be returned by a later call.
 
     Returns:
         dict: A dictionary with the status ('success' or 'error') and the message,
@@ -773,8 +2632,12 @@ def process_output_images(outputs, job_id, metadata):
     - It then iterates through the outputs to find the filenames of the generated images.
     - After confirming the existence of the image in the output folder, it checks if the
       SAVE_TO_S3 environment variable.
-    - If it is set and is truthy, it uploads the image to the bucket and returns the URL.
-    - If it is is falsy or unset, it encodes the image in base64 and returns a data: URL.
+    - If it is set and is truthy, it uploads the image to the bucket and returns the URL. The uploads are
+      started all at once, and run concurrently in the background (COMFY_S3_UPLOAD_CONCURRENCY). A failed
+      upload is retried once, on the final (`wait`) pass; if it fails again, it is reported under "errors", and
+      does not fail the other images.
+    - If it is is falsy or unset, it encodes the image in base64 and returns a data: URL. Images larger than
+      COMFY_DATA_URL_MAX_BYTES are uploaded to S3 instead if the credentials are set, or else returned as file:// URLs.
     - If the image file does not exist in the output folder, it returns an error status
       with a message indicating the missing image file.
     """
@@ -782,24 +2645,15 @@ def process_output_images(outputs, job_id, metadata):
         pass
 
     if SERVICE_TYPE == "comfyui":
-        # The path where ComfyUI stores the generated images
-        OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH") or os.environ.get("WEBUI_OUTPUT_PATH") or "/comfyui/output"
-
-        output_images = []
-        all_outputs = {}
-
-        for node_id, node_output in outputs.items():
-            if "images" in node_output:
-                for image in node_output["images"]:
-                    output_images.append(os.path.join(OUTPUT_PATH, image["subfolder"], image["filename"]))
-            if "gifs" in node_output:
-                for video in node_output["gifs"]:
-                    output_images.append(os.path.join(OUTPUT_PATH, video["subfolder"], video["filename"]))
-            if node_output:
-                all_outputs[node_id] = node_output
-                    
+        output_images = comfyui_output_files(outputs)
+        all_outputs = {node_id: node_output for node_id, node_output in outputs.items() if node_output}
+
+    elif SERVICE_TYPE == "deforum" and type(outputs) is list:
+        # The paths of the files, as already found by OutputWatcher
+        output_images = outputs
+
     elif SERVICE_TYPE == "deforum":
-        assert type(outputs) is str, "outputs must be a string when SERVICE_TYPE is deforum"
+        assert type(outputs) is str, "outputs must be a string or a list when SERVICE_TYPE is deforum"
         # the `outputs` output path stub looks like "/runpod-volume/stable-diffusion-webui/outputs/img2img-images/Deforum_foobar/20241204213940"
         # so we have to do the equivalent of "/runpod-volume/stable-diffusion-webui/outputs/img2img-images/Deforum_foobar/20241204213940"* to get all the images' paths
         print("DEBUG: outputs: ", outputs, "SERVICE_TYPE:", SERVICE_TYPE)
@@ -815,26 +2669,69 @@ def process_output_images(outputs, job_id, metadata):
 
     try:
         encoded_output_images = []
+        upload_errors = []
+        pending_uploads = 0
+        transcode = output_transcode(metadata)
+        if transcode and get_transcode_pool():
+            output_images, pending_transcodes = transcode_outputs(output_images, job_id, transcode, wait)
+            pending_uploads += pending_transcodes
+        save_to_s3 = get_bool_env("SAVE_TO_S3", False)
+        # Only the images that are in the output folder
+        destinations = {local_image_path: output_destination(local_image_path, save_to_s3) for local_image_path in output_images if os.path.exists(local_image_path)}
+        # Start all the uploads first, so that they run concurrently
+        with s3_upload_lock:
+            job_s3_url_cache = s3_url_cache.setdefault(job_id, {})
+            job_s3_upload_futures = s3_upload_futures.setdefault(job_id, {})
+            for local_image_path, destination in destinations.items():
+                if destination == "s3" and local_image_path not in job_s3_url_cache and local_image_path not in job_s3_upload_futures:
+                    job_s3_upload_futures[local_image_path] = s3_upload_executor.submit(in_job_context(rp_upload_image), job_id, local_image_path, metadata)
         for local_image_path in output_images:
             print(f"{worker_name} - {local_image_path}")
 
-            # The image is in the output folder
-            if os.path.exists(local_image_path):
+            if local_image_path in destinations:
                 base_name = os.path.basename(local_image_path)
-                if get_bool_env("SAVE_TO_S3", False):
+                if destinations[local_image_path] == "s3":
                     # URL to image in AWS S3
                     # Most of the time, the image has previously been already processed
-                    if local_image_path in s3_url_cache:
-                        url = s3_url_cache[local_image_path]
-                    else:
-                        url = rp_upload_image(job_id, local_image_path, metadata)
-                        s3_url_cache[local_image_path] = url
+                    with s3_upload_lock:
+                        url = job_s3_url_cache.get(local_image_path)
+                        future = job_s3_upload_futures.get(local_image_path)
+                    if url is None:
+                        if not wait and not future.done():
+                            pending_uploads += 1
+                            continue
+                        if wait and not getattr(future, "retried", False) and future.exception() is not None:
+                            # Retry a failed upload once, on the final pass; a multipart upload that failed part-way only sends the missing parts this time
+                            print(f"{worker_name} - Retrying the upload of {base_name} -- {future.exception().__class__.__name__}: {future.exception()}")
+                            future = s3_upload_executor.submit(in_job_context(rp_upload_image), job_id, local_image_path, metadata)
+                            future.retried = True
+                            with s3_upload_lock:
+                                job_s3_upload_futures[local_image_path] = future
+                        try:
+                            url = future.result()
+                        except Exception as e:
+                            # The future stays put, so that we keep reporting the failure, and do not retry it again
+                            print(f"{worker_name} - Error uploading {base_name} to AWS S3 -- {e.__class__.__name__}: {e}")
+                            upload_errors.append({"name": base_name, "error": f"{e.__class__.__name__}: {str(e)}"})
+                            continue
+                        with s3_upload_lock:
+                            job_s3_url_cache[local_image_path] = url
+                            job_s3_upload_futures.pop(local_image_path, None)
                         print(
                             f"{worker_name} - the image {base_name} was generated and uploaded to AWS S3: {url}"
                         )
+                elif destinations[local_image_path] == "file":
+                    file_path = local_image_path
+                    if transcode and local_image_path.startswith(OUTPUT_TRANSCODE_DIR):
+                        # The transcoded file is in the worker's own /tmp, out of the client's reach, and removed with the job: point at the original on the network volume instead
+                        file_path = transcoded_source(job_id, local_image_path) or local_image_path
+                        base_name = os.path.basename(file_path)
+                    url = f"file://{urllib.parse.quote(os.path.abspath(file_path))}"
+                    print(f"{worker_name} - the image {base_name} is larger than COMFY_DATA_URL_MAX_BYTES, and S3 is not configured, returning a file reference: {url}")
                 else:
                     # data: URL
                     url = image_to_data_url(local_image_path)
+                    count_metric("data_url_bytes", len(url))
                     print(
                         f"{worker_name} - the image {base_name} was generated and converted to data URL: {url[:40]+'...' if len(url)>42 else url}"
                     )
@@ -842,14 +2739,19 @@ def process_output_images(outputs, job_id, metadata):
                     "name": base_name,
                     "url": url
                 })
-        if encoded_output_images:
+                count_metric("output_files")
+        if encoded_output_images or pending_uploads:
             print(f"{worker_name} - Success: sending image{'s' if len(encoded_output_images)>1 else ''}: {[f['name'] for f in encoded_output_images]}")
             ret = {
                 "status": "success",
                 "images": encoded_output_images,
+                **({"errors": upload_errors} if upload_errors else {}),
+                **({"pending": pending_uploads} if pending_uploads else {}),
                 **({"outputs": all_outputs} if "all_outputs" in locals() else {}),
             }
             return ret
+        elif upload_errors:
+            raise ImageOutputError(f"All uploads failed: {upload_errors}")
         else:
             raise ImageOutputError(f"Images generated, but none exist in the output folder: {output_images}" if output_images else "No images generated")
     except Exception as e:
@@ -861,37 +2763,516 @@ def process_output_images(outputs, job_id, metadata):
         }
         return ret
 
+class InotifyWatch:
+    """
+    A minimal, non-blocking inotify(7) watch on a single directory, using libc through ctypes (so that we do not need another dependency).
+
+    Note that on a network volume only changes made by this machine are reported, which is what we want for files written by the backend.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+
+    def __init__(self, directory: str, mask: int):
+        """
+        Raises:
+            OSError: If inotify is not available, or the directory cannot be watched
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.directory = directory
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}: {os.strerror(errno)}")
+
+    def read_events(self) -> list:
+        """
+        Returns:
+            list: (mask, name) for every event queued since the last call; never blocks
+        """
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((mask, name))
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class CancellationWatcher:
+    """
+    Watches the cancellation directory in a background thread, and keeps the cancellation requests for the jobs running on this worker in memory, so that raise_for_cancel() is a dictionary lookup, rather than a metadata round-trip to the network volume on every poll of every job.
+
+    When a running job is cancelled, its `on_cancel` callback is called straight away, from the watcher thread, so that the backend is interrupted even while the handler is blocked (e.g. uploading the input images, or waiting for a synchronous A1111 call).
+
+    Cancellation files are normally written from another machine, which inotify does not see on a network volume, so the directory is also listed every COMFY_CANCEL_WATCH_INTERVAL_MS -- but only while there are jobs running. inotify just wakes us up early for files written locally.
+    """
+    def __init__(self, directory: str = CANCEL_DIR, interval_ms: int = CANCEL_WATCH_INTERVAL_MS):
+        self.directory = directory
+        self.interval = interval_ms / 1000
+        self.lock = threading.Lock()
+        self.jobs = {} # runpod_job_id -> (file name, on_cancel)
+        self.cancelled = {} # runpod_job_id -> timestamp of the cancellation request
+        self.inotify = None
+        try:
+            self.inotify = InotifyWatch(directory, InotifyWatch.IN_CLOSE_WRITE | InotifyWatch.IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            print(f"{worker_name} - Cannot watch {directory} with inotify, polling it only -- {e.__class__.__name__}: {e}")
+        self.thread = threading.Thread(target=self.run, name="cancellation-watcher", daemon=True)
+        self.thread.start()
+
+    def register(self, runpod_job_id: str, on_cancel=None) -> None:
+        """
+        Start watching for the cancellation of a job; a request that was already there is picked up immediately.
+        """
+        try:
+            file_name = fs_safe(runpod_job_id, raise_=True)
+        except UnsafeInputError:
+            print(f"Warning: Runpod Job ID is filesystem-unsafe: {runpod_job_id}")
+            return
+        timestamp = take_cancel_request(os.path.join(self.directory, file_name))
+        with self.lock:
+            self.jobs[runpod_job_id] = (file_name, on_cancel)
+            if timestamp:
+                self.cancelled[runpod_job_id] = timestamp
+
+    def unregister(self, runpod_job_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(runpod_job_id, None)
+            self.cancelled.pop(runpod_job_id, None)
+
+    def is_registered(self, runpod_job_id: str) -> bool:
+        with self.lock:
+            return runpod_job_id in self.jobs
+
+    def cancelled_at(self, runpod_job_id: str):
+        """
+        Returns:
+            str: The timestamp of the cancellation request, or None if the job has not been cancelled
+        """
+        with self.lock:
+            return self.cancelled.get(runpod_job_id)
+
+    def wait(self) -> None:
+        if self.inotify:
+            select.select([self.inotify.fd], [], [], self.interval)
+            self.inotify.read_events()
+        else:
+            time.sleep(self.interval)
+
+    def run(self):
+        while True:
+            self.wait()
+            with self.lock:
+                watched = {runpod_job_id: file_name for runpod_job_id, (file_name, _) in self.jobs.items() if runpod_job_id not in self.cancelled}
+            if not watched:
+                continue
+            try:
+                present = set(os.listdir(self.directory))
+            except OSError:
+                continue
+            for runpod_job_id, file_name in watched.items():
+                if file_name not in present:
+                    continue
+                timestamp = take_cancel_request(os.path.join(self.directory, file_name))
+                if not timestamp:
+                    continue
+                with self.lock:
+                    if runpod_job_id not in self.jobs:
+                        continue
+                    self.cancelled[runpod_job_id] = timestamp
+                    on_cancel = self.jobs[runpod_job_id][1]
+                print(f"{worker_name} - Job '{runpod_job_id}' was cancelled at {timestamp}, interrupting it")
+                if on_cancel:
+                    try:
+                        on_cancel()
+                    except Exception as e:
+                        print(f"{worker_name} - Warning - Failed to interrupt job '{runpod_job_id}' -- {e.__class__.__name__}: {e}")
+
+cancellation_watcher = None
+cancellation_watcher_lock = threading.Lock()
+def get_cancellation_watcher():
+    """
+    Return the worker's cancellation watcher, starting it on first use, or None if COMFY_CANCEL_WATCHER is disabled.
+    """
+    global cancellation_watcher
+    if not CANCEL_WATCHER:
+        return None
+    with cancellation_watcher_lock:
+        if cancellation_watcher is None:
+            cancellation_watcher = CancellationWatcher()
+        return cancellation_watcher
+
+class OutputWatcher:
+    """
+    An incremental index of the completed output files whose paths begin with a path stub (cf. construct_output_path_stub()).
+
+    With inotify, a file is complete once it has been closed after writing (or moved into place). Without inotify, we list the directory on every poll -- a single readdir, rather than the glob plus a stat of every entry -- and a file is complete once its size and mtime have stopped changing between two polls. Files that already existed when the watcher was started are checked the same way.
+
+    Only new files are ever returned, so the cost per poll does not grow with the number of frames already streamed.
+    """
+    def __init__(self, output_files_path_stub: str, mode: str = None):
+        mode = mode or OUTPUT_WATCHER
+        self.directory, self.prefix = os.path.split(output_files_path_stub)
+        self.completed = set()
+        self.candidates = {} # path -> (size, mtime_ns) as of the previous poll, for the files not known to be complete yet
+        self.inotify = None
+        if mode == "inotify":
+            try:
+                self.inotify = InotifyWatch(self.directory, InotifyWatch.IN_CLOSE_WRITE | InotifyWatch.IN_MOVED_TO)
+            except (OSError, AttributeError) as e:
+                print(f"{worker_name} - Warning - Cannot watch {self.directory} with inotify, polling it instead -- {e.__class__.__name__}: {e}")
+        self.rescan()
+
+    def wanted(self, name: str) -> bool:
+        # exclude .mp4 files and .txt files
+        return name.startswith(self.prefix) and not name.endswith(".mp4") and not name.endswith(".txt")
+
+    def rescan(self) -> None:
+        """
+        Add the files we have not seen yet to the candidates.
+        """
+        try:
+            entries = os.scandir(self.directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if self.wanted(entry.name) and entry.path not in self.completed and entry.path not in self.candidates and entry.is_file():
+                    self.candidates[entry.path] = None
+
+    def poll(self, final: bool = False) -> list:
+        """
+        Args:
+            final (bool): The job has finished, so all the files are complete
+
+        Returns:
+            list: The paths of the files completed since the last call, sorted by file name
+        """
+        new_files = []
+        if self.inotify:
+            for mask, name in self.inotify.read_events():
+                if mask & InotifyWatch.IN_Q_OVERFLOW:
+                    self.rescan()
+                    continue
+                path = os.path.join(self.directory, name)
+                if not mask & InotifyWatch.IN_ISDIR and self.wanted(name) and path not in self.completed:
+                    self.candidates.pop(path, None)
+                    self.completed.add(path)
+                    new_files.append(path)
+        else:
+            self.rescan()
+        if final:
+            self.rescan()
+        for path, previous in list(self.candidates.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.candidates[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if final or current == previous:
+                del self.candidates[path]
+                self.completed.add(path)
+                new_files.append(path)
+            else:
+                self.candidates[path] = current
+        new_files.sort(key=os.path.basename)
+        return new_files
+
+    def close(self) -> None:
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+class StatusJournal:
+    """
+    The most recent status snapshots of a job, kept in a bounded ring buffer.
+
+    If COMFY_STATUS_JOURNAL_DIR is set, every snapshot is also appended to a JSONL file for the job, through a buffered writer, so that we do not pay for a synchronous write on every poll. The ring buffer is only written out in full, by dump(), if the job fails.
+    """
+    def __init__(self, job_id: str, maxlen: int = STATUS_JOURNAL_SIZE, directory: str = STATUS_JOURNAL_DIR):
+        self.job_id = job_id
+        self.file_name_stub = f"{fs_safe(job_id)}_status"
+        self.snapshots = deque(maxlen=maxlen)
+        self.file = None
+        if directory:
+            try:
+                self.file = open(os.path.join(directory, f"{self.file_name_stub}.jsonl"), "a", buffering=64 * 1024)
+            except OSError as e:
+                print(f"{worker_name} - Warning - Cannot open the status journal in {directory} -- {e.__class__.__name__}: {e}")
+
+    def record(self, status: dict) -> None:
+        snapshot = {"time": time.time(), "status": status}
+        self.snapshots.append(snapshot)
+        if self.file:
+            self.file.write(json.dumps(snapshot, separators=(",", ":")) + "\n")
+
+    def dump(self) -> str:
+        """
+        Write the ring buffer out in full.
+
+        Returns:
+            str: The path of the file written
+        """
+        path = f"/tmp/{self.file_name_stub}.json"
+        with open(path, "w") as f:
+            f.write(json.dumps(list(self.snapshots), indent=4))
+        print(f"{worker_name} - the last {len(self.snapshots)} status snapshots of job {self.job_id} were saved to {path}")
+        return path
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+
 class OutputStreamer:
-    def __init__(self, output_files_path_stub, job_id, metadata):
+    def __init__(self, output_files_path_stub, job_id, metadata, previews=False):
         self.output_files_path_stub = output_files_path_stub
         self.job_id = job_id
         self.metadata = metadata
-        self.output_images = {}
+        # All the bookkeeping is by source file: a file is returned under another name when it is transcoded, or under its own when that fails
+        self.output_images = {} # source path -> image returned
         self.output_images_lock = threading.Lock()
+        self.errors = [] # per-file upload failures, as of the last call
+        # Without a watcher, every poll globs and re-processes all the files
+        self.watcher = OutputWatcher(output_files_path_stub) if OUTPUT_WATCHER != "glob" else None
+        self.completed_files = [] # from the watcher, in order of completion
+        self.transcode = output_transcode(metadata) if get_transcode_pool() else None
+        self.preview_pool = get_preview_pool() if previews else None
+        self.preview_futures = {} # source path -> Future of its preview
+        self.previews_sent = set() # source paths
+
+    def output_files(self) -> list:
+        """
+        Every output file so far, as process_output_images() would glob them.
+        """
+        return sorted((f for f in glob.glob(f"{self.output_files_path_stub}*") if os.path.isfile(f) and not f.endswith(".mp4") and not f.endswith(".txt")), key=os.path.basename)
+
+    def collect(self, final=False):
+        """
+        Pick up the files completed since the last call (with the watcher).
+        """
+        if self.watcher:
+            self.completed_files += self.watcher.poll(final=final)
 
-    def get_new_images(self):
+    def image_name(self, path: str):
+        """
+        The name that a file is returned under, or None while that is not known yet, i.e. while it is being transcoded.
+        """
+        with self.output_images_lock:
+            if path in self.output_images:
+                return self.output_images[path]["name"]
+        if not self.transcode or not path.lower().endswith(".png"):
+            return os.path.basename(path)
+        with output_transcode_lock:
+            future = output_transcodes.get(self.job_id, {}).get(path)
+        if future is None or not future.done():
+            return None
+        return output_name(path, self.transcode) if future.exception() is None else os.path.basename(path)
+
+    def submit_previews(self) -> list:
+        """
+        Start making the previews of the files that do not have one yet, and transcoding them, so that the previews can be named after the full-resolution images. A failure only costs the previews, never the full-resolution images.
+
+        Returns:
+            list: The futures that the previews not returned yet are waiting for
+        """
+        files = self.completed_files if self.watcher else self.output_files()
+        for path in files:
+            if path in self.preview_futures or is_video(path):
+                continue
+            try:
+                self.preview_futures[path] = self.preview_pool.submit(make_preview, path, PREVIEW_MAX_SIZE, PREVIEW_FORMAT, PREVIEW_QUALITY)
+            except Exception as e:
+                print(f"{worker_name} - Warning - Could not make a preview of {os.path.basename(path)} -- {e.__class__.__name__}: {e}")
+                break
+        waiting = [path for path in self.preview_futures if path not in self.previews_sent]
+        transcodes = {}
+        if self.transcode:
+            try:
+                transcodes = start_transcodes(waiting, self.job_id, self.transcode)
+            except Exception as e:
+                print(f"{worker_name} - Warning - Could not start transcoding the outputs -- {e.__class__.__name__}: {e}")
+        return [self.preview_futures[path] for path in waiting] + [future for future in transcodes.values() if future is not None]
+
+    def get_new_previews(self, timeout=PREVIEW_WAIT_MS / 1000):
+        """
+        Return the previews that have not been returned yet, waiting for at most `timeout` seconds for those of the frames that have just landed. A preview has the same `name` as its full-resolution image (transcoded or not).
+        """
+        self.collect()
+        pending = self.submit_previews()
+        if pending:
+            wait_for_futures(pending, timeout=timeout)
+        previews = []
+        for path, future in self.preview_futures.items():
+            if path in self.previews_sent or not future.done():
+                continue
+            name = self.image_name(path)
+            if name is None:
+                continue
+            self.previews_sent.add(path)
+            try:
+                previews.append({"name": name, "url": future.result()})
+            except Exception as e:
+                print(f"{worker_name} - Warning - Could not make a preview of {name} -- {e.__class__.__name__}: {e}")
+        count_metric("previews", len(previews))
+        return previews
+
+    def get_new_images(self, wait=False):
         """
         This is a very ingenious wrapper around process_output_images() that yields any new images as they are generated.
+
+        Unless `wait` is set, images that are still being uploaded to S3 are not waited for; they will be yielded by a later call, so the uploads overlap with the generation.
         """
         try:
-            images_result = process_output_images(self.output_files_path_stub, self.job_id, self.metadata)
+            if self.watcher:
+                self.collect(final=wait)
+                with self.output_images_lock:
+                    # Including the ones whose upload was still in progress last time
+                    outputs = [path for path in self.completed_files if path not in self.output_images]
+                if not outputs:
+                    return
+            else:
+                outputs = self.output_files()
+            images_result = process_output_images(outputs, self.job_id, self.metadata, wait=wait)
+            self.errors = images_result.get("errors", [])
             if images_result["status"] == "success":
+                # Back from the names to the files: transcoded, or returned as they are
+                sources = {output_name(path, self.transcode): path for path in outputs}
+                sources.update({os.path.basename(path): path for path in outputs})
                 for image in images_result["images"]:
+                    source = sources.get(image["name"], image["name"])
                     with self.output_images_lock:
-                        if image["name"] not in self.output_images:
-                            self.output_images[image["name"]] = image
+                        if source not in self.output_images:
+                            self.output_images[source] = image
                             yield image
         except Exception as e:
             print(f"{worker_name} - Error streaming output for job {self.job_id} in directory {self.output_files_path_stub}: {e}")
     
     def get_all_images(self):
         """
-        Return any previously returned images, plus any new images that have been generated since the last call to get_new_images().
+        Return any previously returned images, plus any new images that have been generated since the last call to get_new_images(), in the same order as process_output_images() would.
         """
-        for _ in self.get_new_images():
+        for _ in self.get_new_images(wait=True):
             pass
         with self.output_images_lock:
-            return [self.output_images[image_name] for image_name in self.output_images]
+            return sorted(self.output_images.values(), key=lambda image: image["name"])
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+
+class PollScheduler:
+    """
+    Decides how long to wait between polls of the backend, instead of always waiting COMFY_POLLING_INTERVAL_MS.
+
+    - Right after the job has been queued, we poll quickly, backing off geometrically, so that short jobs are picked up promptly.
+    - When we can estimate the time to completion, we poll at a quarter of it, so that we poll quickly near the expected finish. The estimate comes from the progress reported by the backend (Deforum's `phase_progress`, ComfyUI's `progress` events), or failing that, from how long previous jobs on this worker took.
+    - Otherwise, during long steady phases, we keep backing off, up to COMFY_POLLING_MAX_INTERVAL_MS.
+
+    The intervals actually used are summarized by cadence(), which the handler attaches to the job output.
+
+    As the intervals vary, COMFY_POLLING_MAX_RETRIES no longer bounds how long we wait; instead, we give up once we have waited as long as COMFY_POLLING_MAX_RETRIES polls at COMFY_POLLING_INTERVAL_MS would have taken (see timed_out()).
+    """
+    GROWTH = 1.5
+    expected_duration = None # seconds; an exponentially weighted moving average over the previous jobs on this worker
+
+    def __init__(self, min_interval_ms=POLLING_MIN_INTERVAL_MS, max_interval_ms=POLLING_MAX_INTERVAL_MS, max_wait_ms=SERVER_POLLING_MAX_RETRIES * SERVER_POLLING_INTERVAL_MS):
+        self.min_interval = min_interval_ms / 1000
+        self.max_interval = max(max_interval_ms, min_interval_ms) / 1000
+        self.max_wait = max_wait_ms / 1000
+        self.start = time.monotonic()
+        self.interval = None
+        self.intervals = []
+        self.phase = None
+        self.samples = [] # (time, fraction) within the current phase
+
+    def observe(self, fraction, phase=None) -> None:
+        """
+        Record the progress of the job.
+
+        Args:
+            fraction (float): 0..1, or None if unknown
+            phase: Progress restarts from 0 whenever the phase changes
+        """
+        if phase != self.phase:
+            self.phase = phase
+            self.samples = []
+        if fraction is not None:
+            self.samples = (self.samples + [(time.monotonic(), fraction)])[-2:]
+
+    def estimate_remaining(self):
+        """
+        Returns:
+            float: Seconds until the job (or its current phase) is expected to finish, or None if we cannot tell
+        """
+        if len(self.samples) == 2:
+            (t0, f0), (t1, f1) = self.samples
+            if f1 > f0 and t1 > t0:
+                return (1 - f1) * (t1 - t0) / (f1 - f0)
+        if PollScheduler.expected_duration is not None:
+            remaining = PollScheduler.expected_duration - (time.monotonic() - self.start)
+            if remaining > 0:
+                return remaining
+        return None
+
+    def next_interval(self) -> float:
+        """
+        Returns:
+            float: Seconds to wait before the next poll
+        """
+        remaining = self.estimate_remaining()
+        if self.interval is None:
+            interval = self.min_interval
+        elif remaining is not None:
+            interval = remaining / 4
+        else:
+            interval = self.interval * self.GROWTH
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals.append(self.interval)
+        return self.interval
+
+    def timed_out(self) -> bool:
+        """
+        Whether we have waited for the job for longer than the fixed polling interval would have allowed.
+        """
+        return time.monotonic() - self.start >= self.max_wait
+
+    def finish(self) -> None:
+        """
+        Call when the job has finished successfully, to refine the expected duration of the next jobs.
+        """
+        duration = time.monotonic() - self.start
+        previous = PollScheduler.expected_duration
+        PollScheduler.expected_duration = duration if previous is None else 0.7 * previous + 0.3 * duration
+
+    def cadence(self) -> dict:
+        if not self.intervals:
+            return {"polls": 0}
+        return {
+            "polls": len(self.intervals),
+            "mean_interval_ms": round(1000 * sum(self.intervals) / len(self.intervals)),
+            "min_interval_ms": round(1000 * min(self.intervals)),
+            "max_interval_ms": round(1000 * max(self.intervals)),
+        }
 
 def handler(job):
     """
@@ -907,55 +3288,129 @@ def handler(job):
         dict: A dictionary containing either an error message or a success status with generated images.
     """
     print("handler()", job)
+    job_metrics = JobMetrics(enabled=JOB_METRICS or metrics_registry is not None, attach=JOB_METRICS)
+    def with_metrics(result):
+        """
+        The job's final result, with its metrics if they were asked for.
+        """
+        job_metrics.finish(result)
+        return {**result, "metrics": job_metrics.report()} if job_metrics.attach else result
     try:
         timestamp = JobTimestamp.start_job()
         job_input = job["input"]
         runpod_job_id = job.get("id")
 
+        # Interrupt the backend as soon as the job is cancelled, rather than at the next poll
+        backend_job = {} # "id": the backend's job ID, once we know it; "cancelled": whether the watcher has cancelled it already
+        cancel_requested = threading.Event() # cuts the wait between polls short
+        def on_cancel():
+            cancel_requested.set()
+            if SERVICE_TYPE == "a1111" or backend_job.get("id"):
+                cancel_job(backend_job.get("id"))
+                backend_job["cancelled"] = True
+        if get_cancellation_watcher() and runpod_job_id:
+            cancellation_watcher.register(runpod_job_id, on_cancel)
+
         raise_for_cancel(runpod_job_id)
 
         # Make sure that the input is valid
         validated_data, error_message = validate_input(job_input)
         if error_message:
-            yield {"error": error_message}
+            yield with_metrics({"error": error_message})
             return
 
         # Extract validated data
         workflow = validated_data["workflow"]
         images = validated_data.get("images")
         metadata = validated_data.get("metadata")
+        if metadata.get("metrics"):
+            job_metrics.enabled = job_metrics.attach = True
+
+        # Download the images given by URL; they are pinned in the cache until they have been uploaded
+        with job_metrics.active("fetch_images"):
+            fetch_result = fetch_images(images)
+        if fetch_result["status"] == "error":
+            yield with_metrics(fetch_result)
+            return
+        images = fetch_result["images"]
+        pinned_inputs = fetch_result["pinned"]
+
+        # An identical job has been run before, return its result
+        with job_metrics.active("result_cache"):
+            result_cache_key = result_cache.key(workflow, images, metadata) if result_cache is not None and result_cache.cacheable(workflow, metadata) else None
+            cached_result = result_cache.lookup(result_cache_key) if result_cache_key else None
+        if cached_result is not None:
+            print(f"{worker_name} - Returning the cached result of an identical job")
+            yield with_metrics({**cached_result, "cached": True, "refresh_worker": REFRESH_WORKER})
+            return
 
         # Make sure that the ComfyUI API is available
-        check_server(
-            # Note we use the deforum API endpoint's existence as a proxy for the webui being up and not having crashed on startup (it gets reloaded on crash, but if we just check the normal API endpoint, we often catch it while it still has not crashed yet)
-            f"http://{SERVER_HOST}" + ("/deforum_api/jobs" if SERVICE_TYPE in ["deforum", "a1111"] else ""),
-            SERVER_API_AVAILABLE_MAX_RETRIES,
-            SERVER_API_AVAILABLE_INTERVAL_MS,
-        )
+        with job_metrics.active("check_server"):
+            if get_backend_health():
+                backend_health.wait_ready(SERVER_API_AVAILABLE_MAX_RETRIES * SERVER_API_AVAILABLE_INTERVAL_MS / 1000)
+            else:
+                check_server(
+                    # Note we use the deforum API endpoint's existence as a proxy for the webui being up and not having crashed on startup (it gets reloaded on crash, but if we just check the normal API endpoint, we often catch it while it still has not crashed yet)
+                    f"http://{SERVER_HOST}" + ("/deforum_api/jobs" if SERVICE_TYPE in ["deforum", "a1111"] else ""),
+                    SERVER_API_AVAILABLE_MAX_RETRIES,
+                    SERVER_API_AVAILABLE_INTERVAL_MS,
+                )
 
         # Upload images if they exist
-        upload_result = upload_images(images)
+        with job_metrics.active("upload_images"):
+            upload_result = upload_images(images)
+        if pinned_inputs:
+            input_url_cache.release(pinned_inputs)
+            pinned_inputs = []
 
         if upload_result["status"] == "error":
-            yield upload_result
+            yield with_metrics(upload_result)
             return
 
+        # Do not queue a job that has been cancelled in the meantime
+        raise_for_cancel(runpod_job_id)
+
+        # Subscribe to the ComfyUI events before queueing, so that we do not miss any
+        comfy_events = get_comfy_event_stream()
+        comfy_events_epoch = comfy_events.current_epoch() if comfy_events else None
+
+        # Drop the stale cached models before ComfyUI can load them
+        model_cache_models = None
+        if model_cache is not None:
+            try:
+                model_cache_models = model_cache.revalidate(workflow)
+            except Exception as e:
+                print(f"{worker_name} - Warning - Model cache -- {e.__class__.__name__}: {e}")
+
         # Queue the workflow
         lastlog, queued_workflow = None, None
+        backend_restarts = backend_health.restarts if backend_health else None
         try:
-            lastlog, queued_workflow = queue_workflow(workflow)
+            # The A1111 API is synchronous, the whole generation happens here
+            with job_metrics.active("execution" if SERVICE_TYPE == "a1111" else "queue"):
+                lastlog, queued_workflow = queue_workflow(workflow, client_id=comfy_events.client_id if comfy_events_epoch is not None else None)
+            queued_at = time.perf_counter()
             if SERVICE_TYPE == "comfyui":
                 job_id = queued_workflow["prompt_id"]
+                backend_job["id"] = job_id
                 timestamp.set_job_id(job_id)
+                if model_cache_models:
+                    try:
+                        model_cache.observe(model_cache_models)
+                    except Exception as e:
+                        print(f"{worker_name} - Warning - Model cache -- {e.__class__.__name__}: {e}")
             elif SERVICE_TYPE == "deforum":
                 if "error" in queued_workflow:
                     print(f"{worker_name} - Error: queued_workflow is already the error response:", queued_workflow)
-                    yield queued_workflow
+                    yield with_metrics(queued_workflow)
                     return
                 job_id = queued_workflow["job_ids"][0]
+                backend_job["id"] = job_id
                 timestamp.set_job_id(job_id)
             elif SERVICE_TYPE == "a1111":
                 # The sdapi API is synchronous, so we just return the result here straight away
+                # ...unless it was interrupted, in which case the result is partial
+                raise_for_cancel(runpod_job_id)
 
                 # Get the logging out of the way, we will not come back to it later
                 time.sleep(1) # allow log to be written to disk
@@ -969,10 +3424,20 @@ def handler(job):
                 try:
                     # SDAPI does not give us image names, only image data
                     images = []
-                    for i, base64_encoded_png_data in enumerate(result["images"]):
+                    fake_job_ids = []
+                    for base64_encoded_png_data in result["images"]:
                         fake_job_id = uuid.uuid4().hex # This serves as the unique path within the S3 bucket, so it must be something random
                         timestamp.set_job_id(fake_job_id, is_fake=True)
-                        url = upload_png_to_s3(fake_job_id, base64_encoded_png_data, metadata) if SAVE_TO_S3 else f"data:image/png;base64,{base64_encoded_png_data}"
+                        fake_job_ids.append(fake_job_id)
+                    with job_metrics.active("outputs"):
+                        if SAVE_TO_S3:
+                            # Straight from memory, and concurrently; map() keeps the order
+                            urls = list(s3_upload_executor.map(in_job_context(lambda args: upload_png_to_s3(*args, metadata)), zip(fake_job_ids, result["images"])))
+                        else:
+                            urls = [f"data:image/png;base64,{base64_encoded_png_data}" for base64_encoded_png_data in result["images"]]
+                            count_metric("data_url_bytes", sum(len(url) for url in urls))
+                        count_metric("output_files", len(urls))
+                    for i, url in enumerate(urls):
                         assert url.startswith("https:") or url.startswith("data:"), f"Invalid URL: {url}"
                         images.append({
                             "name": f"image_{i:04d}.png",
@@ -980,58 +3445,79 @@ def handler(job):
                         })
                     if not images:
                         raise ValueError("No images generated")
+                    if result_cache_key and "error" not in result:
+                        result_cache.add(result_cache_key, {"status": "success", "images": images})
                 except Exception as e:
                     yield {"error": f"Error processing output images -- {e.__class__.__name__}: {str(e)}"}
-                yield {"status": "success", "images": images}
+                yield with_metrics({"status": "success", "images": images})
                 return
             print(f"{worker_name} - queued workflow with ID {job_id}")
+        except JobCancelledException as e:
+            raise e
         except Exception as e:
             traceback_str = traceback.format_exc()
-            yield {"error": f"Error queuing workflow -- {e.__class__.__name__}: {str(e)}", "traceback": traceback_str, "workflow": workflow, "queued_workflow": queued_workflow}
+            yield with_metrics({"error": f"Error queuing workflow -- {e.__class__.__name__}: {str(e)}", "traceback": traceback_str, "workflow": workflow, "queued_workflow": queued_workflow})
             return
 
         # Poll for completion
         print(f"{worker_name} - wait until image generation is complete")
         retries = 0
         images_result = {}
+        settle_polls = 0
+        poll_scheduler = PollScheduler() if POLLING_ADAPTIVE else None
         try:
-            while retries < SERVER_POLLING_MAX_RETRIES:
-                runpod.serverless.progress_update(job, {'log': lastlog.get_log(last_only=False)})
+            while not poll_scheduler.timed_out() if poll_scheduler else retries < SERVER_POLLING_MAX_RETRIES:
+                # The event stream can only be trusted if it has stayed connected since the prompt was queued
+                prompt_events = comfy_events.get(job_id) if COMFY_USE_WEBSOCKET and comfy_events_epoch is not None and comfy_events.current_epoch() == comfy_events_epoch else None
+                runpod.serverless.progress_update(job, {'log': lastlog.get_log(last_only=False), **({'progress': prompt_events.progress()} if prompt_events and prompt_events.progress() else {})})
                 raise_for_cancel(runpod_job_id)
-                if SERVICE_TYPE == "comfyui":
-                    history = get_comfyui_history(job_id)
+                if backend_health and backend_health.restarts != backend_restarts:
+                    # The job went down with the backend, and will never finish
+                    yield with_metrics({"error": "Image generation failed -- the backend restarted while the job was running"})
+                    return
+                if poll_scheduler and prompt_events and prompt_events.max:
+                    poll_scheduler.observe(prompt_events.value / prompt_events.max, phase=prompt_events.node)
+                if SERVICE_TYPE == "comfyui" and prompt_events and not prompt_events.finished.is_set():
+                    pass # Nothing to do until ComfyUI tells us that the prompt has finished, see the wait below
+                elif SERVICE_TYPE == "comfyui":
+                    with job_metrics.active():
+                        history = get_comfyui_history(job_id)
+                        count_metric("backend_polls")
 
                     # Exit the loop if we have found the history or encountered an error
                     if job_id in history and history[job_id].get("outputs"):
-                        images_result = process_output_images(history[job_id].get("outputs"), job_id, metadata)
+                        with job_metrics.active("outputs"):
+                            images_result = process_output_images(history[job_id].get("outputs"), job_id, metadata)
                         break
                     else:
                         try:
                             if history[job_id]["status"]["status_str"] in ["error"]:
-                                yield {"error": "Image generation failed -- ComfyUI workflow failed unexpectedly", "full_response": history[job_id]}
+                                yield with_metrics({"error": "Image generation failed -- ComfyUI workflow failed unexpectedly", "full_response": history[job_id]})
                                 return
                         except:
                             pass
                 elif SERVICE_TYPE == "deforum":
-                    job_status = get_deforum_job_status(job_id)
+                    with job_metrics.active():
+                        job_status = get_deforum_job_status(job_id)
+                        count_metric("backend_polls")
                     output_path_stub = construct_output_path_stub(job_status)
-                    try:
-                        __index__ += 1
-                    except NameError:
-                        __index__ = 0
-                    with open(f"/tmp/{job_id}_status{__index__:06d}.json", "w") as f:
-                        f.write(json.dumps(job_status, indent=4))
-                        print(f"DEBUG: job status saved to {f.name}")
+                    if "status_journal" not in locals():
+                        status_journal = StatusJournal(job_id)
+                    status_journal.record(job_status)
+                    if poll_scheduler:
+                        poll_scheduler.observe(job_status.get("phase_progress"), phase=job_status.get("phase"))
                     if job_status["status"] == "FAILED":
-                        yield {"error": "Image generation failed", "full_response": job_status}
+                        status_journal.dump()
+                        yield with_metrics({"error": "Image generation failed", "full_response": job_status})
                         return
                     elif job_status["status"] == "SUCCEEDED":
-                        if "output_streamer" in locals():
-                            images = output_streamer.get_all_images()
-                            images_result = { **({"images": images} if images else {}), "streamed": True }
-                        else:
-                            assert output_path_stub, "Output directory not found even tough job is SUCCEEDED"
-                            images_result = process_output_images(output_path_stub, job_id, metadata)
+                        with job_metrics.active("outputs"):
+                            if "output_streamer" in locals():
+                                images = output_streamer.get_all_images()
+                                images_result = { **({"images": images} if images else {}), **({"errors": output_streamer.errors} if output_streamer.errors else {}), "streamed": True }
+                            else:
+                                assert output_path_stub, "Output directory not found even tough job is SUCCEEDED"
+                                images_result = process_output_images(output_path_stub, job_id, metadata)
                         break
                     elif STREAM_OUTPUT:
                         stream_res = {}
@@ -1040,8 +3526,15 @@ def handler(job):
                                 if not output_path_stub:
                                     # The output directory does not exist yet, this is expected while the job has not been started in earnest
                                     raise ValueError("Output directory not found")
-                                output_streamer = OutputStreamer(output_path_stub, job_id, metadata)
-                            images = [image for image in output_streamer.get_new_images()]
+                                output_streamer = OutputStreamer(output_path_stub, job_id, metadata, previews=metadata.get("previews", PREVIEWS))
+                            if output_streamer.preview_pool:
+                                with job_metrics.active("outputs"):
+                                    previews = output_streamer.get_new_previews()
+                                if previews:
+                                    # Ahead of the full-resolution frames, which may have to be encoded or uploaded first
+                                    yield {"previews": previews}
+                            with job_metrics.active("outputs"):
+                                images = [image for image in output_streamer.get_new_images()]
                             if images:
                                 stream_res = { "images": images }
                         except Exception as e:
@@ -1056,22 +3549,45 @@ def handler(job):
                 else:
                     raise ValueError("Invalid SERVICE_TYPE")
                 # Wait before trying again
-                time.sleep(SERVER_POLLING_INTERVAL_MS / 1000)
+                polling_interval = poll_scheduler.next_interval() if poll_scheduler else SERVER_POLLING_INTERVAL_MS / 1000
+                if prompt_events and not prompt_events.finished.is_set():
+                    # Returns as soon as the prompt finishes
+                    prompt_events.finished.wait(polling_interval)
+                elif prompt_events:
+                    # ComfyUI announces completion just before it writes the history, so poll /history quickly for a bit
+                    cancel_requested.wait(min(polling_interval, 0.025 * 2 ** settle_polls))
+                    settle_polls += 1
+                else:
+                    cancel_requested.wait(polling_interval)
                 retries += 1
             else:
-                yield {"error": "Max retries reached while waiting for image generation"}
+                yield with_metrics({"error": "Max retries reached while waiting for image generation"})
                 return
         except JobCancelledException as e:
             raise e
         except Exception as e:
-            yield {"error": f"Error waiting for image generation: {str(e)}"}
+            if "status_journal" in locals():
+                status_journal.dump()
+            yield with_metrics({"error": f"Error waiting for image generation: {str(e)}"})
             return
+        # Whatever time the job spent after queueing that was not spent on the outputs, it spent waiting for the backend
+        job_metrics.add_time("execution", time.perf_counter() - queued_at - job_metrics.phases.get("outputs", 0.0))
         # Get the generated image and return it as URL in an AWS bucket or as base64
         result = {**images_result, "refresh_worker": REFRESH_WORKER}
+        if poll_scheduler:
+            poll_scheduler.finish()
+            result["poll_cadence"] = poll_scheduler.cadence()
+        if result_cache_key and result.get("status") == "success" and not result.get("errors") and not result.get("pending"):
+            result_cache.add(result_cache_key, result)
     except JobCancelledException as e:
-        if "job_id" in locals():
+        if "job_id" in locals() and not backend_job.get("cancelled"):
             cancel_job(job_id) if SERVICE_TYPE in ["comfyui", "deforum"] else None
         result = {"status": "cancelled", "message": f"Cancelled by user - {e}"}
+        job_metrics.finish(result)
+    except GeneratorExit:
+        # The job was abandoned half-way, e.g. its task was cancelled (see concurrent_handler())
+        job_metrics.finish({"status": "cancelled"})
+        raise
     except Exception as e:
         # stringify and jsonify the trackback
         traceback_str = traceback.format_exc()
@@ -1079,20 +3595,443 @@ def handler(job):
     finally:
         # Clean up
         try:
-            s3_url_cache.pop(job_id, None)
+            with s3_upload_lock:
+                s3_url_cache.pop(job_id, None)
+                s3_upload_futures.pop(job_id, None)
+            abort_multipart_uploads(job_id)
+            remove_transcoded_outputs(job_id)
         except:
             pass
+        if cancellation_watcher is not None and "runpod_job_id" in locals():
+            cancellation_watcher.unregister(runpod_job_id)
+        if locals().get("pinned_inputs"):
+            input_url_cache.release(pinned_inputs)
+        if "output_streamer" in locals():
+            output_streamer.close()
+        if "status_journal" in locals():
+            status_journal.close()
+        if comfy_event_stream is not None and "job_id" in locals():
+            comfy_event_stream.forget(job_id)
+        if "result" not in locals():
+            # An exception that is not the job's, e.g. KeyboardInterrupt
+            job_metrics.finish(None)
         # TODO clean up the respective output directories
+    result = with_metrics(result)
     print(f"{worker_name} - Done - {result}")
     yield result
     return {"status": result["status"] if "status" in result else "done"} # XXX the yield ought to be enough, why are we returning this?
 
+async def concurrent_handler(job):
+    """
+    Runs handler() in a thread, for when the worker accepts several jobs at once (COMFY_JOB_CONCURRENCY).
+
+    The RunPod SDK iterates a synchronous generator on its event loop, so each job would block all the others. Here we advance the generator in a thread instead, so that e.g. the next job's prompt is already queued while the previous job's outputs are still being post-processed.
+
+    All per-job state (the JobTimestamp, s3_url_cache entries, the cancellation state) is keyed by job, or local to handler(). Each job has its own LastLog, but the backends write one shared log: only ComfyUI's, demultiplexed by prompt (COMFY_LOG_DEMUX), is split exactly; otherwise a job's log may include the lines of jobs that ran at the same time.
+
+    If the job is abandoned half-way (e.g. the task is cancelled), the generator is closed, so that handler() still cleans up after the job.
+    """
+    outputs = handler(job)
+    done = object()
+    advancing = threading.Lock() # a generator cannot be closed while it is running
+    def advance():
+        with advancing:
+            return next(outputs, done)
+    def close():
+        with advancing:
+            outputs.close()
+    try:
+        while True:
+            output = await asyncio.to_thread(advance)
+            if output is done:
+                return
+            yield output
+    finally:
+        if advancing.acquire(blocking=False):
+            try:
+                outputs.close()
+            finally:
+                advancing.release()
+        else:
+            # Still running in its thread, which outlives the cancelled task; close it once it yields, without blocking the event loop
+            threading.Thread(target=close, name="close-job", daemon=True).start()
+
+class ModelCache:
+    """
+    A copy of the hot model files on the container's local disk, which reads several times faster than the network volume, and is searched by ComfyUI before the network volume (start.sh passes ComfyUI an extra model paths config with `is_default`, for the folders in MODEL_CACHE_FOLDERS).
+
+    The models that each workflow uses are copied in the background, after the job has been queued (ComfyUI has probably pulled the file into the page cache by then, so the copy is cheap). The usage is also appended to a log on the network volume, so that a fresh worker can warm its cache with the models that were used most recently, before its first job.
+
+    The cache is bounded by COMFY_MODEL_CACHE_MAX_BYTES, least recently used files are evicted first. A file is only put in place (atomically, by rename) once its copy has been read back and matched the SHA-256 of the source. A cached file whose source has changed is dropped before the job that uses it is queued (see revalidate()), so that ComfyUI never loads the stale copy. The cache found on disk at startup is moved out of ComfyUI's sight, and each file is only put back once it has been verified (see verify_existing()).
+    """
+    MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".sft", ".gguf")
+    CHUNK_SIZE = 8 * 1024 * 1024
+    USAGE_TAIL_BYTES = 1024 * 1024 # how much of the usage log to look at when warming, i.e. the recent usage
+
+    def __init__(self, cache_dir: str, source_dir: str, max_bytes: int, usage_file: str):
+        self.cache_dir = cache_dir
+        self.source_dir = source_dir
+        self.max_bytes = max_bytes
+        self.usage_file = usage_file
+        self.meta_dir = os.path.join(cache_dir, ".meta")
+        self.tmp_dir = os.path.join(cache_dir, ".tmp")
+        self.unverified_dir = os.path.join(cache_dir, ".unverified")
+        self.entries = OrderedDict() # relative path -> size, least recently used first
+        self.pending = set() # relative paths being copied
+        self.lock = threading.Lock()
+        # One copy at a time, not to compete with the backend for the network volume
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-cache")
+        os.makedirs(self.meta_dir, exist_ok=True)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # Before any job is queued, i.e. before ComfyUI can load any of it
+        self.set_aside_existing()
+        self.executor.submit(self.verify_existing)
+
+    def cached_path(self, rel: str) -> str:
+        return os.path.join(self.cache_dir, rel)
+
+    def meta_path(self, rel: str) -> str:
+        return os.path.join(self.meta_dir, rel + ".json")
+
+    def models_used(self, workflow: dict) -> list:
+        """
+        Returns:
+            list: The model files referenced by the workflow's node inputs, as paths relative to the models directory
+        """
+        used = []
+        for node in workflow.values():
+            inputs = node.get("inputs") if isinstance(node, dict) else None
+            if not isinstance(inputs, dict):
+                continue
+            for value in inputs.values():
+                if not isinstance(value, str) or not value.lower().endswith(self.MODEL_EXTENSIONS) or value.startswith("/") or ".." in value.split("/"):
+                    continue
+                for folder in MODEL_CACHE_FOLDERS:
+                    rel = os.path.join(folder, value)
+                    if os.path.isfile(os.path.join(self.source_dir, rel)):
+                        used.append(rel)
+                        break
+        return used
+
+    def revalidate(self, workflow: dict) -> list:
+        """
+        Drop the cached copies of the workflow's models whose source has changed. Call before the workflow is queued, so that ComfyUI loads the source instead.
+
+        Returns:
+            list: The models that the workflow uses, for observe()
+        """
+        used = self.models_used(workflow)
+        with self.lock:
+            for rel in used:
+                if rel in self.entries and not self.is_fresh(rel):
+                    print(f"{worker_name} - {rel} has changed, dropping it from the model cache")
+                    self.evict(rel)
+        return used
+
+    def observe(self, used: list) -> None:
+        """
+        Note the models that a workflow uses (see revalidate()), and cache the ones that are not cached yet.
+        """
+        if not used:
+            return
+        try:
+            with open(self.usage_file, "a") as f:
+                f.write("".join(json.dumps({"model": rel, "time": time.time()}, separators=(",", ":")) + "\n" for rel in used))
+        except OSError as e:
+            print(f"{worker_name} - Warning - Cannot record the model usage to {self.usage_file} -- {e.__class__.__name__}: {e}")
+        for rel in used:
+            self.request(rel)
+
+    def request(self, rel: str) -> None:
+        with self.lock:
+            if rel in self.entries:
+                self.entries.move_to_end(rel)
+                if self.is_fresh(rel):
+                    return
+                self.evict(rel)
+            if rel in self.pending:
+                return
+            self.pending.add(rel)
+        self.executor.submit(self.copy, rel)
+
+    def warm(self) -> None:
+        """
+        Cache the models that have been used most recently (by any worker), as far as they fit.
+        """
+        try:
+            with open(self.usage_file, "rb") as f:
+                offset = max(0, os.fstat(f.fileno()).st_size - self.USAGE_TAIL_BYTES)
+                f.seek(offset)
+                lines = f.read().decode("utf-8", errors="replace").splitlines()[1 if offset else 0:] # the first line is probably cut
+        except FileNotFoundError:
+            return
+        counts = {}
+        for line in lines:
+            try:
+                rel = json.loads(line)["model"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            counts[rel] = counts.get(rel, 0) + 1
+        budget = self.max_bytes
+        for rel in sorted(counts, key=counts.get, reverse=True):
+            try:
+                size = os.path.getsize(os.path.join(self.source_dir, rel))
+            except OSError:
+                continue
+            if size > budget:
+                continue
+            budget -= size
+            self.request(rel)
+
+    def is_fresh(self, rel: str, path: str = None) -> bool:
+        """
+        Whether the cached copy (at `path`, if it is not in place) still matches its source (by size and modification time; the content was checked when it was copied).
+        """
+        try:
+            with open(self.meta_path(rel), "r") as f:
+                meta = json.load(f)
+            st = os.stat(os.path.join(self.source_dir, rel))
+            return meta["source_size"] == st.st_size and meta["source_mtime"] == st.st_mtime and os.path.getsize(path or self.cached_path(rel)) == st.st_size
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def evict(self, rel: str) -> None:
+        """
+        Remove a file from the cache. Must be called with the lock held. (ComfyUI may still have it open, which is fine.)
+        """
+        self.entries.pop(rel, None)
+        for path in (self.cached_path(rel), self.meta_path(rel)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def make_room(self, size: int) -> bool:
+        with self.lock:
+            while self.entries and sum(self.entries.values()) + size > self.max_bytes:
+                rel, _ = next(iter(self.entries.items()))
+                print(f"{worker_name} - Evicting {rel} from the model cache")
+                self.evict(rel)
+            return sum(self.entries.values()) + size <= self.max_bytes
+
+    def hash_file(self, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def copy(self, rel: str) -> None:
+        source = os.path.join(self.source_dir, rel)
+        tmp = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            st = os.stat(source)
+            if st.st_size > self.max_bytes or st.st_size > shutil.disk_usage(self.cache_dir).free:
+                print(f"{worker_name} - Not caching {rel} ({st.st_size} bytes), it does not fit")
+                return
+            if not self.make_room(st.st_size):
+                return
+            start = time.time()
+            sha256 = hashlib.sha256()
+            with open(source, "rb") as src, open(tmp, "wb") as dst:
+                for chunk in iter(lambda: src.read(self.CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            if self.hash_file(tmp) != sha256.hexdigest():
+                raise IOError(f"The copy of {rel} does not match the source")
+            if os.stat(source).st_mtime != st.st_mtime:
+                raise IOError(f"{rel} was modified while it was being copied")
+            os.makedirs(os.path.dirname(self.cached_path(rel)), exist_ok=True)
+            os.makedirs(os.path.dirname(self.meta_path(rel)), exist_ok=True)
+            with open(self.meta_path(rel), "w") as f:
+                json.dump({"source_size": st.st_size, "source_mtime": st.st_mtime, "sha256": sha256.hexdigest()}, f)
+            os.replace(tmp, self.cached_path(rel))
+            with self.lock:
+                self.entries[rel] = st.st_size
+            print(f"{worker_name} - Cached {rel} ({st.st_size / 2**20:.1f} MiB) in {time.time() - start:.2f}s")
+        except Exception as e:
+            print(f"{worker_name} - Warning - Failed to cache {rel} -- {e.__class__.__name__}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(rel)
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+
+    def set_aside_existing(self) -> None:
+        """
+        Move the files already in the cache (e.g. if the worker has been restarted) out of the folders that ComfyUI searches, until verify_existing() has checked them.
+        """
+        for folder in MODEL_CACHE_FOLDERS:
+            for root, _, files in os.walk(os.path.join(self.cache_dir, folder)):
+                for name in files:
+                    path = os.path.join(root, name)
+                    unverified = os.path.join(self.unverified_dir, os.path.relpath(path, self.cache_dir))
+                    os.makedirs(os.path.dirname(unverified), exist_ok=True)
+                    # Keeps the modification time, our best guess at LRU order
+                    os.replace(path, unverified)
+
+    def verify_existing(self) -> None:
+        """
+        Adopt the files set aside at startup (see set_aside_existing()), provided that their content and source are unchanged, by moving them back into place. Anything else is removed.
+        """
+        found = []
+        for root, _, files in os.walk(self.unverified_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                found.append((os.path.getmtime(path), os.path.relpath(path, self.unverified_dir)))
+        for _, rel in sorted(found): # oldest first, which is our best guess at LRU order
+            unverified = os.path.join(self.unverified_dir, rel)
+            try:
+                with open(self.meta_path(rel), "r") as f:
+                    meta = json.load(f)
+                valid = self.is_fresh(rel, unverified) and self.hash_file(unverified) == meta["sha256"]
+            except (OSError, ValueError, KeyError):
+                valid = False
+            with self.lock:
+                if valid and rel not in self.entries:
+                    os.makedirs(os.path.dirname(self.cached_path(rel)), exist_ok=True)
+                    os.replace(unverified, self.cached_path(rel))
+                    self.entries[rel] = os.path.getsize(self.cached_path(rel))
+                else:
+                    print(f"{worker_name} - Removing invalid or stale {rel} from the model cache")
+                    if rel not in self.entries:
+                        self.evict(rel)
+                    os.remove(unverified)
+        shutil.rmtree(self.unverified_dir, ignore_errors=True)
+
+model_cache = None # started by init_server()
+
+def read_warmup_manifest(manifest_file: str) -> list:
+    """
+    Read the list of files to preload from the warm-up manifest:
+
+        {"preload": ["ComfyUI/models/checkpoints/model.safetensors", {"path": "ComfyUI/models/loras/*.safetensors", "critical": true}, ...]}
+
+    Paths are relative to /workspace, and may be glob patterns.
+
+    Returns:
+        list: (path, critical) tuples, the critical files first, each file only once
+    """
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    files = {}
+    for entry in manifest.get("preload", []):
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        paths = sorted(glob.glob(os.path.join("/workspace", entry["path"])))
+        if not paths:
+            print(f"{worker_name} - Warning - Nothing to preload at {entry['path']}")
+        for path in paths:
+            files[path] = files.get(path, False) or bool(entry.get("critical", False))
+    return sorted(files.items(), key=lambda item: not item[1])
+
+def available_memory():
+    """
+    Returns:
+        int: MemAvailable from /proc/meminfo, in bytes, or None if unknown
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def preload_file(path: str, buffer: bytearray) -> int:
+    """
+    Pull a file into the page cache, so that the backend finds it there when it loads the model.
+
+    posix_fadvise() starts the kernel's readahead, but it is only advisory, and network filesystems may ignore it, so we also read the file through.
+
+    Returns:
+        int: The number of bytes read
+    """
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                return total
+            total += n
+
+def preload_files(paths: list, phase: str) -> dict:
+    """
+    Preload files into the page cache, WARMUP_PRELOAD_CONCURRENCY at a time. Stops once the files would no longer fit in the available memory, because they would only evict each other.
+
+    Returns:
+        dict: The phase's timing, for the warm-up report
+    """
+    start = time.time()
+    budget = available_memory()
+    if budget is not None:
+        kept = []
+        for path in paths:
+            size = os.path.getsize(path)
+            if size > budget:
+                print(f"{worker_name} - Warning - Not preloading {path} ({size} bytes), it does not fit in the available memory")
+                continue
+            budget -= size
+            kept.append(path)
+        paths = kept
+    buffers = threading.local()
+    def preload(path):
+        if not hasattr(buffers, "buffer"):
+            buffers.buffer = bytearray(8 * 1024 * 1024)
+        try:
+            return preload_file(path, buffers.buffer)
+        except OSError as e:
+            print(f"{worker_name} - Warning - Failed to preload {path} -- {e.__class__.__name__}: {e}")
+            return 0
+    with ThreadPoolExecutor(max_workers=WARMUP_PRELOAD_CONCURRENCY, thread_name_prefix="preload") as executor:
+        total = sum(executor.map(preload, paths))
+    elapsed = time.time() - start
+    print(f"{worker_name} - Warm-up phase {phase}: preloaded {len(paths)} files, {total / 2**20:.1f} MiB in {elapsed:.2f}s ({total / 2**20 / max(elapsed, 1e-6):.1f} MiB/s)")
+    return {"phase": phase, "files": len(paths), "bytes": total, "seconds": round(elapsed, 3)}
+
 def init_server():
     """
     Initialize the server by running either:
       1. an empty job
       2. or, if present, all jobs (alphabetically) found in /workspace/worker-warmup/{SERVICE_TYPE}/*.json
+
+    Meanwhile, the model files listed in /workspace/worker-warmup/{SERVICE_TYPE}/manifest.json (see read_warmup_manifest()) are preloaded into the page cache, the critical ones first. We return once the critical files have been preloaded and the warm-up jobs have run, while the rest of the preload carries on in the background; with COMFY_WARMUP_ACCEPT_EARLY, we do not wait for the warm-up jobs either.
+
+    Returns:
+        list: The timing of each warm-up phase (complete only once the warm-up has finished)
     """
+    global model_cache, OUTPUT_FORMAT, PREVIEW_FORMAT
+    if PREVIEW_FORMAT not in PREVIEW_FORMATS:
+        print(f"{worker_name} - Warning - COMFY_PREVIEW_FORMAT={PREVIEW_FORMAT} is not one of {', '.join(PREVIEW_FORMATS)}, the previews are made in {PREVIEW_FORMATS[0]}")
+        PREVIEW_FORMAT = PREVIEW_FORMATS[0]
+    if OUTPUT_FORMAT not in ("",) + OUTPUT_FORMATS:
+        print(f"{worker_name} - Warning - COMFY_OUTPUT_FORMAT={OUTPUT_FORMAT} is not one of {', '.join(OUTPUT_FORMATS)}" + (" (Pillow is not installed)" if Image is None else "") + ", the outputs are returned as they are")
+        OUTPUT_FORMAT = ""
+    # Here rather than at import time, as the pools' processes import this module again (see WorkerPool)
+    if MODEL_CACHE_DIR and SERVICE_TYPE == "comfyui":
+        model_cache = ModelCache(MODEL_CACHE_DIR, MODEL_CACHE_SOURCE, MODEL_CACHE_MAX_BYTES, MODEL_CACHE_USAGE_FILE)
+    if metrics_registry is not None and METRICS_PORT:
+        metrics_registry.serve(METRICS_PORT)
+    # Start watching the backend while it is still starting up
+    get_backend_health()
+    if PREVIEWS and SERVICE_TYPE == "deforum" and get_preview_pool():
+        # Start the preview processes now, rather than in the middle of a job
+        preview_pool.submit(int).result()
+    if OUTPUT_FORMAT not in ("", "png") and SERVICE_TYPE in ["comfyui", "deforum"] and get_transcode_pool():
+        transcode_pool.submit(int).result()
+
     def run_job(job):
         print(f"{worker_name} - Running warm-up job {job} -- because it is a warm-up job, errors will be ignored...")
         try:
@@ -1102,11 +4041,37 @@ def init_server():
             print(f"... caught exception: {e.__class__.__name__}: {e}")
 
     warmup_dir = f"/workspace/worker-warmup/{SERVICE_TYPE}"
+    manifest_file = os.path.join(warmup_dir, "manifest.json")
     jobs_to_run = []
-    
+    timings = []
+    warmup_start = time.time()
+
+    # Start preloading the model files straight away, the warm-up jobs are about to need them
+    preload = []
+    if os.path.isfile(manifest_file):
+        try:
+            preload = read_warmup_manifest(manifest_file)
+        except Exception as e:
+            print(f"{worker_name} - Warning - Invalid warm-up manifest {manifest_file} -- {e.__class__.__name__}: {e}")
+    critical_ready = threading.Event()
+    def run_preload():
+        try:
+            critical = [path for path, is_critical in preload if is_critical]
+            if critical:
+                timings.append(preload_files(critical, "preload_critical"))
+        finally:
+            critical_ready.set()
+        rest = [path for path, is_critical in preload if not is_critical]
+        if rest:
+            timings.append(preload_files(rest, "preload"))
+    preload_thread = threading.Thread(target=run_preload, name="preload", daemon=True)
+    preload_thread.start()
+    if model_cache is not None:
+        model_cache.executor.submit(model_cache.warm)
+
     # Check if the directory exists and has job files
     if os.path.isdir(warmup_dir):
-        jobs = sorted(glob.glob(os.path.join(warmup_dir, "*.json")))
+        jobs = sorted(path for path in glob.glob(os.path.join(warmup_dir, "*.json")) if path != manifest_file)
         if jobs:
             print(f"{worker_name} - Initializing server {SERVICE_TYPE} by running {len(jobs)} jobs...")
             for job_file in jobs:
@@ -1124,13 +4089,37 @@ def init_server():
         jobs_to_run.append({"input": {"workflow": {}}})
 
     # Run all gathered jobs
-    for job in jobs_to_run:
-        run_job(job)
-
-    print(f"{worker_name} - Server {SERVICE_TYPE} initialized successfully.")
+    def run_jobs():
+        for i, job in enumerate(jobs_to_run):
+            start = time.time()
+            run_job(job)
+            timings.append({"phase": f"warmup_job_{i}", "seconds": round(time.time() - start, 3)})
+            print(f"{worker_name} - Warm-up phase warmup_job_{i}: {time.time() - start:.2f}s")
+    jobs_thread = threading.Thread(target=run_jobs, name="warmup-jobs", daemon=True)
+    jobs_thread.start()
+
+    def report():
+        print(f"{worker_name} - Server {SERVICE_TYPE} initialized successfully in {time.time() - warmup_start:.2f}s: {timings}")
+    critical_ready.wait()
+    if not WARMUP_ACCEPT_EARLY:
+        jobs_thread.join()
+    if preload_thread.is_alive() or jobs_thread.is_alive():
+        print(f"{worker_name} - Ready after {time.time() - warmup_start:.2f}s, accepting jobs while the warm-up carries on")
+        def finish():
+            preload_thread.join()
+            jobs_thread.join()
+            report()
+        threading.Thread(target=finish, name="warmup", daemon=True).start()
+    else:
+        report()
+    return timings
 
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
     init_server()
-    runpod.serverless.start({"handler": handler, "return_aggregate_stream": True})
+    if JOB_CONCURRENCY > 1:
+        print(f"{worker_name} - Accepting up to {JOB_CONCURRENCY} jobs at once")
+        runpod.serverless.start({"handler": concurrent_handler, "concurrency_modifier": lambda current_concurrency: JOB_CONCURRENCY, "return_aggregate_stream": True})
+    else:
+        runpod.serverless.start({"handler": handler, "return_aggregate_stream": True})
 
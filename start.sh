@@ -25,11 +25,34 @@ if [ -z "$DOCKER_IMAGE_TYPE" ]; then
     DOCKER_IMAGE_TYPE="comfyui"
 fi
 if [ "$DOCKER_IMAGE_TYPE" == "comfyui" ]; then
+    COMFY_EXTRA_ARGS=""
+    if [ -n "$COMFY_MODEL_CACHE_DIR" ]; then
+        # Look for models in the local model cache (see ModelCache in rp_handler.py) before the network volume
+        # The folders must be kept in sync with MODEL_CACHE_FOLDERS
+        mkdir -p "$COMFY_MODEL_CACHE_DIR"
+        cat > /tmp/extra_model_paths_cache.yaml <<EOF
+model_cache:
+    base_path: $COMFY_MODEL_CACHE_DIR
+    is_default: true
+    checkpoints: checkpoints
+    loras: loras
+    vae: vae
+    unet: unet
+    diffusion_models: diffusion_models
+    clip: clip
+    text_encoders: text_encoders
+    clip_vision: clip_vision
+    controlnet: controlnet
+    upscale_models: upscale_models
+    embeddings: embeddings
+EOF
+        COMFY_EXTRA_ARGS="--extra-model-paths-config /tmp/extra_model_paths_cache.yaml"
+    fi
     echo "runpod-worker-$DOCKER_IMAGE_TYPE: Starting ComfyUI"
     (
         cd /workspace/ComfyUI
         . /workspace/ComfyUI/venv/bin/activate
-        python3 main.py --disable-auto-launch --disable-metadata 2>&1 | tee -a /workspace/ComfyUI/logs/sls-comfyui.log &
+        python3 main.py --disable-auto-launch --disable-metadata $COMFY_EXTRA_ARGS 2>&1 | tee -a /workspace/ComfyUI/logs/sls-comfyui.log &
     )
     echo "runpod-worker-$DOCKER_IMAGE_TYPE: Starting RunPod Handler"
     python3 -u /rp_handler.py